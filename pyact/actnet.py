@@ -1,4 +1,9 @@
+import base64
+import collections
+import errno
+import struct
 import eventlet
+from eventlet import event
 from eventlet.green import socket as _gsocket
 from pyact import actor
 
@@ -9,44 +14,139 @@ from pyact import actor
 #  {'actnet':'tcp_close', 'host':<host>, 'port':<port>}
 #  {'actnet':'tcp_error', 'host':<host>, 'port':<port>,'error':<error>}
 #  {'actnet':'udp', 'host':<host>,'port':<port>}
+#  {'actnet':'udp_batch', 'packets':[(<host>,<port>,<data>),...]}
+#  {'actnet':'tcp_passive', 'host':<host>, 'port':<port>}
+#  {'actnet':'tcp_accept', 'host':<host>, 'port':<port>, 'socket':<socket>}
+#  {'actnet':'udp_passive'}
+#  {'actnet':'tcp_sent', 'host':<host>, 'port':<port>, 'bytes':<count>}
+#  {'actnet':'tcp_send_error', 'host':<host>, 'port':<port>,'error':<error>}
 #
+# Sockets are made active with setactive (or the 'active' option):
+# True delivers every message, ONCE delivers one message and an
+# integer N delivers N more messages. The socket is then passive
+# again; after N messages a tcp_passive or udp_passive message is
+# sent, so the actor knows to call setactive again. Data which is
+# not delivered stays in the kernel socket buffer, pushing back on
+# the peer.
+#
+# With the 'buffers' option (or setbuffers(True)), unframed data
+# is read with recv_into into pooled buffers and delivered as a
+# PooledBinary, a Binary viewing the buffer without copying it.
+# Call its release method when done with it so the buffer can be
+# reused; buffers which are not released are garbage collected.
+#
+# cast_send queues data, a string or a file object, for the socket's
+# writer greenlet and returns without waiting for the peer. Queued
+# strings are joined and sent with one sendall, files are read and
+# sent in chunks. When the queue is empty a tcp_sent message gives
+# the number of bytes sent since the last one; if sending fails the
+# queue is dropped and a tcp_send_error is sent instead. cast_send
+# blocks while more than the high water mark (sethighwater) is
+# queued.
+#
+# An active listening socket accepts connections itself and sends a
+# tcp_accept message for each, carrying the new socket and the peer's
+# host and port. Accepted sockets inherit the listener's framing and
+# owner and are made active with the 'accept_active' mode. With a
+# 'handler' spawnable, each accepted socket is instead passed to a
+# newly spawned handler actor, which owns it. Up to 'accept_batch'
+# pending connections are accepted before other greenlets get to run.
+#
+# UDP sockets take a 'batch' option (or setbatch). With batch=N the
+# poller reads every datagram already waiting, up to N, after each
+# wakeup and sends them as one udp_batch message, which counts as a
+# single message for the active modes.
+#
+# AF_UNIX sockets are supported as well as AF_INET and AF_INET6; pass
+# family=socket.AF_UNIX to connect or listen. Their 'host' is the
+# peer's path, which is empty or None if the peer is unbound, and
+# their 'port' is None.
+#
+# TCP sockets take a 'packet' option. With packet=1, 2 or 4 the
+# stream is made of frames, each preceded by a big endian length
+# header of that many bytes; with packet='line' it is made of
+# newline terminated lines. Each 'tcp' message then carries
+# exactly one complete frame (without its header) or line (with
+# its newline). A frame longer than 'packet_size' bytes is
+# reported as a tcp_error with errno.EMSGSIZE.
 #
 
 def connect(*args,**kw):
-    active = kw.pop('active',False)
+    active,packet,packet_size,buffers = _sockopts(kw)
     s=eventlet.connect(*args,**kw)
-    return _actsock(s,active)
+    return _actsock(s,active,packet,packet_size,buffers)
 
 def listen(*args,**kw):
-    active = kw.pop('active',False)
+    active,packet,packet_size,buffers = _sockopts(kw)
+    accept_active = kw.pop('accept_active',False)
+    handler = kw.pop('handler',None)
+    accept_batch = kw.pop('accept_batch',ACCEPT_BATCH)
     s=eventlet.listen(*args,**kw)
-    return _actsock(s,active)
+    s=_actsock(s,False,packet,packet_size,buffers)
+    s.setaccept(accept_active,handler,accept_batch)
+    s._listening = True
+    s.setactive(active)
+    return s
 
 def socket(*args,**kw):
-    active = kw.pop('active',False)
+    active,packet,packet_size,buffers = _sockopts(kw)
+    batch = kw.pop('batch',None)
     s=_gsocket.socket(*args,**kw)
-    return _actsock(s,active)
+    s=_actsock(s,False,packet,packet_size,buffers)
+    s.setbatch(batch)
+    s.setactive(active)
+    return s
+
+def _sockopts(kw):
+    return (kw.pop('active',False), kw.pop('packet',None),
+            kw.pop('packet_size',PACKET_SIZE), kw.pop('buffers',False))
 
 
 class InvalidActor(Exception): pass
 class InvalidOption(Exception): pass
 
 ONCE      = 'once'
-FAMILIES  = [IPV4,IPV6] = ['ipv4','ipv6']
+LINE      = 'line'
+PACKETS   = [None, 1, 2, 4, LINE]
+PACKET_SIZE = 1024*1024 # default largest frame
+RECV_LIMIT = 65536 # default largest adaptive TCP read
+POOL_SIZE = 64 # most free buffers of each size kept for reuse
+HIGH_WATER = 1024*1024 # queued bytes at which cast_send blocks
+FILE_CHUNK = 65536 # bytes read from a file at once by the writer
+ACCEPT_BATCH = 64 # connections accepted before the acceptor yields
+_HEADERS  = {1:'!B', 2:'!H', 4:'!I'}
+FAMILIES  = [IPV4,IPV6,UNIX] = ['ipv4','ipv6','unix']
 TYPES     = [TCP,UDP]   = ['tcp','udp']
 TCP_ERROR,TCP_CLOSE     = 'tcp_error','tcp_close'
+TCP_PASSIVE,UDP_PASSIVE = 'tcp_passive','udp_passive'
+TCP_SENT,TCP_SEND_ERROR = 'tcp_sent','tcp_send_error'
+TCP_ACCEPT = 'tcp_accept'
+UDP_BATCH = 'udp_batch'
 
 class _actsock(object):
     
-    def __init__(self,sock,active):
+    def __init__(self,sock,active,packet=None,packet_size=PACKET_SIZE,
+                 buffers=False,owner=None):
         self._sock = sock
-        self._actaddr = _curact()
+        self._actaddr = owner or _curact()
         self._active = False
         self._family = _sockfam(sock)
         self._type   = _socktype(sock)
-        self.setactive(active)
         self._gthread = None
-        self._recvmax = 4096
+        self.setrecvmax(4096,RECV_LIMIT)
+        self._rbuf = ''
+        self._rpos = 0
+        self._buffers = buffers
+        self._wqueue = collections.deque()
+        self._wbytes = 0
+        self._whigh = HIGH_WATER
+        self._wready = None
+        self._writer = None
+        self._listening = False
+        self._batch = None
+        self.setaccept()
+        self.setpacket(packet,packet_size)
+        self.setactive(active)
 
     def __getattr__(self,attrib):
         return getattr(self._sock, attrib)
@@ -61,9 +161,26 @@ class _actsock(object):
         self._activate()
         return r
 
+    def listen(self,backlog):
+        r = self._sock.listen(backlog)
+        self._listening = True
+        self._activate()
+        return r
+
     def accept(self):
         connsock,addr = self._sock.accept()
-        return _actsock(connsock,active=False),addr
+        return _actsock(connsock,False,self._packet,self._packet_size,
+                        self._buffers,self._actaddr),addr
+
+    def setaccept(self,active=False,handler=None,batch=ACCEPT_BATCH):
+        """
+        Set the active mode of sockets accepted while listening,
+        the spawnable handling each of them, if any, and how many
+        connections to accept before yielding.
+        """
+        self._accept_active = active
+        self._accept_handler = handler
+        self._accept_batch = batch
 
     def setactor(self,address=None):
         if not address:
@@ -74,21 +191,159 @@ class _actsock(object):
         return self._actaddr
 
     def setactive(self,active):
+        """
+        Set the active mode: False, True, ONCE or a number of
+        messages to deliver, which is added to any remaining count.
+        """
         if not active:
             active = False
-        else:
-            if active != True and active != ONCE:
+        elif _iscount(active):
+            if active < 0:
                 raise InvalidOption("Invalid active value: "+str(active))
-        if active == self._active:
-            return # no change
+            if _iscount(self._active):
+                active += self._active
+        elif active is not True and active != ONCE:
+            raise InvalidOption("Invalid active value: "+str(active))
         self._active = active
         self._activate()
 
     def getactive(self):
         return self._active
 
-    def setrecvmax(self,recvmax):
+    def setpacket(self,packet,packet_size=PACKET_SIZE):
+        """
+        Set how the received stream is split into 'tcp' messages.
+        See the top of this module.
+        """
+        if packet not in PACKETS:
+            raise InvalidOption("Invalid packet value: "+str(packet))
+        self._packet = packet
+        self._packet_size = packet_size
+
+    def getpacket(self):
+        return self._packet
+
+    def sendpacket(self,data):
+        """
+        Send data as one frame, adding the length header
+        when the socket uses packet=1, 2 or 4.
+        """
+        if self._packet in _HEADERS:
+            if len(data) >> (8*self._packet):
+                raise ValueError("frame too long for packet=%s" % self._packet)
+            data = struct.pack(_HEADERS[self._packet],len(data)) + data
+        self._sock.sendall(data)
+
+    def cast_send(self,data):
+        """
+        Queue data, a string or a file object, to be sent by the
+        writer greenlet. Block while the queue is over the high
+        water mark.
+        """
+        if isinstance(data,actor.Binary):
+            data = data.value
+        if isinstance(data,memoryview):
+            data = data.tobytes()
+        while self._wbytes >= self._whigh and self._writer is not None:
+            if self._wready is None:
+                self._wready = event.Event()
+            self._wready.wait()
+        self._wqueue.append(data)
+        if isinstance(data,basestring):
+            self._wbytes += len(data)
+        if self._writer is None:
+            self._writer = eventlet.spawn(self._write_queue)
+
+    def sethighwater(self,high):
+        self._whigh = high
+
+    def gethighwater(self):
+        return self._whigh
+
+    def getqueued(self):
+        return self._wbytes
+
+    def _write_queue(self):
+        sent = 0
+        try:
+            try:
+                while self._wqueue:
+                    chunks = []
+                    while self._wqueue and isinstance(self._wqueue[0],basestring):
+                        chunks.append(self._wqueue.popleft())
+                    if chunks:
+                        data = ''.join(chunks)
+                        self._sock.sendall(data)
+                        self._wbytes -= len(data)
+                        sent += len(data)
+                    else:
+                        sent += self._send_file(self._wqueue.popleft())
+                    self._wake_senders()
+            except (_gsocket.error,IOError),e:
+                self._wqueue.clear()
+                self._wbytes = 0
+                self._report({'actnet':TCP_SEND_ERROR,'error':e.args})
+            else:
+                self._report({'actnet':TCP_SENT,'bytes':sent})
+        finally:
+            self._writer = None
+            self._wake_senders()
+
+    def _send_file(self,f):
+        sent = 0
+        while True:
+            data = f.read(FILE_CHUNK)
+            if not data:
+                return sent
+            self._sock.sendall(data)
+            sent += len(data)
+
+    def _wake_senders(self):
+        if self._wready is not None and (
+                self._wbytes < self._whigh or self._writer is None):
+            ready,self._wready = self._wready,None
+            ready.send()
+
+    def _report(self,msg):
+        try:
+            host,port = _hostport(self._sock.getpeername())
+        except _gsocket.error:
+            host,port = None,None
+        msg['host'] = host
+        msg['port'] = port
+        try:
+            self._actaddr._actor._cast(msg,as_json=False)
+        except (actor.DeadActor, actor.Killed):
+            pass
+
+    def setrecvmax(self,recvmax,limit=None):
+        """
+        Set how many bytes to read at once. If a larger limit is
+        given, TCP reads double in size, up to limit, while they
+        fill the read size, and shrink back towards recvmax when
+        they come in small.
+        """
         self._recvmax = recvmax
+        self._recvlimit = max(limit or recvmax,recvmax)
+        self._recvsize = recvmax
+
+    def setbatch(self,batch):
+        """
+        Set the most datagrams sent in one udp_batch message,
+        or None to send each in its own udp message.
+        """
+        if batch is not None and (not _iscount(batch) or batch < 1):
+            raise InvalidOption("Invalid batch value: "+str(batch))
+        self._batch = batch
+
+    def getbatch(self):
+        return self._batch
+
+    def setbuffers(self,buffers):
+        self._buffers = buffers
+
+    def getbuffers(self):
+        return self._buffers
 
     def getrecvmax(self):
         return self._recvmax
@@ -99,12 +354,17 @@ class _actsock(object):
             self._gthread=None
 
     def _activate(self):
-        if self._active == False:
-            self._kill_poll()
+        if self._active is False:
+            self._kill_poller()
             return
+        if self._gthread is not None and not self._gthread.dead:
+            return # the running poller picks up the new mode
         if self._type == UDP:
             self._gthread = eventlet.spawn(self._udp_poller)
             return
+        if self._listening:
+            self._gthread = eventlet.spawn(self._acceptor)
+            return
         try:
             peername = self._sock.getpeername()
         except _gsocket.error:
@@ -117,52 +377,259 @@ class _actsock(object):
     def _udp_poller(self):
         try:
             while True:
-                (data,addr)=self._sock.recvfrom(self._recvmax)
-                host,port = addr[:2]
+                host,port,data = self._udp_recv(self._sock)
+                if self._batch is None:
+                    msg = {'actnet':UDP,'host':host,'port':port,'data':data}
+                else:
+                    packets = [(host,port,data)]
+                    while len(packets) < self._batch:
+                        try:
+                            # the real socket, which does not wait
+                            packets.append(self._udp_recv(self._sock.fd))
+                        except _gsocket.error,e:
+                            if e.args[0] not in (errno.EAGAIN,errno.EWOULDBLOCK):
+                                raise
+                            break
+                    msg = {'actnet':UDP_BATCH,'packets':packets}
                 try:
                     actobj = self._actaddr._actor
                 except (actor.DeadActor, actor.Killed):
                     break
-                msg = {'actnet':UDP,'host':host,'port':port,'data':data}
                 actobj._cast(msg,as_json=False)
-                if self._active == ONCE:
-                    self._active = False
+                if self._delivered(actobj,{'actnet':UDP_PASSIVE}):
                     break
         except eventlet.greenlet.GreenletExit:
             pass
             
+    def _udp_recv(self,sock):
+        if self._buffers:
+            buf = _pool.get(self._recvmax)
+            n,addr = sock.recvfrom_into(buf,self._recvmax)
+            data = PooledBinary(buf,n)
+        else:
+            data,addr = sock.recvfrom(self._recvmax)
+        host,port = _hostport(addr)
+        return host,port,data
+
     def _tcp_poller(self,peername):
-        host,port = peername[:2]
+        host,port = _hostport(peername)
         try:
             done = False
             while not done:
-                data,error=None,None
-                try:
-                    data=self._sock.recv(self._recvmax)
-                except _gsocket.error,e:
-                    error=e.args
+                kind,value = self._tcp_recv()
                 try:
                     actobj = self._actaddr._actor
                 except (actor.DeadActor, actor.Killed):
                     break
-                if error is None:
-                    if len(data)!=0:
-                        msg = {'actnet':TCP,'host':host,'port':port,'data':data}
-                    else:
-                        msg = {'actnet':TCP_CLOSE,'host':host,'port':port}
-                        done = True
+                if kind == TCP:
+                    msg = {'actnet':TCP,'host':host,'port':port,'data':value}
+                elif kind == TCP_CLOSE:
+                    msg = {'actnet':TCP_CLOSE,'host':host,'port':port}
+                    done = True
                 else:
-                    msg = {'actnet':TCP_ERROR,'host':host,'port':port,'error':error}
+                    msg = {'actnet':TCP_ERROR,'host':host,'port':port,'error':value}
                     done = True
                 actobj._cast(msg,as_json=False)
-                if self._active == ONCE:
-                    self._active = False
+                passive = {'actnet':TCP_PASSIVE,'host':host,'port':port}
+                if self._delivered(actobj,passive):
+                    break
+        except eventlet.greenlet.GreenletExit:
+            pass
+
+    def _acceptor(self):
+        host,port = _hostport(self._sock.getsockname())
+        passive = {'actnet':TCP_PASSIVE,'host':host,'port':port}
+        try:
+            accepted = 0
+            while True:
+                if accepted >= self._accept_batch:
+                    accepted = 0
+                    eventlet.sleep(0)
+                try:
+                    sock,addr = self.accept()
+                except _gsocket.error,e:
+                    sock,error = None,e.args
+                accepted += 1
+                try:
+                    actobj = self._actaddr._actor
+                except (actor.DeadActor, actor.Killed):
+                    if sock is not None:
+                        sock.close()
+                    break
+                if sock is None:
+                    msg = {'actnet':TCP_ERROR,'host':host,'port':port,
+                           'error':error}
+                    actobj._cast(msg,as_json=False)
+                    break
+                if self._accept_handler is not None:
+                    sock.setactor(actor.spawn(self._accept_handler,sock))
+                    sock.setactive(self._accept_active)
+                else:
+                    sock.setactive(self._accept_active)
+                    peerhost,peerport = _hostport(addr)
+                    msg = {'actnet':TCP_ACCEPT,'host':peerhost,'port':peerport,
+                           'socket':sock}
+                    actobj._cast(msg,as_json=False)
+                if self._delivered(actobj,passive):
                     break
         except eventlet.greenlet.GreenletExit:
             pass
 
+    def _delivered(self,actobj,passive):
+        """
+        Count a message delivered to actobj. Return True if the
+        socket has become passive and the poller should stop,
+        after casting the passive message if the socket counted
+        down from a number of messages.
+        """
+        if self._active == ONCE:
+            self._active = False
+            return True
+        if _iscount(self._active):
+            self._active -= 1
+            if self._active == 0:
+                self._active = False
+                actobj._cast(passive,as_json=False)
+                return True
+        return False
+
+    def _tcp_recv(self):
+        """
+        Return (TCP, data) for the next chunk received, or with
+        framing the next complete frame, (TCP_CLOSE, None) when
+        the peer has closed or (TCP_ERROR, error).
+        """
+        while True:
+            if self._packet is not None:
+                try:
+                    frame = self._next_frame()
+                except ValueError,e:
+                    return TCP_ERROR,(errno.EMSGSIZE,str(e))
+                if frame is not None:
+                    return TCP,frame
+            size = self._recvsize
+            try:
+                if self._buffers and self._packet is None:
+                    buf = _pool.get(size)
+                    n = self._sock.recv_into(buf,size)
+                    if n:
+                        data = PooledBinary(buf,n)
+                    else:
+                        _pool.put(buf)
+                        data = ''
+                else:
+                    data=self._sock.recv(size)
+            except _gsocket.error,e:
+                return TCP_ERROR,e.args
+            if not data:
+                return TCP_CLOSE,None
+            self._adapt(len(data))
+            if self._packet is None:
+                return TCP,data
+            self._rbuf = self._rbuf[self._rpos:] + data
+            self._rpos = 0
+
+    def _adapt(self,n):
+        size = self._recvsize
+        if n >= size and size < self._recvlimit:
+            self._recvsize = min(size*2,self._recvlimit)
+        elif n < size//4 and size > self._recvmax:
+            self._recvsize = max(size//2,self._recvmax)
+
+    def _next_frame(self):
+        """
+        Remove and return the next complete frame from the
+        receive buffer, or None if it has not all arrived.
+        """
+        buf,pos = self._rbuf,self._rpos
+        if self._packet == LINE:
+            end = buf.find('\n',pos)
+            if end < 0:
+                if len(buf)-pos > self._packet_size:
+                    raise ValueError("line too long")
+                return None
+            end += 1
+            start = pos
+        else:
+            if len(buf)-pos < self._packet:
+                return None
+            start = pos+self._packet
+            size, = struct.unpack(_HEADERS[self._packet],buf[pos:start])
+            if size > self._packet_size:
+                raise ValueError("frame too long")
+            end = start+size
+            if len(buf) < end:
+                return None
+        if end - start > self._packet_size:
+            raise ValueError("line too long")
+        self._rpos = end
+        return buf[start:end]
+
+
+class PooledBinary(actor.Binary):
+    """
+    A Binary whose value is a memoryview of part of a pooled
+    receive buffer. Once release is called the value must no
+    longer be used, since the buffer will be filled again.
+    """
+    def __init__(self,buf,size):
+        actor.Binary.__init__(self,memoryview(buf)[:size])
+        self._buf = buf
+
+    def __len__(self):
+        return len(self.value)
+
+    def tobytes(self):
+        return self.value.tobytes()
+
+    def to_json(self):
+        return {'_pyact_binary':base64.b64encode(self.tobytes())}
+
+    def release(self):
+        if self._buf is not None:
+            _pool.put(self._buf)
+            self._buf = None
+
+    def __hash__(self):
+        return hash(self.tobytes())
+
+    def __repr__(self):
+        return 'PooledBinary(%r)' % (self.tobytes(),)
+
+
+class _BufferPool(object):
+    """
+    Free receive buffers, kept by size for reuse.
+    """
+    def __init__(self,maxfree=POOL_SIZE):
+        self.maxfree = maxfree
+        self._free = {}
+
+    def get(self,size):
+        free = self._free.get(size)
+        if free:
+            return free.pop()
+        return bytearray(size)
+
+    def put(self,buf):
+        free = self._free.setdefault(len(buf),[])
+        if len(free) < self.maxfree:
+            free.append(buf)
+
+_pool = _BufferPool()
+
+
+def _iscount(active):
+    return isinstance(active,(int,long)) and not isinstance(active,bool)
+
+def _hostport(addr):
+    if addr is None or isinstance(addr,basestring):
+        return addr,None
+    return addr[0],addr[1]
 
 def _sockfam(s):
+    if s.family == getattr(_gsocket,'AF_UNIX',None):
+        return UNIX
     sockname_data = s.getsockname()
     # for IPv4 it is (ip,port)
     # for IPv6 it is (ip,port,flowinfo,scopeid)
@@ -170,7 +637,7 @@ def _sockfam(s):
         return IPV4
     if len(sockname_data) == 4:
         return IPV6
-    raise InvalidOption("Invalid socket family. Accpet only AF_INET and AF_INET6")
+    raise InvalidOption("Invalid socket family. Accpet only AF_INET, AF_INET6 and AF_UNIX")
 
 def _socktype(s):
     t=s.getsockopt(_gsocket.SOL_SOCKET, _gsocket.SO_TYPE)
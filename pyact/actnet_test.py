@@ -1,5 +1,10 @@
+import errno
+import os
+import shutil
+import tempfile
 import unittest
 import eventlet
+from StringIO import StringIO
 from eventlet.green import socket
 from pyact import actor, actnet
 
@@ -131,6 +136,238 @@ class TestActnet(unittest.TestCase):
         assert EchoStream.spawn(port,1024).wait()
 
 
+    def test_adaptive_recv(self):
+        class AdaptiveStream(actor.Actor):
+            def main(self,port):
+                s=actnet.connect(('localhost',port),active=True)
+                s.sendall('x'*100000)
+                sizes = set()
+                rdata = 0
+                while rdata < 100000:
+                    p,m=self.receive({'actnet':'tcp'},timeout=0.1)
+                    if p is None:
+                        break
+                    rdata+=len(m['data'])
+                    sizes.add(s._recvsize)
+                return rdata,max(sizes)
+        rdata,largest = AdaptiveStream.spawn(echo_tcp()).wait()
+        self.assertEquals(rdata,100000)
+        assert 4096 < largest <= actnet.RECV_LIMIT
+
+
+    def test_pooled_buffers(self):
+        class PooledStream(actor.Actor):
+            def main(self,port):
+                s=actnet.connect(('localhost',port),active=True,buffers=True)
+                s.sendall('hello')
+                p,m=self.receive({'actnet':'tcp'},timeout=0.1)
+                data = m['data']
+                result = (isinstance(data,actnet.PooledBinary),
+                          data.tobytes(),data == 'hello')
+                data.release()
+                return result
+        self.assertEquals(PooledStream.spawn(echo_tcp()).wait(),
+                          (True,'hello',True))
+
+
+    def test_cast_send(self):
+        class Writer(actor.Actor):
+            def main(self,port):
+                s=actnet.connect(('localhost',port),active=True)
+                for i in range(10):
+                    s.cast_send('%s\n' % i)
+                s.cast_send(StringIO('file\n'))
+                p,sent=self.receive({'actnet':'tcp_sent'},timeout=0.1)
+                rdata=''
+                while not rdata.endswith('file\n'):
+                    p,m=self.receive({'actnet':'tcp'},timeout=0.1)
+                    if p is None:
+                        break
+                    rdata+=m['data']
+                return sent['bytes'],rdata
+        sent,rdata = Writer.spawn(echo_tcp()).wait()
+        self.assertEquals(sent,25)
+        self.assertEquals(rdata,''.join('%s\n' % i for i in range(10))+'file\n')
+
+
+    def test_cast_send_high_water(self):
+        class SlowPeer(actor.Actor):
+            def main(self):
+                server = eventlet.listen(('127.0.0.1',0))
+                s=actnet.connect(server.getsockname())
+                peer,_ = server.accept()
+                s.sethighwater(1000)
+                s.cast_send('x'*10000)
+                # the writer has not run yet, so this blocks until it has
+                s.cast_send('y')
+                queued = s.getqueued()
+                sent = 0
+                while sent < 10001:
+                    p,m=self.receive({'actnet':'tcp_sent'},timeout=1)
+                    if p is None:
+                        break
+                    sent += m['bytes']
+                return queued,sent
+        queued,sent = SlowPeer.spawn().wait()
+        self.assertEquals(queued,1)
+        self.assertEquals(sent,10001)
+
+
+    def test_cast_send_error(self):
+        class BrokenPipe(actor.Actor):
+            def main(self):
+                server = eventlet.listen(('127.0.0.1',0))
+                s=actnet.connect(server.getsockname())
+                peer,_ = server.accept()
+                s.close()
+                s.cast_send('x')
+                return self.receive({'actnet':'tcp_send_error'},timeout=0.1)
+        p,m = BrokenPipe.spawn().wait()
+        assert p is not None
+
+
+    def test_active_listen(self):
+        class Listener(actor.Actor):
+            def main(self):
+                server=actnet.listen(('127.0.0.1',0),active=True,
+                                     accept_active=True,packet='line')
+                port=server.getsockname()[1]
+                clients=[]
+                for i in range(3):
+                    c=socket.socket()
+                    c.connect(('127.0.0.1',port))
+                    c.sendall('hello %s\n' % i)
+                    clients.append(c)
+                lines=[]
+                for i in range(3):
+                    p,m=self.receive({'actnet':'tcp_accept'},timeout=0.1)
+                    if p is None:
+                        break
+                    assert m['socket'].getpacket() == 'line'
+                    p,m=self.receive({'actnet':'tcp','port':m['port']},timeout=0.1)
+                    lines.append(m['data'])
+                return sorted(lines)
+        self.assertEquals(Listener.spawn().wait(),
+                          ['hello 0\n','hello 1\n','hello 2\n'])
+
+
+    def test_accept_handler(self):
+        def handler(receive,sock):
+            p,m=receive({'actnet':'tcp'},timeout=0.1)
+            sock.sendall(m['data'].upper())
+        class Listener(actor.Actor):
+            def main(self):
+                server=actnet.listen(('127.0.0.1',0),active=actnet.ONCE,
+                                     accept_active=True,handler=handler)
+                c=socket.socket()
+                c.connect(server.getsockname())
+                c.sendall('hi')
+                reply = c.recv(10)
+                return reply,server.getactive()
+        self.assertEquals(Listener.spawn().wait(),('HI',False))
+
+
+    def test_line_framing(self):
+        class LineClient(actor.Actor):
+            def main(self,port):
+                s=actnet.connect(('localhost',port),active=True,packet='line')
+                s.sendall('one\ntw')
+                eventlet.sleep(0.01)
+                s.sendall('o\nthree\n')
+                lines = []
+                for i in range(3):
+                    p,m=self.receive({'actnet':'tcp'},timeout=0.1)
+                    if p is None:
+                        break
+                    lines.append(m['data'])
+                return lines
+        port = echo_tcp()
+        self.assertEquals(LineClient.spawn(port).wait(),
+                          ['one\n','two\n','three\n'])
+
+
+    def test_packet_framing(self):
+        class PacketClient(actor.Actor):
+            def main(self,port,packet):
+                s=actnet.connect(('localhost',port),active=True,
+                                 packet=packet,packet_size=1000)
+                for data in ['x'*200,'','y']:
+                    s.sendpacket(data)
+                frames = []
+                for i in range(3):
+                    p,m=self.receive({'actnet':'tcp'},timeout=0.1)
+                    if p is None:
+                        break
+                    frames.append(m['data'])
+                return frames
+        for packet in [1,2,4]:
+            frames = PacketClient.spawn(echo_tcp(),packet).wait()
+            self.assertEquals(frames,['x'*200,'','y'])
+
+
+    def test_packet_too_large(self):
+        class BigPacketClient(actor.Actor):
+            def main(self,port):
+                s=actnet.connect(('localhost',port),active=True,
+                                 packet=2,packet_size=10)
+                s.sendpacket('x'*11)
+                return self.receive({'actnet':'tcp_error'},timeout=0.1)
+        p,m = BigPacketClient.spawn(echo_tcp()).wait()
+        assert p is not None
+        self.assertEquals(m['error'][0],errno.EMSGSIZE)
+
+
+    def test_active_count(self):
+        class CountingClient(actor.Actor):
+            def main(self,port):
+                s=actnet.connect(('localhost',port),active=3,packet='line')
+                s.sendall(''.join(['%s\n' % i for i in range(5)]))
+                got = []
+                for active in [None, 2]:
+                    if active:
+                        s.setactive(active)
+                    while True:
+                        p,m=self.receive({'actnet':object},timeout=0.1)
+                        if p is None:
+                            return 'timeout'
+                        got.append(m.get('data',m['actnet']))
+                        if m['actnet'] == 'tcp_passive':
+                            break
+                    assert s.getactive() is False
+                    p,m=self.receive({'actnet':object},timeout=0.05)
+                    if p is not None:
+                        return 'unexpected message'
+                return got
+        self.assertEquals(CountingClient.spawn(echo_tcp()).wait(),
+                          ['0\n','1\n','2\n','tcp_passive',
+                           '3\n','4\n','tcp_passive'])
+
+
+    def test_udp_active_count(self):
+        class UDPCounting(actor.Actor):
+            def main(self,port):
+                s=actnet.socket(socket.AF_INET,socket.SOCK_DGRAM,active=1)
+                s.setactive(1)
+                for i in range(3):
+                    s.sendto(str(i),('localhost',port))
+                msgs = []
+                for i in range(3):
+                    p,m=self.receive({'actnet':object},timeout=0.1)
+                    msgs.append(m and m['actnet'])
+                return msgs
+        self.assertEquals(UDPCounting.spawn(echo_udp()).wait(),
+                          ['udp','udp','udp_passive'])
+
+
+    def test_invalid_active(self):
+        class InvalidActive(actor.Actor):
+            def main(self,port):
+                s=actnet.connect(('localhost',port))
+                s.setactive(-1)
+        self.assertRaises(actnet.InvalidOption,
+                          InvalidActive.spawn(echo_tcp()).wait)
+
+
     def test_tcp_close(self):
         class EchoClient(actor.Actor):
             def main(self,port):
@@ -153,6 +390,69 @@ class TestActnet(unittest.TestCase):
         p,m = UDPEcho.spawn(port).wait()
         assert p
    
+    def test_udp_pooled_buffers(self):
+        class UDPPooled(actor.Actor):
+            def main(self,port):
+                s=actnet.socket(socket.AF_INET,socket.SOCK_DGRAM,
+                                active=True,buffers=True)
+                s.sendto('hi',('localhost',port))
+                p,m=self.receive({'actnet':'udp'},timeout=0.1)
+                data = m['data'].tobytes()
+                m['data'].release()
+                return data
+        self.assertEquals(UDPPooled.spawn(echo_udp()).wait(),'hi')
+
+    def test_udp_batch(self):
+        class UDPBatch(actor.Actor):
+            def main(self):
+                s=actnet.socket(socket.AF_INET,socket.SOCK_DGRAM,batch=3)
+                s.bind(('127.0.0.1',0))
+                c=socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+                for i in range(5):
+                    c.sendto(str(i),s.getsockname())
+                s.setactive(True)
+                batches=[]
+                for i in range(2):
+                    p,m=self.receive({'actnet':'udp_batch'},timeout=0.1)
+                    if p is None:
+                        break
+                    batches.append([data for host,port,data in m['packets']])
+                return batches
+        self.assertEquals(UDPBatch.spawn().wait(),[['0','1','2'],['3','4']])
+
+    def test_unix_stream(self):
+        path = os.path.join(tempfile.mkdtemp(),'sock')
+        class UnixEcho(actor.Actor):
+            def main(self):
+                server=actnet.listen(path,family=socket.AF_UNIX,active=True,
+                                     accept_active=True)
+                c=actnet.connect(path,family=socket.AF_UNIX,active=True)
+                p,m=self.receive({'actnet':'tcp_accept'},timeout=0.1)
+                m['socket'].sendall('hi')
+                p,m=self.receive({'actnet':'tcp','data':'hi'},timeout=0.1)
+                return m['host'],m['port'],c.getsockname()
+        try:
+            self.assertEquals(UnixEcho.spawn().wait(),(path,None,''))
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_unix_datagram(self):
+        tmpdir = tempfile.mkdtemp()
+        class UnixDatagram(actor.Actor):
+            def main(self):
+                s=actnet.socket(socket.AF_UNIX,socket.SOCK_DGRAM,active=True)
+                s.bind(os.path.join(tmpdir,'server'))
+                c=socket.socket(socket.AF_UNIX,socket.SOCK_DGRAM)
+                c.bind(os.path.join(tmpdir,'client'))
+                c.sendto('hi',os.path.join(tmpdir,'server'))
+                p,m=self.receive({'actnet':'udp'},timeout=0.1)
+                return m['host'],m['port'],m['data']
+        try:
+            self.assertEquals(UnixDatagram.spawn().wait(),
+                              (os.path.join(tmpdir,'client'),None,'hi'))
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_udp_dialog(self):
         class UDPDialog(actor.Actor):
             def main(self,port):
@@ -19,8 +19,13 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import collections
+import heapq
+import logging
+import socket
 import sys
-import traceback
+import time
+import urllib
 import urlparse
 import uuid
 import weakref
@@ -36,17 +41,36 @@ import eventlet
 from eventlet import hubs
 from eventlet import event
 from eventlet import greenlet
+from eventlet import queue
 
 from eventlet.green import httplib
 
 from pyact import exc
+from pyact import sched
 from pyact import shape
+from pyact import timers
+from pyact import trace
 
 
-## If set to true, an Actor will print out every exception, even if the parent
-## handles the exception properly.
+## If set to true, an Actor will log every exception to the 'pyact.actor'
+## logger, even if the parent handles the exception properly. Logging is
+## rate limited and done from another greenlet; see exc.RateLimitedLog.
 NOISY_ACTORS = True
 
+exception_log = exc.RateLimitedLog(logging.getLogger('pyact.actor'))
+
+## Number of Actor.changed calls remembered for computing state diffs.
+CHANGE_LOG_SIZE = 64
+
+## Actor.stats counters which node_stats sums over all Actors, including
+## those which have exited.
+STAT_TOTALS = ('messages_in', 'messages_out', 'messages_scanned',
+               'blocked_time', 'unblocked_time')
+
+## Totals of the Actors which have exited, and the numbers of Actors
+## created and exited.
+_node_totals = dict.fromkeys(STAT_TOTALS + ('spawned', 'exited'), 0)
+
 
 class ActorError(RuntimeError):
     """Base class for actor exceptions.
@@ -108,7 +132,9 @@ def spawn(spawnable, *args, **kw):
         spawnable = Actor(spawnable)
 
     spawnable._args = (args, kw)
-    eventlet.spawn_after(0, spawnable.switch)
+    if trace.enabled:
+        _trace_spawn(spawnable)
+    timers.call_soon(spawnable.switch)
     return spawnable.address
 
 
@@ -139,10 +165,57 @@ def spawn_link(spawnable, *args, **kw):
 
     spawnable._args = (args, kw)
     spawnable.add_link(eventlet.getcurrent().address)
-    eventlet.spawn_after(0, spawnable.switch)
+    if trace.enabled:
+        _trace_spawn(spawnable)
+    timers.call_soon(spawnable.switch)
     return spawnable.address
 
 
+def _trace_spawn(spawnable):
+    spawnable._trace_id = trace.current_trace()
+    trace.emit(trace.SPAWN, {'actor': spawnable.actor_id,
+                             'parent': _current_id(),
+                             'type': type(spawnable).__name__,
+                             'trace': spawnable._trace_id})
+
+
+def _current_id():
+    return getattr(eventlet.getcurrent(), 'actor_id', None)
+
+
+def send_after(address, message, delay):
+    """Cast message to address after delay seconds. Return a
+    timers.Timer; cancel it and the message is not sent.
+    """
+    return timers.call_later(delay, _send_timed, address, message)
+
+
+def send_interval(address, message, interval):
+    """Cast message to address every interval seconds, until the
+    returned timers.Timer is cancelled or the Actor at address dies.
+    """
+    timer = timers.call_interval(interval, _send_timed, address, message)
+    timer.args = (address, message, timer)
+    return timer
+
+
+def _send_timed(address, message, timer=None):
+    ## Timers run in the hub, which must not block on HTTP.
+    if isinstance(address, RemoteAddress):
+        eventlet.spawn_n(_cast_timed, address, message, timer)
+    else:
+        _cast_timed(address, message, timer)
+
+
+def _cast_timed(address, message, timer):
+    try:
+        delivered = address.cast(message) is not False
+    except DeadActor:
+        delivered = False
+    if not delivered and timer is not None:
+        timer.cancel()
+
+
 def connect(url):
     parsed = urlparse.urlparse(url)
     if parsed[0] == 'http':
@@ -170,6 +243,121 @@ def spawn_remote(url, code_string):
         return RemoteAddress(url)
     raise RuntimeError("Could not spawn remote Actor.")
 
+def register_template(url, name, code_string):
+    """Compile some code once in the remote process at url and
+    register it under name, for spawning with spawn_template.
+    """
+    parsed, conn = connect(urlparse.urljoin(url, '_templates/' + name))
+    conn.request('PUT', parsed[2], code_string)
+    resp = conn.getresponse()
+    if resp.status != 201:
+        raise RuntimeError("Could not register remote template %r." % (name, ))
+
+
+def spawn_template(url, name, args=None):
+    """Run the code registered as template name in the remote process,
+    making args available to it as "args". Returns the Address of the
+    remote Actor.
+    """
+    parsed, conn = connect(url)
+    body = '' if args is None else json.dumps(args, default=handle_custom)
+    conn.request('PUT', parsed[2] + '?template=' + urllib.quote(name), body)
+    resp = conn.getresponse()
+    if resp.status == 202:
+        return RemoteAddress(url)
+    raise RuntimeError("Could not spawn remote Actor from template %r." % (name, ))
+
+def spawn_remote_many(url, count, code_string=None, template=None, args=None):
+    """Run count copies of some code, or of a template registered with
+    register_template, in the remote process at url using one request.
+    Returns the Addresses of the remote Actors.
+    """
+    request = {'count': count}
+    if template is None:
+        request['code'] = code_string
+    else:
+        request['template'] = template
+        request['args'] = args
+    parsed, conn = connect(urlparse.urljoin(url, '_spawn'))
+    conn.request('PUT', parsed[2], json.dumps(request, default=handle_custom))
+    resp = conn.getresponse()
+    if resp.status != 202:
+        raise RuntimeError("Could not spawn remote Actors.")
+    ids = json.loads(resp.read())['actors']
+    return [RemoteAddress(urlparse.urljoin(url, actor_id)) for actor_id in ids]
+
+
+def remote_load(url):
+    """Return {'actors': <actor count>, 'mailbox': <queued messages>} for
+    the remote process at url.
+    """
+    parsed, conn = connect(urlparse.urljoin(url, '_load'))
+    conn.request('GET', parsed[2])
+    resp = conn.getresponse()
+    if resp.status != 200:
+        raise RuntimeError("Could not get remote load.")
+    return json.loads(resp.read())
+
+
+def place(urls, count):
+    """Divide count new Actors between the remote processes at urls,
+    favouring the least loaded. Returns a list of (url, number) pairs.
+    """
+    loads = []
+    for url in urls:
+        load = remote_load(url)
+        loads.append((load['actors'] + load['mailbox'], url))
+    heapq.heapify(loads)
+    placed = dict.fromkeys(urls, 0)
+    for i in xrange(count):
+        load, url = loads[0]
+        placed[url] += 1
+        heapq.heapreplace(loads, (load + 1, url))
+    return [(url, placed[url]) for url in urls if placed[url]]
+
+
+def spawn_remote_placed(urls, count, code_string=None, template=None, args=None):
+    """Like spawn_remote_many, but place the Actors on the least loaded of
+    several remote processes. See pyactpmd.node_urls for finding the
+    processes registered with a port mapper.
+    """
+    addresses = []
+    for url, number in place(urls, count):
+        addresses.extend(
+            spawn_remote_many(url, number, code_string, template, args))
+    return addresses
+
+def _count_out():
+    current = eventlet.getcurrent()
+    if isinstance(current, Actor):
+        current._messages_out += 1
+
+
+def node_stats(actors=False):
+    """Return the Actor.stats counters summed over all the Actors of this
+    process, including those which have exited, with the number of
+    Actors running, spawned and exited, the total and largest mailbox
+    lengths of the running Actors and, if actors is true, the list of
+    their stats as 'actor_stats'.
+    """
+    result = dict(_node_totals)
+    result['actors'] = len(Actor.all_actors)
+    result['mailbox'] = 0
+    result['mailbox_peak'] = 0
+    actor_stats = []
+    for an_actor in Actor.all_actors.values():
+        stats = an_actor.stats()
+        for key in STAT_TOTALS:
+            result[key] += stats[key]
+        result['mailbox'] += stats['mailbox']
+        result['mailbox_peak'] = max(result['mailbox_peak'], stats['mailbox_peak'])
+        if actors:
+            actor_stats.append(stats)
+    if actors:
+        result['actor_stats'] = actor_stats
+    return result
+
+
 def handle_custom(obj):
     if isinstance(obj, Address) or isinstance(obj,Binary):
         return obj.to_json()
@@ -259,6 +447,21 @@ class Address(object):
         """
         self._actor.add_link(eventlet.getcurrent().address, trap_exit=trap_exit)
 
+    def subscribe(self, address=None):
+        """Subscribe the current Actor (or the given Address) to messages the
+        Actor at this address publishes with Actor.publish.
+        """
+        if address is None:
+            address = eventlet.getcurrent().address
+        self._actor.add_subscriber(address)
+
+    def unsubscribe(self, address=None):
+        """Stop receiving messages published by the Actor at this address.
+        """
+        if address is None:
+            address = eventlet.getcurrent().address
+        self._actor.remove_subscriber(address)
+
     def cast(self, message):
         """Send a message to the Actor this object addresses.
         """
@@ -268,7 +471,16 @@ class Address(object):
         ## object.
         if hasattr(message,'_as_json_obj'):
             message = message._as_json_obj()
-        self._actor._cast(json.dumps(message, default=handle_custom))
+        encoded = json.dumps(message, default=handle_custom)
+        self._actor._cast(encoded)
+        _count_out()
+        if trace.enabled:
+            trace.emit(trace.CAST, {'actor': _current_id(),
+                                    'to': self.actor_id,
+                                    'size': len(encoded),
+                                    'trace': trace.current_trace()})
+        if sched.enabled:
+            sched.charge()
 
     def __or__(self, message):
         """Use Erlang-y syntax (| instead of !) to send messages.
@@ -287,23 +499,27 @@ class Address(object):
         """
         message_id = str(uuid.uuid1())
         my_address = eventlet.getcurrent().address
-        self.cast(
-                {'call': message_id, 'method': method,
-                'address': my_address, 'message': message})
+        call_msg = {'call': message_id, 'method': method,
+                    'address': my_address, 'message': message}
+        if trace.enabled:
+            call_msg['trace'] = trace.current_trace() or trace.new_trace_id()
+        self.cast(call_msg)
         if timeout is None:
             cancel = None
         else:
             ## Raise any TimeoutError to the caller so they can handle it
-            cancel = eventlet.Timeout(timeout, eventlet.TimeoutError)
+            cancel = timers.call_later(
+                timeout, eventlet.getcurrent().throw, eventlet.TimeoutError)
 
         RSP = {'response': message_id, 'message': object}
         EXC = {'response': message_id, 'exception': object}
         INV = {'response': message_id, 'invalid_method': str}
 
-        pattern, response = eventlet.getcurrent().receive(RSP, EXC, INV)
-
-        if cancel is not None:
-            cancel.cancel()
+        try:
+            pattern, response = eventlet.getcurrent().receive(RSP, EXC, INV)
+        finally:
+            if cancel is not None:
+                cancel.cancel()
 
         if pattern is INV:
             raise RemoteAttributeError(method)
@@ -333,26 +549,141 @@ class Address(object):
         eventlet.kill(self._actor, Killed)
 
 
+## 'scheme://host:port/' prefixes under which this process serves its own
+## Actors. RemoteAddresses for urls under them are delivered in process.
+_local_urls = set()
+
+
+def _url_prefix(url):
+    """Return the 'scheme://host:port/' part of url.
+    """
+    parsed = urlparse.urlparse(url)
+    scheme, host = parsed[0].lower(), parsed[1].lower()
+    if ':' not in host:
+        host += {'http': ':80', 'https': ':443'}.get(scheme, '')
+    return '%s://%s/' % (scheme, host)
+
+
+def add_local_url(url):
+    """Declare that url is the root of a wsgiapp serving this process's
+    Actors, so RemoteAddresses under it skip HTTP.
+    """
+    _local_urls.add(_url_prefix(url))
+
+
+def add_local_node(port, scheme='http', hosts=()):
+    """Declare the local urls of a wsgiapp served on port, under the
+    usual names of this host and any extra host aliases.
+    """
+    names = ['localhost', '127.0.0.1', socket.gethostname()]
+    for host in names + list(hosts):
+        add_local_url('%s://%s:%s/' % (scheme, host, port))
+
+
+def _local_actor_id(url):
+    """Return the actor_id of url if it addresses this process, else None.
+    """
+    if not _local_urls:
+        return None
+    prefix = _url_prefix(url)
+    if prefix in _local_urls:
+        return urlparse.urlparse(url)[2][1:]
+    return None
+
+
+class LookupCache(object):
+    """A least recently used cache of whether urls name existing Actors.
+    Found urls are remembered for ttl seconds and missing ones for
+    negative_ttl seconds. hits and misses count cache lookups.
+    """
+    def __init__(self, maxsize=1024, ttl=30.0, negative_ttl=5.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict() # url : (expires, found)
+
+    def get(self, url):
+        """Return True if url is known to exist, False if it is known
+        not to, or None if it must be looked up.
+        """
+        entry = self._entries.pop(url, None)
+        if entry is None or entry[0] < time.time():
+            self.misses += 1
+            return None
+        self._entries[url] = entry
+        self.hits += 1
+        return entry[1]
+
+    def put(self, url, found):
+        self._entries.pop(url, None)
+        if found:
+            expires = time.time() + self.ttl
+        else:
+            expires = time.time() + self.negative_ttl
+        self._entries[url] = (expires, found)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, url):
+        self._entries.pop(url, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
 class RemoteAddress(Address):
+    ## Shared by all RemoteAddress.lookup calls in this process.
+    lookup_cache = LookupCache()
+
     def __init__(self, address):
         self._address = address
 
     @staticmethod
     def lookup(url):
         if url.startswith('http://') or url.startswith('https://'):
-            parsed, conn = connect(url)
-            conn.request('HEAD', parsed[2])
-            resp = conn.getresponse()
-            if resp.status != 404:
+            local_id = _local_actor_id(url)
+            if local_id is not None:
+                return Address.lookup(local_id)
+            found = RemoteAddress.lookup_cache.get(url)
+            if found is None:
+                parsed, conn = connect(url)
+                conn.request('HEAD', parsed[2])
+                resp = conn.getresponse()
+                found = resp.status != 404
+                RemoteAddress.lookup_cache.put(url, found)
+            if found:
                 return RemoteAddress(url)
             raise KeyError(url)
-        return Actor.lookup(url)
+        return Address.lookup(url)
 
     @property
     def actor_id(self):
         return self._address
 
+    def _local(self):
+        """Return the in-process Address this url refers to, or None
+        if it refers to another process.
+        """
+        local_id = _local_actor_id(self._address)
+        if local_id is None:
+            return None
+        local_actor = Actor.all_actors.get(local_id)
+        if local_actor is None:
+            raise DeadActor()
+        return local_actor.address
+
     def cast(self, message):
+        """Send a message to the remote Actor this object addresses.
+        Return False if its node answered that there is no such Actor.
+        """
+        try:
+            local = self._local()
+            if local is not None:
+                return local.cast(message)
+        except DeadActor:
+            return False
         parsed, conn = connect(self._address)
         ## TODO how to get the address of the local http server? This does not give fully
         ## qualified return addresses
@@ -363,35 +694,61 @@ class RemoteAddress(Address):
         ## object.
         if hasattr(message,'_as_json_obj'):
             message = message._as_json_obj()
-        conn.request('POST', parsed[2], json.dumps(message, default=handle_custom))
+        encoded = json.dumps(message, default=handle_custom)
+        conn.request('POST', parsed[2], encoded)
+        _count_out()
+        if trace.enabled:
+            trace.emit(trace.CAST, {'actor': _current_id(),
+                                    'to': self._address,
+                                    'size': len(encoded),
+                                    'trace': trace.current_trace()})
         resp = conn.getresponse()
+        if resp.status == 404:
+            self.lookup_cache.invalidate(self._address)
+            return False
 
     def call(self, method, message=None, timeout=None):
         """Send a message to the remote Actor this object addresses.
         Wait for a result. If a timeout in seconds is passed, raise
         eventlet.TimeoutError if no result is returned in less than the timeout.
         """
+        local = self._local()
+        if local is not None and hasattr(eventlet.getcurrent(), 'address'):
+            return local.call(method, message, timeout)
         message_id = str(uuid.uuid1())
         parsed,conn = connect(self._address)
         call_msg = {'remotecall':message_id,
                     'method':method,
                     'message':message,
                     'timeout':timeout}
-        resp = conn.request('POST',parsed[2],json.dumps(call_msg,default=handle_custom))
+        headers = {}
+        if trace.enabled:
+            call_msg['trace'] = trace.current_trace() or trace.new_trace_id()
+            headers['X-Pyact-Trace'] = call_msg['trace']
+        resp = conn.request('POST',parsed[2],json.dumps(call_msg,default=handle_custom),
+                            headers)
         if timeout is None:
             cancel = None
         else:
             ## Raise any TimeoutError to the caller so they can handle it
-            cancel = eventlet.Timeout(timeout, eventlet.TimeoutError)
+            cancel = timers.call_later(
+                timeout, eventlet.getcurrent().throw, eventlet.TimeoutError)
 
-        resp = conn.getresponse()
-        stat = resp.status
-        rstr = resp.read()
+        try:
+            resp = conn.getresponse()
+            stat = resp.status
+            rstr = resp.read()
+        finally:
+            if cancel is not None:
+                cancel.cancel()
 
         if stat == 202:
             rjson = json.loads(rstr,object_hook=generate_custom)
             return rjson['message']
         elif stat == 404:
+            if resp.getheader('Content-type') != 'application/json':
+                self.lookup_cache.invalidate(self._address)
+                raise DeadActor(self._address)
             rjson = json.loads(rstr,object_hook=generate_custom)
             raise RemoteAttributeError(rjson['invalid_method'])
         elif stat == 406:
@@ -404,11 +761,17 @@ class RemoteAddress(Address):
             raise RemoteException("Unknown remote response "+str(stat))
 
     def kill(self):
+        local = self._local()
+        if local is not None:
+            return local.kill()
         parsed, conn = connect(self._address)
         conn.request('DELETE', parsed[2])
         resp = conn.getresponse()
 
     def wait(self):
+        local = self._local()
+        if local is not None:
+            return local.wait()
         raise NotImplementedError(
             "Can't wait on a RemoteAddress yet. "
             "Need some sort of COMET protocol to implement this?")
@@ -462,6 +825,10 @@ class Actor(greenlet.greenlet):
     _mailbox = lazy_property('_p_mailbox', lambda self: [])
     _links = lazy_property('_p_links', lambda self: [])
     _exit_links = lazy_property('_p_exit_links', lambda self: [])
+    _subscribers = lazy_property('_p_subscribers', lambda self: [])
+    _changes = lazy_property('_p_changes',
+        lambda self: collections.deque(maxlen=CHANGE_LOG_SIZE))
+    _state_version = None
     _exit_event = lazy_property('_p_exit_event', lambda self: event.Event())
 
     address = lazy_property('_p_address', lambda self: Address(self),
@@ -473,6 +840,32 @@ class Actor(greenlet.greenlet):
     spawn = classmethod(spawn)
     spawn_link = classmethod(spawn_link)
 
+    ## Scheduling priority, one of sched.PRIORITIES; only used once
+    ## sched.enable has been called.
+    priority = sched.NORMAL
+    _reductions = 0
+    _ticket = None
+
+    ## Id of the trace this Actor is working for; see the trace module.
+    _trace_id = None
+    trace_id = property(
+        lambda self: self._trace_id,
+        lambda self, trace_id: setattr(self, '_trace_id', trace_id))
+
+    ## Runtime counters; see stats. They are private so that they are
+    ## not part of the state the wsgi gateway serves.
+    _messages_in = 0
+    _messages_out = 0
+    _messages_scanned = 0
+    _mailbox_peak = 0
+    _blocked_time = 0.0
+    _started = None
+    _exited = None
+
+    ## Detail level of the exception reports this Actor sends to its
+    ## links and callers, one of exc.DETAIL_LEVELS; None for exc.DETAIL.
+    exception_detail = None
+
     all_actors = {}
 
     actor_id = property(lambda self: self._actor_id)
@@ -487,6 +880,7 @@ class Actor(greenlet.greenlet):
 
         self._actor_id = str(uuid.uuid1())
         self.all_actors[self.actor_id] = self
+        _node_totals['spawned'] += 1
 
     #######
     ## Methods for general use
@@ -499,7 +893,68 @@ class Actor(greenlet.greenlet):
         self._actor_id = name
         self.all_actors[name] = self
 
-        
+    @property
+    def state_version(self):
+        """The number of times this Actor has called changed, or None if
+        it never has and its state is therefore not versioned.
+        """
+        return self._state_version
+
+    def changed(self, *names):
+        """Record that this Actor changed the public attributes with the
+        given names, or all of its state if no names are given.
+
+        Actors which call changed let the wsgi gateway answer GET
+        requests with ETags, cached snapshots and diffs since a version.
+        """
+        self._state_version = (self._state_version or 0) + 1
+        self._changes.append((self._state_version, names))
+
+    def changed_since(self, version):
+        """Return the names of the attributes changed after the given state
+        version, or None if they are not known and the whole state must
+        be considered changed.
+        """
+        current = self._state_version
+        if current is None or version > current:
+            return None
+        if version == current:
+            return set()
+        if not self._changes or self._changes[0][0] > version + 1:
+            return None
+        names = set()
+        for changed_version, changed_names in self._changes:
+            if changed_version <= version:
+                continue
+            if not changed_names:
+                return None
+            names.update(changed_names)
+        return names
+
+    def stats(self):
+        """Return this Actor's runtime counters: the messages cast to it,
+        the messages it cast, the current and largest mailbox lengths,
+        the messages its receive patterns were matched against, the
+        seconds it spent blocked in receive and the other seconds since
+        it started. Those are wall clock seconds, and include any time
+        spent sleeping or waiting for I/O outside of receive; see the
+        profiler module for CPU time.
+        """
+        if self._started is None:
+            unblocked_time = 0.0
+        else:
+            unblocked_time = ((self._exited or time.time()) - self._started
+                              - self._blocked_time)
+        return {'actor_id': self.actor_id,
+                'type': type(self).__name__,
+                'messages_in': self._messages_in,
+                'messages_out': self._messages_out,
+                'mailbox': len(self._mailbox),
+                'mailbox_peak': self._mailbox_peak,
+                'messages_scanned': self._messages_scanned,
+                'blocked_time': self._blocked_time,
+                'unblocked_time': unblocked_time}
+
     def _match_patterns(self,patterns):
         """Internal method to match a list of patterns against
         the mailbox. If message matches any of the patterns,
@@ -510,8 +965,20 @@ class Actor(greenlet.greenlet):
         for i, message in enumerate(self._mailbox):
             for pattern in patterns:
                 if shape.is_shaped(message, pattern):
+                    self._messages_scanned += i + 1
+                    if sched.enabled:
+                        # may yield, so charge while the message is
+                        # still in the mailbox; only appends happen
+                        sched.charge(i + 1)
                     del self._mailbox[i]
+                    if trace.enabled:
+                        self._trace_receive(message)
                     return pattern, message
+        self._messages_scanned += len(self._mailbox)
+        if sched.enabled:
+            # not yielding here, since a message cast meanwhile would
+            # not wake receive; the next charge may yield instead
+            self._reductions += len(self._mailbox)
         return None,None
         
     def receive(self, *patterns, **kw):
@@ -523,12 +990,17 @@ class Actor(greenlet.greenlet):
         if timeout == 0 :
             if not patterns:
                 if self._mailbox:
-                    return {object: object}, self._mailbox.pop(0)
+                    if sched.enabled:
+                        sched.charge()
+                    message = self._mailbox.pop(0)
+                    if trace.enabled:
+                        self._trace_receive(message)
+                    return {object: object}, message
                 else:
                     return None,None
             return self._match_patterns(patterns)
         if timeout is not None:
-            timer = eventlet.Timeout(kw['timeout'], ReceiveTimeout)
+            timer = timers.call_later(timeout, self.throw, ReceiveTimeout)
         else:
             timer = None
         try:
@@ -536,23 +1008,40 @@ class Actor(greenlet.greenlet):
                 if patterns:
                     matched_pat, matched_msg = self._match_patterns(patterns)
                 elif self._mailbox:
+                    if sched.enabled:
+                        sched.charge()
                     matched_pat, matched_msg = {object:object},self._mailbox.pop(0)
+                    if trace.enabled:
+                        self._trace_receive(matched_msg)
                 else:
                     matched_pat = None
                 if matched_pat is not None:
-                    if timer:
-                        timer.cancel()
                     return matched_pat,matched_msg
                 self._wevent = event.Event()
+                blocked = time.time()
                 try:
                     # wait until at least one message or timeout
                     self._wevent.wait()
                 finally:
                     self._wevent = None
+                    self._blocked_time += time.time() - blocked
         except ReceiveTimeout:
             return (None,None)
+        finally:
+            if timer is not None:
+                timer.cancel()
 
 
+    def _trace_receive(self, message):
+        # only calls carry trace ids; other messages are the user's
+        if (type(message) is dict and
+                isinstance(message.get('trace'), basestring) and
+                shape.is_shaped(message, CALL_PATTERN)):
+            self._trace_id = message['trace']
+        trace.emit(trace.RECEIVE, {'actor': self.actor_id,
+                                   'mailbox': len(self._mailbox),
+                                   'trace': self._trace_id})
+
     def respond(self, orig_message, response=None):
         if not shape.is_shaped(orig_message, CALL_PATTERN):
             raise InvalidCallMessage(str(orig_message))
@@ -582,6 +1071,40 @@ class Actor(greenlet.greenlet):
         if trap_exit:
             self._exit_links.append(address)
 
+    def add_subscriber(self, address):
+        """Add the Actor at the given Address to the Actors which receive
+        the messages this Actor publishes.
+        """
+        assert isinstance(address, Address)
+        if address not in self._subscribers:
+            self._subscribers.append(address)
+
+    def remove_subscriber(self, address):
+        """Remove the Actor at the given Address from this Actor's subscribers.
+        """
+        if address in self._subscribers:
+            self._subscribers.remove(address)
+
+    def publish(self, message):
+        """Cast a message to every subscriber of this Actor. The message is
+        encoded once and shared by all local subscribers. Subscribers which
+        are no longer running are dropped.
+        """
+        if not self._subscribers:
+            return
+        if hasattr(message,'_as_json_obj'):
+            message = message._as_json_obj()
+        encoded = json.dumps(message, default=handle_custom)
+        for subscriber in list(self._subscribers):
+            try:
+                if type(subscriber) is Address:
+                    subscriber._actor._cast(encoded)
+                    self._messages_out += 1
+                else:
+                    subscriber.cast(message)
+            except DeadActor:
+                self.remove_subscriber(subscriber)
+
     def main(self, *args, **kw):
         """If subclassing Actor, override this method to implement the Actor's
         main loop.
@@ -610,21 +1133,33 @@ class Actor(greenlet.greenlet):
         del self._args
         to_run = self._to_run
         del self._to_run
+        self._started = time.time()
+        exc_info = None
         try:
             result = to_run(*args, **kw)
             self._exit_event.send(result)
         except:
+            exc_info = sys.exc_info()
             if NOISY_ACTORS:
-                print "Actor had an exception:"
-                traceback.print_exc()
+                exception_log.exception(
+                    "Actor %s had an exception:" % (self.actor_id, ), exc_info)
             result = None
-            formatted = exc.format_exc()
-            for link in self._links:
-                link.cast({'address': self.address, 'exception': formatted})
-            exc_info = sys.exc_info()
+            if self._links:
+                formatted = exc.format_exc(exc_info, self.exception_detail)
+                for link in self._links:
+                    link.cast({'address': self.address, 'exception': formatted})
             self._exit_event.send_exception(*exc_info)
         for link in self._exit_links:
             link.cast({'address': self.address, 'exit': result})
+        self._exited = time.time()
+        if trace.enabled:
+            trace.emit(trace.EXIT, {'actor': self.actor_id,
+                                    'exception': exc_info is not None,
+                                    'trace': self._trace_id})
+        stats = self.stats()
+        for key in STAT_TOTALS:
+            _node_totals[key] += stats[key]
+        _node_totals['exited'] += 1
         self.all_actors.pop(self.actor_id)
 
     def _cast(self, message, as_json=True):
@@ -632,9 +1167,19 @@ class Actor(greenlet.greenlet):
         
         Address uses this to insert a message into this Actor's mailbox.
         """
+        size = None
         if as_json:
+            size = len(message)
             message = json.loads(message, object_hook=generate_custom)
         self._mailbox.append(message)
+        self._messages_in += 1
+        if trace.enabled:
+            trace.emit(trace.DELIVER, {'actor': self.actor_id,
+                                       'size': size,
+                                       'mailbox': len(self._mailbox),
+                                       'trace': self._trace_id})
+        if len(self._mailbox) > self._mailbox_peak:
+            self._mailbox_peak = len(self._mailbox)
         if self._wevent and not self._wevent.has_result():
             self._wevent.send(None)
 
@@ -672,12 +1217,148 @@ class Server(Actor):
                 try:
                     self.respond(message,  method(message['message']))
                 except Exception, e:
-                    formatted = exc.format_exc()
+                    formatted = exc.format_exc(detail=self.exception_detail)
                     self.respond_exception(message, formatted)
         finally:
             self.stop(*args, **kw)
 
 
+## Supervisor restart strategies. one_for_one restarts only the child
+## which stopped, one_for_all restarts all children and rest_for_one
+## restarts the child which stopped and the children started after it.
+STRATEGIES = [ONE_FOR_ONE, ONE_FOR_ALL, REST_FOR_ONE] = [
+    'one_for_one', 'one_for_all', 'rest_for_one']
+
+## Child restart types. A permanent child is always restarted, a
+## transient child only if it had an exception, and a temporary child
+## is never restarted.
+RESTART_TYPES = [PERMANENT, TRANSIENT, TEMPORARY] = [
+    'permanent', 'transient', 'temporary']
+
+
+class TooManyRestarts(ActorError):
+    """Exception which a Supervisor exits with when its children had to be
+    restarted more than max_restarts times in max_seconds.
+    """
+    pass
+
+
+class Supervisor(Actor):
+    """An actor which starts children and restarts them when they stop.
+
+    Spawn a Supervisor with a list of child specs, dictionaries like:
+
+        {'id': 'worker', 'start': Worker, 'args': [], 'kw': {},
+         'restart': PERMANENT}
+
+    where start is a spawnable and only id and start are required.
+    Children are started in order. When one stops, the children
+    picked by the strategy are killed, last started first, and started
+    again in order.
+
+    A restart which follows others within max_seconds is delayed by
+    backoff seconds, doubled for each of those others, up to
+    max_backoff. If more than max_restarts restarts happen within
+    max_seconds, the Supervisor kills all its children and exits with
+    TooManyRestarts.
+
+    Call which_children for a list of [id, address] pairs, the address
+    being None while a child waits to be restarted.
+    """
+    def main(self, children, strategy=ONE_FOR_ONE, max_restarts=3,
+             max_seconds=5, backoff=0.01, max_backoff=1):
+        if strategy not in STRATEGIES:
+            raise ValueError("Invalid strategy: " + str(strategy))
+        self.strategy = strategy
+        self.max_restarts = max_restarts
+        self.max_seconds = max_seconds
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._children = [[spec, None] for spec in children]
+        self._restarts = collections.deque()
+        try:
+            for child in self._children:
+                self.start_child(child)
+            while True:
+                pattern, message = self.receive(
+                    {'exit': object, 'address': object},
+                    {'exception': object, 'address': object},
+                    {'supervisor': 'restart', 'ids': list},
+                    CALL_PATTERN)
+                if pattern is CALL_PATTERN:
+                    self.handle_call(message)
+                elif 'supervisor' in pattern:
+                    for child in self._children:
+                        if child[1] is None and child[0]['id'] in message['ids']:
+                            self.start_child(child)
+                else:
+                    self.child_stopped(message)
+        finally:
+            for child in reversed(self._children):
+                self.kill_child(child)
+
+    def start_child(self, child):
+        spec = child[0]
+        child[1] = spawn_link(
+            spec['start'], *spec.get('args', ()), **spec.get('kw', {}))
+
+    def kill_child(self, child):
+        if child[1] is not None:
+            try:
+                child[1].kill()
+            except DeadActor:
+                pass
+            child[1] = None
+
+    def child_stopped(self, message):
+        for index, (spec, address) in enumerate(self._children):
+            if address == message['address']:
+                break
+        else:
+            return # a child which was killed to be restarted
+        restart = spec.get('restart', PERMANENT)
+        if restart == TEMPORARY or (
+                restart == TRANSIENT and 'exception' not in message):
+            del self._children[index]
+            return
+
+        now = time.time()
+        self._restarts.append(now)
+        while self._restarts[0] < now - self.max_seconds:
+            self._restarts.popleft()
+        if len(self._restarts) > self.max_restarts:
+            raise TooManyRestarts(
+                "%s restarts in %s seconds" % (
+                    len(self._restarts), self.max_seconds))
+
+        if self.strategy == ONE_FOR_ONE:
+            restarting = [self._children[index]]
+        elif self.strategy == ONE_FOR_ALL:
+            restarting = self._children[:]
+        else:
+            restarting = self._children[index:]
+        for child in reversed(restarting):
+            self.kill_child(child)
+
+        delay = min(self.backoff * 2 ** (len(self._restarts) - 1),
+                    self.max_backoff)
+        if len(self._restarts) == 1 or not delay:
+            for child in restarting:
+                self.start_child(child)
+        else:
+            send_after(self.address,
+                       {'supervisor': 'restart',
+                        'ids': [child[0]['id'] for child in restarting]},
+                       delay)
+
+    def handle_call(self, message):
+        if message['method'] == 'which_children':
+            self.respond(message, [[spec['id'], address]
+                                   for spec, address in self._children])
+        else:
+            self.respond_invalid_method(message, message['method'])
+
+
 class Gather(Actor):
     def main(self, spawnable_list):
         address_list = [spawn_link(x) for x in spawnable_list]
@@ -691,14 +1372,156 @@ class Gather(Actor):
                 {'exception': object, 'address': object})
 
             messages[message['address']] = message
-            if address_list[current_index] in messages:
-                results.append(messages[address_list[current_index]])
+            while (current_index < len(address_list) and
+                   address_list[current_index] in messages):
+                results.append(messages.pop(address_list[current_index]))
                 current_index += 1
         return results
 
 
-def wait_all(*spawnable_list):
+## Default number of actors pmap keeps running or waiting to be yielded.
+PMAP_CONCURRENCY = 100
+
+_LINK_PATTERNS = ({'exit': object, 'address': object},
+                  {'exception': object, 'address': object})
+
+
+class _Collector(Actor):
+    """Spawn linked actors for an iterator of (index, spawnable, args)
+    jobs and put (index, link message) on the results queue as each
+    finishes, then None. At most concurrency jobs are spawned and not
+    yet consumed; the reader casts {'gather': 'consumed'} for each
+    result it is done with, and {'gather': 'stop'} to kill the rest.
+    """
+    def main(self, jobs, results, concurrency):
+        running = {}
+        outstanding = 0
+        try:
+            while True:
+                while jobs is not None and (
+                        concurrency is None or outstanding < concurrency):
+                    try:
+                        index, spawnable, args = jobs.next()
+                    except StopIteration:
+                        jobs = None
+                        break
+                    running[spawn_link(spawnable, *args)] = index
+                    outstanding += 1
+                if jobs is None and not running:
+                    return
+                pattern, message = self.receive(
+                    {'gather': str}, *_LINK_PATTERNS)
+                if 'gather' not in pattern:
+                    index = running.pop(message['address'], None)
+                    if index is not None:
+                        results.put((index, message))
+                elif message['gather'] == 'consumed':
+                    outstanding -= 1
+                else:
+                    return
+        finally:
+            for address in running:
+                try:
+                    address.kill()
+                except DeadActor:
+                    pass
+            results.put(None)
+
+
+def _collect(jobs, concurrency=None, timeout=None, ordered=False):
+    """Run jobs with a _Collector and yield (index, link message) as
+    each finishes. Stop after timeout seconds, killing the rest.
+
+    If ordered, jobs are indexed from 0 and are yielded in index order;
+    results which finish early are held back, and count against
+    concurrency, until they are yielded.
+    """
+    results = queue.Queue()
+    collector = spawn(_Collector, iter(jobs), results, concurrency)
+    deadline = timeout is not None and time.time() + timeout
+    pending = {}
+    next_index = 0
+    try:
+        while True:
+            if deadline:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                try:
+                    item = results.get(timeout=remaining)
+                except queue.Empty:
+                    return
+            else:
+                item = results.get()
+            if item is None:
+                return
+            if ordered:
+                pending[item[0]] = item[1]
+                ready = []
+                while next_index in pending:
+                    ready.append((next_index, pending.pop(next_index)))
+                    next_index += 1
+            else:
+                ready = [item]
+            for item in ready:
+                yield item
+                try:
+                    collector.cast({'gather': 'consumed'})
+                except DeadActor:
+                    pass
+    finally:
+        try:
+            collector.cast({'gather': 'stop'})
+        except DeadActor:
+            pass
+
+
+def as_completed(spawnable_list, timeout=None, concurrency=None):
+    """Spawn each spawnable linked and yield its link message, like
+    {'address': address, 'exit': result} or
+    {'address': address, 'exception': dict}, as soon as it finishes.
+
+    If concurrency is given, only that many spawnables are running or
+    waiting to be yielded at once. If timeout is given, stop after that
+    many seconds and kill the spawnables still running.
+    """
+    jobs = ((index, spawnable, ())
+            for index, spawnable in enumerate(spawnable_list))
+    for index, message in _collect(jobs, concurrency, timeout):
+        yield message
+
+
+def pmap(func, iterable, concurrency=PMAP_CONCURRENCY):
+    """Call spawn_link(func, item) for each item of iterable and yield
+    the results in the order of the items. func is a spawnable, so a
+    function is called with the receive method first.
+
+    The iterable is read as results are consumed, and at most
+    concurrency actors are running or have results waiting to be
+    yielded. If an actor has an exception, raise RemoteException.
+    """
+    jobs = ((index, func, (item, )) for index, item in enumerate(iterable))
+    for index, message in _collect(jobs, concurrency, ordered=True):
+        if 'exception' in message:
+            raise RemoteException(message['exception'])
+        yield message['exit']
+
+
+def wait_all(*spawnable_list, **kw):
+    """Spawn each spawnable linked and return the list of their link
+    messages, in order. If timeout is given, return after that many
+    seconds with None for the spawnables which had not finished; they
+    are killed.
+    """
     if len(spawnable_list) == 1 and isinstance(spawnable_list[0], list):
         spawnable_list = spawnable_list[0]
-    return spawn(Gather, spawnable_list).wait()
+    timeout = kw.get('timeout')
+    if timeout is None:
+        return spawn(Gather, spawnable_list).wait()
+    results = [None] * len(spawnable_list)
+    jobs = ((index, spawnable, ())
+            for index, spawnable in enumerate(spawnable_list))
+    for index, message in _collect(jobs, timeout=timeout):
+        results[index] = message
+    return results
 
@@ -19,6 +19,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import time
 import unittest
 import eventlet
 from pyact import actor
@@ -412,6 +413,59 @@ class TestActor(unittest.TestCase):
         self.assertRaises(actor.Killed, actor.spawn(KillTest).wait)
 
 
+    def test_publish_subscribe(self):
+        """Assert that messages an Actor publishes are cast to every
+        subscriber, and not to Actors which have unsubscribed.
+        """
+        class Publisher(actor.Actor):
+            def main(self):
+                pat, msg = self.receive({'publish': object})
+                self.publish(msg['publish'])
+
+        class Subscriber(actor.Actor):
+            def main(self):
+                publisher = actor.spawn(Publisher)
+                other = actor.spawn(Publisher)
+                publisher.subscribe()
+                other.subscribe()
+                other.unsubscribe()
+                other | {'publish': 'nope'}
+                publisher | {'publish': 'news'}
+                pat, msg = self.receive(str, timeout=0.1)
+                return msg
+
+        self.assertEquals(actor.spawn(Subscriber).wait(), 'news')
+
+
+    def test_local_remote_address(self):
+        """Assert that RemoteAddresses for urls served by this process
+        are delivered in process, without connecting to the url.
+        """
+        class Echo(actor.Server):
+            def echo(self, message):
+                return message
+
+        class Client(actor.Actor):
+            def main(self, url):
+                server = actor.RemoteAddress.lookup(url + 'echo-server')
+                remote = actor.RemoteAddress(url.upper() + 'echo-server')
+                return server.echo('hi'), remote.echo('there')
+
+        actor.add_local_url('http://127.0.0.1:9/')
+        try:
+            address = actor.spawn(Echo)
+            address._actor.rename('echo-server')
+            result = actor.spawn(Client, 'http://127.0.0.1:9/').wait()
+            self.assertEquals(result, ('hi', 'there'))
+            self.assertRaises(KeyError, actor.RemoteAddress.lookup,
+                              'http://127.0.0.1:9/no-such-actor')
+            missing = actor.RemoteAddress('http://127.0.0.1:9/no-such-actor')
+            self.assertEquals(missing.cast({'hi': 1}), False)
+            address.kill()
+        finally:
+            actor._local_urls.clear()
+
+
     def test_wait_all(self):
         class WaitAll(actor.Actor):
             def main(self):
@@ -435,6 +489,97 @@ class TestActor(unittest.TestCase):
         self.assertEquals([1,2,3], result2)
 
 
+    def test_wait_all_out_of_order(self):
+        def sleeper(receive, seconds):
+            eventlet.sleep(seconds)
+            return seconds
+        spawnables = [lambda receive, s=s: sleeper(receive, s)
+                      for s in [0.03, 0.01, 0.02]]
+        result = actor.wait_all(spawnables)
+        self.assertEquals([x['exit'] for x in result], [0.03, 0.01, 0.02])
+
+
+    def test_wait_all_timeout(self):
+        def quick(receive):
+            return 1
+        def slow(receive):
+            eventlet.sleep(1)
+        result = actor.wait_all(quick, slow, timeout=0.05)
+        self.assertEquals(result[0]['exit'], 1)
+        self.assertEquals(result[1], None)
+
+
+    def test_as_completed(self):
+        def sleeper(receive, seconds):
+            eventlet.sleep(seconds)
+            return seconds
+        spawnables = [lambda receive, s=s: sleeper(receive, s)
+                      for s in [0.03, 0.01, 0.02]]
+        self.assertEquals(
+            [x['exit'] for x in actor.as_completed(spawnables)],
+            [0.01, 0.02, 0.03])
+
+
+    def test_pmap(self):
+        running = []
+        peak = []
+        def square(receive, item):
+            running.append(item)
+            peak.append(len(running))
+            eventlet.sleep(0.001 * (item % 3))
+            running.remove(item)
+            return item * item
+        result = list(actor.pmap(square, xrange(50), concurrency=4))
+        self.assertEquals(result, [i * i for i in range(50)])
+        self.assertEquals(max(peak) <= 4, True)
+
+    def test_pmap_slow_head(self):
+        started = []
+        def work(receive, item):
+            started.append(item)
+            if item == 0:
+                eventlet.sleep(0.05)
+            return item
+        results = actor.pmap(work, xrange(100), concurrency=10)
+        self.assertEquals(results.next(), 0)
+        # the others wait for the first result to be yielded
+        self.assertEquals(len(started), 10)
+        self.assertEquals(list(results), range(1, 100))
+
+    def test_pmap_exception(self):
+        def fail(receive, item):
+            raise ValueError(item)
+        self.assertRaises(actor.RemoteException, list,
+                          actor.pmap(fail, range(3)))
+
+
+    def test_stats(self):
+        def echo(receive, parent):
+            for i in range(3):
+                pattern, message = receive(int)
+                parent.cast(message)
+            receive('stop')
+        class Parent(actor.Actor):
+            def main(self):
+                child = actor.spawn(echo, self.address)
+                child.cast('skipped')
+                for i in range(3):
+                    child.cast(i)
+                eventlet.sleep(0.01)
+                stats = child._actor.stats()
+                child.kill()
+                return stats
+        spawned = actor.node_stats()['spawned']
+        stats = Parent.spawn().wait()
+        self.assertEquals(stats['messages_in'], 4)
+        self.assertEquals(stats['messages_out'], 3)
+        self.assertEquals(stats['mailbox'], 1)
+        self.assertEquals(stats['mailbox_peak'], 4)
+        self.assertEquals(stats['messages_scanned'], 7)
+        self.assertEquals(stats['blocked_time'] >= 0, True)
+        self.assertEquals(actor.node_stats()['spawned'] - spawned, 2)
+
+
     def test_build_call_pattern(self):
         
         assert actor.build_call_pattern('meth1') == {'address': actor.Address,
@@ -467,6 +612,7 @@ class TestServer(unittest.TestCase):
 
 		cancel = eventlet.Timeout(1, eventlet.TimeoutError)
 		result = SimpleClient.spawn().wait()
+		cancel.cancel()
 
 		self.assertEquals(result, THE_RESULT)
 
@@ -519,6 +665,75 @@ class TestServer(unittest.TestCase):
 		self.assertEqual(mutate_me.get('stop'), True)
 
 
+def crasher(receive):
+    pattern, message = receive('crash')
+    raise RuntimeError("crashed")
+
+
+def crash_at_once(receive):
+    raise RuntimeError("crashed")
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def start(self, ids, **kw):
+        sup = actor.Supervisor.spawn(
+            [{'id': id, 'start': crasher} for id in ids], **kw)
+        eventlet.sleep(0)
+        return sup
+
+    def addresses(self, sup):
+        return [address for spec, address in sup._actor._children]
+
+    def crash(self, sup, index):
+        before = self.addresses(sup)
+        before[index].cast('crash')
+        eventlet.sleep(0.01)
+        after = self.addresses(sup)
+        sup.kill()
+        return [b == a for b, a in zip(before, after)]
+
+    def test_one_for_one(self):
+        sup = self.start('abc')
+        self.assertEquals(self.crash(sup, 1), [True, False, True])
+
+    def test_one_for_all(self):
+        sup = self.start('abc', strategy=actor.ONE_FOR_ALL)
+        self.assertEquals(self.crash(sup, 1), [False, False, False])
+
+    def test_rest_for_one(self):
+        sup = self.start('abc', strategy=actor.REST_FOR_ONE)
+        self.assertEquals(self.crash(sup, 1), [True, False, False])
+
+    def test_temporary(self):
+        sup = actor.Supervisor.spawn(
+            [{'id': 'a', 'start': crasher, 'restart': actor.TEMPORARY}])
+        eventlet.sleep(0)
+        sup._actor._children[0][1].cast('crash')
+        eventlet.sleep(0.01)
+        self.assertEquals(sup._actor._children, [])
+        sup.kill()
+
+    def test_which_children(self):
+        class Client(actor.Actor):
+            def main(self, sup):
+                return sup.call('which_children')
+        sup = self.start('ab')
+        children = Client.spawn(sup).wait()
+        self.assertEquals(children, [['a', self.addresses(sup)[0]],
+                                     ['b', self.addresses(sup)[1]]])
+        sup.kill()
+
+    def test_too_many_restarts(self):
+        started = time.time()
+        sup = actor.Supervisor.spawn(
+            [{'id': 'a', 'start': crash_at_once}],
+            max_restarts=3, backoff=0.02)
+        self.assertRaises(actor.TooManyRestarts, sup.wait)
+        # restarts two and three waited 0.02 and 0.04 seconds
+        self.assertEquals(time.time() - started >= 0.06, True)
+
+
 if __name__ == '__main__':
     unittest.main()
 
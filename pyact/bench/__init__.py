@@ -0,0 +1,6 @@
+"""
+Benchmarks for python actors. Each benchmark module has a
+run function which returns a dict of results, and prints
+them as json when run as a script. python -m pyact.bench
+runs them all and prints a json list of their results.
+"""
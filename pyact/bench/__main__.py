@@ -0,0 +1,34 @@
+"""
+Run benchmarks and print their results as a json list.
+
+  python -m pyact.bench [name ...]
+
+Without names, every benchmark in BENCHMARKS is run with its
+default parameters.
+"""
+
+import sys
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+BENCHMARKS = ['ring', 'pingpong', 'fanout', 'server_call',
+              'selective_receive', 'spawn_rate', 'binary', 'remote_call',
+              'actnet_echo', 'actnet_throughput', 'pmd_restart']
+
+
+def main(names):
+    results = []
+    for name in names or BENCHMARKS:
+        if name not in BENCHMARKS:
+            raise SystemExit("Unknown benchmark: %s" % (name, ))
+        module = __import__('pyact.bench.' + name, fromlist=['run'])
+        results.append(module.run())
+    return results
+
+
+if __name__ == '__main__':
+    print json.dumps(main(sys.argv[1:]), indent=1)
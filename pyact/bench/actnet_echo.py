@@ -0,0 +1,63 @@
+"""
+Measure actnet TCP echo throughput: an actor sends framed messages
+through an actnet echo server, using the queued writer, and waits
+for each to come back.
+"""
+
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from pyact import actor, actnet
+
+
+def _echo(receive, sock):
+    while True:
+        pattern, message = receive({'actnet': object})
+        if message['actnet'] in (actnet.TCP_CLOSE, actnet.TCP_ERROR):
+            return
+        if message['actnet'] == actnet.TCP:
+            sock.cast_send(actnet.struct.pack('!I', len(message['data'])) +
+                           message['data'])
+
+
+def _client(receive, count, size):
+    server = actnet.listen(('127.0.0.1', 0), active=True, packet=4,
+                           accept_active=True, handler=_echo)
+    sock = actnet.connect(server.getsockname(), active=True, packet=4)
+    frame = actnet.struct.pack('!I', size) + 'x' * size
+    started = time.time()
+    for i in xrange(count):
+        sock.cast_send(frame)
+    for i in xrange(count):
+        receive({'actnet': 'tcp'})
+    seconds = time.time() - started
+    sock.setactive(False)
+    sock.close()
+    server.setactive(False)
+    server.close()
+    return seconds
+
+
+def run(count=20000, size=512):
+    seconds = actor.spawn(_client, count, size).wait()
+    return {'benchmark': 'actnet_echo',
+            'messages': count,
+            'size': size,
+            'seconds': seconds,
+            'messages_per_second': count / seconds,
+            'mb_per_second': count * size / seconds / 1e6}
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    p = OptionParser()
+    p.add_option('-n','--count',default=20000,type=int,
+                 help="Number of messages.")
+    p.add_option('-s','--size',default=512,type=int,
+                 help="Message size in bytes.")
+    opts,_ = p.parse_args()
+    print json.dumps(run(opts.count, opts.size))
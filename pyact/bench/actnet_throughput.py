@@ -0,0 +1,81 @@
+"""
+Measure how fast an active actnet TCP socket delivers a large
+stream from an echo server to an actor, with a fixed recv size,
+with adaptive recv sizing, and with pooled receive buffers.
+"""
+
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import eventlet
+from pyact import actor, actnet
+
+
+def _echo_server():
+    server = eventlet.listen(('127.0.0.1', 0))
+    def serve():
+        client, _ = server.accept()
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            client.sendall(data)
+        client.close()
+        server.close()
+    eventlet.spawn_n(serve)
+    return server.getsockname()[1]
+
+
+class Stream(actor.Actor):
+    def main(self, port, size, recvmax, limit, buffers):
+        s = actnet.connect(('127.0.0.1', port), buffers=buffers)
+        s.setrecvmax(recvmax, limit)
+        s.setactive(True)
+        def send():
+            chunk = 'x' * 65536
+            for i in xrange(size // len(chunk)):
+                s.sendall(chunk)
+        eventlet.spawn_n(send)
+        received = messages = 0
+        started = time.time()
+        while received < size:
+            pat, msg = self.receive({'actnet': 'tcp'}, timeout=5)
+            if pat is None:
+                break
+            received += len(msg['data'])
+            messages += 1
+            if buffers:
+                msg['data'].release()
+        seconds = time.time() - started
+        s.setactive(False)
+        s.close()
+        return {'bytes': received,
+                'messages': messages,
+                'seconds': seconds,
+                'mb_per_second': received / seconds / 1e6}
+
+
+def run(size=64 * 1024 * 1024):
+    results = {}
+    for name, recvmax, limit, buffers in [
+            ('fixed', 4096, None, False),
+            ('adaptive', 4096, actnet.RECV_LIMIT, False),
+            ('pooled', 4096, actnet.RECV_LIMIT, True)]:
+        results[name] = Stream.spawn(
+            _echo_server(), size, recvmax, limit, buffers).wait()
+    return {'benchmark': 'actnet_throughput',
+            'size': size,
+            'results': results}
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    p = OptionParser()
+    p.add_option('-s','--size',default=64*1024*1024,type=int,
+                 help="Number of bytes to stream.")
+    opts,_ = p.parse_args()
+    print json.dumps(run(opts.size))
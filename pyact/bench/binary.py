@@ -0,0 +1,53 @@
+"""
+Measure the throughput of messages carrying Binary payloads, which
+are base64 encoded when messages are copied.
+"""
+
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from pyact import actor
+
+
+class Sink(actor.Actor):
+    def main(self, count):
+        received = 0
+        for i in xrange(count):
+            pattern, message = self.receive({'data': object})
+            received += len(message['data'].value)
+        return received
+
+
+def _sender(receive, count, size):
+    payload = actor.Binary('x' * size)
+    sink = Sink.spawn(count)
+    started = time.time()
+    for i in xrange(count):
+        sink.cast({'data': payload})
+    received = sink.wait()
+    return received, time.time() - started
+
+
+def run(count=2000, size=65536):
+    received, seconds = actor.spawn(_sender, count, size).wait()
+    return {'benchmark': 'binary',
+            'messages': count,
+            'size': size,
+            'bytes': received,
+            'seconds': seconds,
+            'mb_per_second': received / seconds / 1e6}
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    p = OptionParser()
+    p.add_option('-n','--count',default=2000,type=int,
+                 help="Number of messages.")
+    p.add_option('-s','--size',default=65536,type=int,
+                 help="Payload size in bytes.")
+    opts,_ = p.parse_args()
+    print json.dumps(run(opts.count, opts.size))
@@ -0,0 +1,53 @@
+"""
+Fan work out to many short lived actors and gather their results
+with wait_all, as_completed and pmap.
+"""
+
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from pyact import actor
+
+
+def _work(receive, item):
+    return item * item
+
+
+def run(actors=5000, concurrency=100):
+    results = {'benchmark': 'fanout',
+               'actors': actors,
+               'concurrency': concurrency}
+
+    spawnables = [lambda receive, i=i: _work(receive, i)
+                  for i in xrange(actors)]
+    started = time.time()
+    actor.wait_all(spawnables)
+    results['wait_all_seconds'] = time.time() - started
+
+    started = time.time()
+    for message in actor.as_completed(spawnables):
+        pass
+    results['as_completed_seconds'] = time.time() - started
+
+    started = time.time()
+    for result in actor.pmap(_work, xrange(actors), concurrency):
+        pass
+    results['pmap_seconds'] = time.time() - started
+
+    results['actors_per_second'] = actors / results['wait_all_seconds']
+    return results
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    p = OptionParser()
+    p.add_option('-a','--actors',default=5000,type=int,
+                 help="Number of actors to fan out to.")
+    p.add_option('-c','--concurrency',default=100,type=int,
+                 help="Concurrency of pmap.")
+    opts,_ = p.parse_args()
+    print json.dumps(run(opts.actors, opts.concurrency))
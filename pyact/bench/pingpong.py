@@ -0,0 +1,48 @@
+"""
+Measure the round trip latency of a message between two actors.
+"""
+
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from pyact import actor
+
+
+class Ponger(actor.Actor):
+    def main(self):
+        while True:
+            pattern, message = self.receive({'ping': int, 'from': object})
+            message['from'].cast({'pong': message['ping']})
+
+
+def _pingpong(receive, rounds):
+    ponger = Ponger.spawn()
+    me = actor.eventlet.getcurrent().address
+    started = time.time()
+    for i in xrange(rounds):
+        ponger.cast({'ping': i, 'from': me})
+        receive({'pong': i})
+    seconds = time.time() - started
+    ponger.kill()
+    return seconds
+
+
+def run(rounds=20000):
+    seconds = actor.spawn(_pingpong, rounds).wait()
+    return {'benchmark': 'pingpong',
+            'rounds': rounds,
+            'seconds': seconds,
+            'round_trip_us': seconds / rounds * 1e6}
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    p = OptionParser()
+    p.add_option('-r','--rounds',default=20000,type=int,
+                 help="Number of round trips.")
+    opts,_ = p.parse_args()
+    print json.dumps(run(opts.rounds))
@@ -0,0 +1,89 @@
+"""
+Measure how long a pyactpmd with a large registry file takes
+to come back after a restart: the time to reload the registry
+in process, and the time from launching a new pyactpmd process
+until it answers a lookup.
+"""
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from pyact import pyactpmd
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _write_registry(path, names):
+    registrations = {}
+    log = pyactpmd._RegistryLog(path, registrations)
+    for i in xrange(names):
+        registrations['node%s' % i] = 10000 + i % 50000
+    log.compact()
+    # leave some records in the log to replay as well
+    for i in xrange(min(names, pyactpmd.COMPACT_MIN)):
+        log.register('node%s' % i, 20000 + i % 40000)
+    log.close()
+
+
+def _time_until_serving(path, port):
+    started = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, pyactpmd.__file__.replace('.pyc', '.py'),
+         '-n', '-p', str(port), '-r', path, '-v', 'error'])
+    try:
+        while True:
+            try:
+                s = socket.create_connection(('127.0.0.1', port))
+            except socket.error:
+                time.sleep(0.005)
+                continue
+            s.sendall('lookup node0\n')
+            reply = s.makefile('r').readline()
+            s.close()
+            if reply.strip():
+                return time.time() - started
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def run(names=1000000):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'registry')
+        _write_registry(path, names)
+        started = time.time()
+        pyactpmd._RegistryLog(path, {}).close()
+        reload_seconds = time.time() - started
+        serving_seconds = _time_until_serving(path, _free_port())
+    finally:
+        shutil.rmtree(tmpdir)
+    return {'benchmark': 'pmd_restart',
+            'names': names,
+            'reload_seconds': reload_seconds,
+            'restart_to_serving_seconds': serving_seconds}
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    p = OptionParser()
+    p.add_option('-n','--names',default=1000000,type=int,
+                 help="Number of registered names.")
+    opts,_ = p.parse_args()
+    print json.dumps(run(opts.names))
@@ -0,0 +1,60 @@
+"""
+Measure RemoteAddress.call through an ActorApplication served on
+a local port, over HTTP.
+"""
+
+import time
+from StringIO import StringIO
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import eventlet
+from eventlet import wsgi
+from pyact import actor, wsgiapp
+
+
+class Echo(actor.Server):
+    def echo(self, message):
+        return message
+
+
+def _client(receive, url, calls):
+    remote = actor.RemoteAddress.lookup(url)
+    for i in xrange(calls):
+        remote.call('echo', i)
+
+
+def run(calls=2000, clients=4):
+    sock = eventlet.listen(('127.0.0.1', 0))
+    server = eventlet.spawn(wsgi.server, sock, wsgiapp.app, log=StringIO())
+    echo = Echo.spawn()
+    eventlet.sleep(0)
+    echo._actor.rename('bench_echo')
+    url = 'http://127.0.0.1:%s/bench_echo' % (sock.getsockname()[1], )
+    per_client = calls // clients
+    started = time.time()
+    actor.wait_all([lambda receive: _client(receive, url, per_client)
+                    for i in xrange(clients)])
+    seconds = time.time() - started
+    echo.kill()
+    server.kill()
+    sock.close()
+    return {'benchmark': 'remote_call',
+            'calls': per_client * clients,
+            'clients': clients,
+            'seconds': seconds,
+            'calls_per_second': per_client * clients / seconds}
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    p = OptionParser()
+    p.add_option('-n','--calls',default=2000,type=int,
+                 help="Total number of calls.")
+    p.add_option('-c','--clients',default=4,type=int,
+                 help="Number of concurrent clients.")
+    opts,_ = p.parse_args()
+    print json.dumps(run(opts.calls, opts.clients))
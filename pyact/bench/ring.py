@@ -0,0 +1,62 @@
+"""
+Pass a message around a ring of actors: each hop is a cast to
+the next actor and a receive there.
+"""
+
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from pyact import actor
+
+
+class RingNode(actor.Actor):
+    def main(self):
+        pattern, setup = self.receive({'next': object, 'done': object})
+        next_node, done = setup['next'], setup['done']
+        while True:
+            pattern, message = self.receive({'hops': int})
+            if message['hops'] == 0:
+                done.cast({'finished': True})
+            else:
+                next_node.cast({'hops': message['hops'] - 1})
+
+
+def _ring(receive, actors, rounds):
+    started = time.time()
+    nodes = [RingNode.spawn() for i in xrange(actors)]
+    me = actor.eventlet.getcurrent().address
+    for i, node in enumerate(nodes):
+        node.cast({'next': nodes[(i + 1) % actors], 'done': me})
+    spawned = time.time()
+    nodes[0].cast({'hops': actors * rounds})
+    receive({'finished': True})
+    finished = time.time()
+    for node in nodes:
+        node.kill()
+    return spawned - started, finished - spawned
+
+
+def run(actors=1000, rounds=10):
+    spawn_seconds, seconds = actor.spawn(_ring, actors, rounds).wait()
+    hops = actors * rounds
+    return {'benchmark': 'ring',
+            'actors': actors,
+            'rounds': rounds,
+            'spawn_seconds': spawn_seconds,
+            'seconds': seconds,
+            'hops_per_second': hops / seconds}
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    p = OptionParser()
+    p.add_option('-a','--actors',default=1000,type=int,
+                 help="Number of actors in the ring.")
+    p.add_option('-r','--rounds',default=10,type=int,
+                 help="Number of times around the ring.")
+    opts,_ = p.parse_args()
+    print json.dumps(run(opts.actors, opts.rounds))
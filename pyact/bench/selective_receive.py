@@ -0,0 +1,46 @@
+"""
+Measure selective receive with a deep mailbox: each wanted message
+arrives behind a number of messages which do not match.
+"""
+
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from pyact import actor
+
+
+class Selector(actor.Actor):
+    def main(self, depth, receives):
+        for i in xrange(depth):
+            self.address.cast({'filler': i})
+        started = time.time()
+        for i in xrange(receives):
+            self.address.cast({'wanted': i})
+            self.receive({'wanted': int})
+        return time.time() - started, self.stats()['messages_scanned']
+
+
+def run(depth=1000, receives=1000):
+    seconds, scanned = Selector.spawn(depth, receives).wait()
+    return {'benchmark': 'selective_receive',
+            'depth': depth,
+            'receives': receives,
+            'seconds': seconds,
+            'messages_scanned': scanned,
+            'receives_per_second': receives / seconds,
+            'scanned_per_second': scanned / seconds}
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    p = OptionParser()
+    p.add_option('-d','--depth',default=1000,type=int,
+                 help="Number of unmatched messages in the mailbox.")
+    p.add_option('-r','--receives',default=1000,type=int,
+                 help="Number of selective receives.")
+    opts,_ = p.parse_args()
+    print json.dumps(run(opts.depth, opts.receives))
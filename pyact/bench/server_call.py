@@ -0,0 +1,49 @@
+"""
+Measure Server call throughput with a number of concurrent
+clients.
+"""
+
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from pyact import actor
+
+
+class Echo(actor.Server):
+    def echo(self, message):
+        return message
+
+
+def _client(receive, server, calls):
+    for i in xrange(calls):
+        server.call('echo', i)
+
+
+def run(calls=20000, clients=10):
+    server = Echo.spawn()
+    per_client = calls // clients
+    started = time.time()
+    actor.wait_all([lambda receive: _client(receive, server, per_client)
+                    for i in xrange(clients)])
+    seconds = time.time() - started
+    server.kill()
+    return {'benchmark': 'server_call',
+            'calls': per_client * clients,
+            'clients': clients,
+            'seconds': seconds,
+            'calls_per_second': per_client * clients / seconds}
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    p = OptionParser()
+    p.add_option('-n','--calls',default=20000,type=int,
+                 help="Total number of calls.")
+    p.add_option('-c','--clients',default=10,type=int,
+                 help="Number of concurrent clients.")
+    opts,_ = p.parse_args()
+    print json.dumps(run(opts.calls, opts.clients))
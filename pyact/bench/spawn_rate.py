@@ -0,0 +1,45 @@
+"""
+Measure how fast actors are spawned, run and reaped.
+"""
+
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from pyact import actor
+
+
+def _child(receive):
+    pass
+
+
+def _spawner(receive, actors):
+    started = time.time()
+    for i in xrange(actors):
+        actor.spawn_link(_child)
+    spawned = time.time()
+    for i in xrange(actors):
+        receive({'exit': object, 'address': object})
+    return spawned - started, time.time() - started
+
+
+def run(actors=20000):
+    spawn_seconds, seconds = actor.spawn(_spawner, actors).wait()
+    return {'benchmark': 'spawn_rate',
+            'actors': actors,
+            'spawn_seconds': spawn_seconds,
+            'seconds': seconds,
+            'spawns_per_second': actors / spawn_seconds,
+            'lifecycles_per_second': actors / seconds}
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    p = OptionParser()
+    p.add_option('-a','--actors',default=20000,type=int,
+                 help="Number of actors to spawn.")
+    opts,_ = p.parse_args()
+    print json.dumps(run(opts.actors))
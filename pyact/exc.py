@@ -24,76 +24,176 @@ THE SOFTWARE.
 """
 
 
+import collections
 import linecache
 import re
 import sys
+import time
 import traceback
 
+import eventlet
 
-def format_exc(exc=None):
+
+## Detail levels of the reports made by format_exc: the description
+## only, the description and stack with the code around each line, or
+## also the variables that code uses.
+DETAIL_LEVELS = [DESCRIPTION, STACK, VARS] = ['description', 'stack', 'vars']
+
+## Detail level used when format_exc is not given one.
+DETAIL = STACK
+
+## Longest repr kept for a variable in a report; longer ones are cut.
+MAX_VAR_REPR = 256
+
+## Default average and burst numbers of exceptions logged per second
+## by RateLimitedLog.
+LOG_RATE = 10
+LOG_BURST = 20
+
+
+def format_exc(exc=None, detail=None):
+    """
+    Return a dictionary describing exc, an exc_info tuple, or the
+    exception being handled. detail is one of DETAIL_LEVELS and
+    defaults to DETAIL.
+    """
+    if detail is None:
+        detail = DETAIL
     if exc is None:
         exc_type, exc_value, exc_tb = sys.exc_info()
     else:
         exc_type, exc_value, exc_tb = exc
 
-    frames = []
-    while exc_tb is not None:
-        f = exc_tb.tb_frame
-        
-        frames.append((
-            f.f_code.co_name,
-            f.f_code.co_filename,
-            exc_tb.tb_lineno,
-            [(key, value) for (key, value)
-             in f.f_locals.items() if key != '__builtins__'],
-            [(key, value) for (key, value)
-             in f.f_globals.items() if key != '__builtins__']))
-        exc_tb = exc_tb.tb_next
-
     stack_trace = []
 
     result = {
         'error': True,
         'stack-trace': stack_trace,
         'description': str(exc_type) + ": " + str(exc_value),
-        'text-exception': ''.join(
-            traceback.format_exception(
-                exc_type, exc_value, exc_tb))
-
         }
 
-    for method, filename, lineno, local_vars, global_vars in frames:
+    if detail == DESCRIPTION:
+        result['text-exception'] = ''.join(
+            traceback.format_exception_only(exc_type, exc_value))
+        return result
+
+    result['text-exception'] = ''.join(
+        traceback.format_exception(exc_type, exc_value, exc_tb))
+
+    while exc_tb is not None:
+        f = exc_tb.tb_frame
+        lineno = exc_tb.tb_lineno
+        exc_tb = exc_tb.tb_next
+
         code = []
-        vars_dict = {}
-        stack_trace.append(
-            {'filename': filename,
-             'lineno': lineno,
-             'method': method,
-             'code': code,
-             #'vars': vars_dict})
-             })
+        frame = {'filename': f.f_code.co_filename,
+                 'lineno': lineno,
+                 'method': f.f_code.co_name,
+                 'code': code}
+        stack_trace.append(frame)
 
         code_text = ''
         for line_number in range(lineno-2, lineno+2):
-            line = linecache.getline(filename, line_number)
+            line = linecache.getline(f.f_code.co_filename, line_number)
             code.append({'lineno': line_number, 'line': line})
             code_text += line
 
-        # "self"
-        for name, var in local_vars:
-            if name == 'self' and hasattr(var, '__dict__'):
-                vars_dict['self'] = dict([
-                    (key, value) for (key, value) in var.__dict__.items()
-                    if re.search(
-                        r'\Wself.%s\W' % (re.escape(key),), code_text)])
-                break
-
-        # Local and global vars
-        vars_dict['locals'] = dict(
-            [(name, var) for (name, var) in local_vars
-             if re.search(r'\W%s\W' % (re.escape(name),), code_text)])
-        vars_dict['globals'] = dict(
-            [(name, var) for (name, var) in global_vars
-             if re.search(r'\W%s\W' % (re.escape(name),), code_text)])
+        if detail == VARS:
+            frame['vars'] = _frame_vars(f, code_text)
 
     return result
+
+
+def _frame_vars(f, code_text):
+    """
+    Return the reprs of the variables of frame f which are
+    used in code_text.
+    """
+    names = set(re.findall(r'\w+', code_text))
+    vars_dict = {}
+
+    # "self"
+    var = f.f_locals.get('self')
+    if var is not None and hasattr(var, '__dict__'):
+        attributes = set(re.findall(r'\Wself\.(\w+)', code_text))
+        vars_dict['self'] = dict([
+            (key, _short_repr(value)) for (key, value) in var.__dict__.items()
+            if key in attributes])
+
+    # Local and global vars
+    vars_dict['locals'] = dict(
+        [(name, _short_repr(var)) for (name, var) in f.f_locals.items()
+         if name in names and name != '__builtins__'])
+    vars_dict['globals'] = dict(
+        [(name, _short_repr(var)) for (name, var) in f.f_globals.items()
+         if name in names and name != '__builtins__'])
+    return vars_dict
+
+
+def _short_repr(value):
+    try:
+        text = repr(value)
+    except Exception, e:
+        text = '<unrepresentable %s: %s>' % (type(value).__name__, e)
+    if len(text) > MAX_VAR_REPR:
+        text = text[:MAX_VAR_REPR] + '...'
+    return text
+
+
+class RateLimitedLog(object):
+    """
+    Log exceptions to a logging.Logger from a greenlet of its own,
+    so the failing greenlet does not wait on the log. At most rate
+    exceptions per second are logged, in bursts of up to burst; the
+    others are counted, and the count is logged with the next one.
+    While logging is not configured to handle the logger's records,
+    the tracebacks are printed to stderr instead.
+    """
+    def __init__(self, logger, rate=LOG_RATE, burst=LOG_BURST):
+        self.logger = logger
+        self.rate = rate
+        self.burst = burst
+        self.dropped = 0
+        self._tokens = burst
+        self._stamp = time.time()
+        self._pending = collections.deque()
+        self._writer = None
+
+    def exception(self, message, exc_info=None):
+        now = time.time()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        if self._tokens < 1:
+            self.dropped += 1
+            return
+        self._tokens -= 1
+        self._pending.append((message, exc_info or sys.exc_info()))
+        if self._writer is None:
+            self._writer = eventlet.spawn(self._write)
+
+    def _write(self):
+        try:
+            while self._pending:
+                message, exc_info = self._pending.popleft()
+                if self.dropped:
+                    message = '%s (%s more exceptions not logged)' % (
+                        message, self.dropped)
+                    self.dropped = 0
+                if _has_handlers(self.logger):
+                    self.logger.error(message, exc_info=exc_info)
+                else:
+                    sys.stderr.write(message + '\n')
+                    traceback.print_exception(*exc_info)
+        finally:
+            self._writer = None
+
+
+def _has_handlers(logger):
+    while logger is not None:
+        if logger.handlers:
+            return True
+        if not logger.propagate:
+            return False
+        logger = logger.parent
+    return False
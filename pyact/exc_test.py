@@ -0,0 +1,88 @@
+
+import logging
+import sys
+import unittest
+from StringIO import StringIO
+import eventlet
+from pyact import actor, exc
+
+
+def fail(big):
+    items = range(1000)
+    raise ValueError("bad " + str(len(items)))
+
+
+def exc_info():
+    try:
+        fail('x' * 1000)
+    except ValueError:
+        return exc.sys.exc_info()
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestFormatExc(unittest.TestCase):
+
+    def test_description(self):
+        result = exc.format_exc(exc_info(), exc.DESCRIPTION)
+        self.assertEquals(result['stack-trace'], [])
+        self.assertEquals(result['text-exception'], 'ValueError: bad 1000\n')
+
+    def test_stack(self):
+        result = exc.format_exc(exc_info(), exc.STACK)
+        self.assertEquals(
+            [frame['method'] for frame in result['stack-trace']],
+            ['exc_info', 'fail'])
+        self.assertEquals('vars' in result['stack-trace'][-1], False)
+        self.assertEquals('in fail' in result['text-exception'], True)
+
+    def test_vars(self):
+        result = exc.format_exc(exc_info(), exc.VARS)
+        frame_vars = result['stack-trace'][-1]['vars']
+        self.assertEquals(sorted(frame_vars['locals']), ['big', 'items'])
+        for value in frame_vars['locals'].values():
+            self.assertEquals(len(value), exc.MAX_VAR_REPR + 3)
+        actor.json.dumps(result)
+
+
+class TestRateLimitedLog(unittest.TestCase):
+
+    def test_rate_limit(self):
+        logger = logging.getLogger('pyact.exc_test')
+        logger.propagate = False
+        handler = ListHandler()
+        logger.addHandler(handler)
+        log = exc.RateLimitedLog(logger, rate=0, burst=2)
+        for i in range(5):
+            log.exception('failed %s' % i, exc_info())
+        self.assertEquals(handler.records, [])
+        eventlet.sleep(0)
+        self.assertEquals(
+            [record.getMessage() for record in handler.records],
+            ['failed 0 (3 more exceptions not logged)', 'failed 1'])
+        self.assertEquals(log.dropped, 0)
+
+    def test_stderr_fallback(self):
+        logger = logging.getLogger('pyact.exc_test.unconfigured')
+        logger.propagate = False
+        log = exc.RateLimitedLog(logger)
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            log.exception('failed', exc_info())
+            eventlet.sleep(0)
+            output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEquals(output.startswith('failed\nTraceback'), True)
+        self.assertEquals('ValueError' in output, True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+"""
+Per-actor profiling.
+
+All Actors share one OS thread, so cProfile and time.clock mix them
+together. A Profiler follows greenlet switches (greenlet.settrace)
+and charges the wall and CPU time between two switches to the Actor
+which was running, keyed by its class name or, with by=ACTOR, its
+actor id. With functions=True it also keeps one cProfile.Profile per
+key, enabled only while one of that key's Actors runs, which can be
+read with pstats or dumped to files.
+
+Time spent in the hub or other greenlets which are not Actors is not
+charged to anyone.
+
+To switch profiling on and off at runtime, spawn a ProfilerServer,
+optionally rename it so it can be called through the wsgi gateway,
+and call its enable, disable, report, dump and profile methods.
+"""
+
+import cProfile
+import os
+import pstats
+import time
+
+import eventlet
+import greenlet
+
+from pyact import actor
+
+
+## What Profiler results are keyed by.
+KEYS = [CLASS, ACTOR] = ['class', 'actor']
+
+
+class Profiler(object):
+    def __init__(self, by=CLASS, functions=False):
+        if by not in KEYS:
+            raise ValueError("Invalid by value: " + str(by))
+        self.by = by
+        self.functions = functions
+        self.times = {} # key : [wall, cpu, runs]
+        self.profiles = {} # key : cProfile.Profile
+        self.running = False
+        self._previous = None
+        self._active = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._mark = time.time()
+        self._cpu = time.clock()
+        self._previous = greenlet.settrace(self._trace)
+        self._enter(eventlet.getcurrent())
+
+    def stop(self):
+        if not self.running:
+            return
+        self._leave(eventlet.getcurrent(), time.time(), time.clock())
+        greenlet.settrace(self._previous)
+        self._previous = None
+        self.running = False
+
+    def reset(self):
+        self.times.clear()
+        self.profiles.clear()
+
+    def _key(self, g):
+        if not isinstance(g, actor.Actor):
+            return None
+        if self.by == ACTOR:
+            return g.actor_id
+        return type(g).__name__
+
+    def _trace(self, event, args):
+        if event in ('switch', 'throw'):
+            origin, target = args
+            now = time.time()
+            cpu = time.clock()
+            self._leave(origin, now, cpu)
+            self._mark = now
+            self._cpu = cpu
+            self._enter(target)
+        if self._previous is not None:
+            self._previous(event, args)
+
+    def _leave(self, g, now, cpu):
+        if self._active is not None:
+            self._active.disable()
+            self._active = None
+        key = self._key(g)
+        if key is None:
+            return
+        entry = self.times.get(key)
+        if entry is None:
+            entry = self.times[key] = [0.0, 0.0, 0]
+        entry[0] += now - self._mark
+        entry[1] += cpu - self._cpu
+        entry[2] += 1
+
+    def _enter(self, g):
+        if not self.functions:
+            return
+        key = self._key(g)
+        if key is None:
+            return
+        profile = self.profiles.get(key)
+        if profile is None:
+            profile = self.profiles[key] = cProfile.Profile()
+        self._active = profile
+        profile.enable()
+
+    def report(self):
+        """
+        Return {key: {'wall': seconds, 'cpu': seconds, 'runs': count}},
+        runs being the number of times Actors of that key were
+        switched out.
+        """
+        return dict(
+            (key, {'wall': wall, 'cpu': cpu, 'runs': runs})
+            for key, (wall, cpu, runs) in self.times.items())
+
+    def format_report(self):
+        lines = ['%12s %12s %8s  %s' % ('cpu', 'wall', 'runs', self.by)]
+        for key, (wall, cpu, runs) in sorted(
+                self.times.items(), key=lambda item: -item[1][1]):
+            lines.append('%12.6f %12.6f %8d  %s' % (cpu, wall, runs, key))
+        return '\n'.join(lines) + '\n'
+
+    def stats(self, key):
+        """
+        Return a pstats.Stats of the functions run by Actors of key.
+        """
+        profile = self.profiles[key]
+        profile.create_stats()
+        return pstats.Stats(profile)
+
+    def dump(self, directory):
+        """
+        Write a pstats file for each key into directory, named
+        <key>.pstats, and return their paths.
+        """
+        paths = []
+        for key, profile in self.profiles.items():
+            path = os.path.join(directory, key.replace('/', '_') + '.pstats')
+            profile.dump_stats(path)
+            paths.append(path)
+        return paths
+
+
+class ProfilerServer(actor.Server):
+    """
+    Control a Profiler by calls:
+
+      enable {'by': 'class'|'actor', 'functions': bool}  start profiling
+      disable                                           stop profiling
+      report                                            Profiler.report
+      dump <directory>                                  Profiler.dump
+      profile {'seconds': n, ...enable options}         profile for n
+                                                        seconds, then
+                                                        return the report
+    """
+    def start(self):
+        self._profiler = None
+
+    def stop(self):
+        if self._profiler is not None:
+            self._profiler.stop()
+
+    def enable(self, message):
+        message = message or {}
+        if self._profiler is not None:
+            self._profiler.stop()
+        self._profiler = Profiler(message.get('by', CLASS),
+                                 message.get('functions', False))
+        self._profiler.start()
+
+    def disable(self, message):
+        if self._profiler is not None:
+            self._profiler.stop()
+
+    def report(self, message):
+        if self._profiler is None:
+            return {}
+        return self._profiler.report()
+
+    def dump(self, message):
+        if self._profiler is None:
+            return []
+        return self._profiler.dump(message)
+
+    def profile(self, message):
+        message = message or {}
+        self.enable(message)
+        self.sleep(message.get('seconds', 1))
+        self.disable(message)
+        return self.report(message)
@@ -0,0 +1,86 @@
+
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+import eventlet
+from pyact import actor, profiler
+from pyact.wsgiapp_test import request
+
+
+def spin(n):
+    total = 0
+    for i in xrange(n):
+        total += i
+    return total
+
+
+class Spinner(actor.Actor):
+    def main(self, rounds):
+        for i in range(rounds):
+            spin(20000)
+            self.cooperate()
+
+
+class Idler(actor.Actor):
+    def main(self, rounds):
+        for i in range(rounds):
+            self.cooperate()
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_report(self):
+        p = profiler.Profiler(functions=True)
+        p.start()
+        actor.wait_all([lambda receive: Spinner.spawn(10).wait(),
+                        lambda receive: Idler.spawn(10).wait()])
+        p.stop()
+        report = p.report()
+        self.assertEquals(report['Spinner']['runs'] >= 10, True)
+        self.assertEquals(
+            report['Spinner']['cpu'] > report['Idler']['cpu'], True)
+        names = [func[2] for func in p.stats('Spinner').stats]
+        self.assertEquals('spin' in names, True)
+        self.assertEquals('spin' in
+                          [func[2] for func in p.stats('Idler').stats], False)
+        self.assertEquals(p.format_report().splitlines()[1].endswith('Spinner'),
+                          True)
+
+    def test_by_actor(self):
+        p = profiler.Profiler(by=profiler.ACTOR)
+        p.start()
+        address = Idler.spawn(3)
+        actor_id = address.actor_id
+        address.wait()
+        p.stop()
+        self.assertEquals(actor_id in p.report(), True)
+
+    def test_dump(self):
+        p = profiler.Profiler(functions=True)
+        p.start()
+        Spinner.spawn(2).wait()
+        p.stop()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            paths = p.dump(tmpdir)
+            self.assertEquals(paths, [os.path.join(tmpdir, 'Spinner.pstats')])
+            pstats.Stats(paths[0])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_server(self):
+        control = profiler.ProfilerServer.spawn()
+        def client(receive):
+            spinner = Spinner.spawn(20)
+            return control.call('profile', {'seconds': 0.05})
+        report = actor.spawn(client).wait()
+        self.assertEquals('Spinner' in report, True)
+        status, headers, body = request('GET', control.actor_id)
+        self.assertEquals(status, '200 OK')
+        control.kill()
+
+
+if __name__ == '__main__':
+    unittest.main()
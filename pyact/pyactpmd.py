@@ -5,8 +5,10 @@ Erlang's port mapper (EPMD).
 
 
 import eventlet
+from eventlet import event
+from eventlet import semaphore
 from eventlet.green import socket, subprocess
-import sys, os
+import collections, errno, logging, logging.handlers, marshal, struct, sys, os, time, weakref
 
 
 PORT = 5473
@@ -23,16 +25,17 @@ def connect_remote(host,port=PORT):
         return consock
     raise IOError("Could not connect to remote pyactpmd @ %s:%s"%(host,port))
 
-def connect_local_andor_launch(port=PORT,logfile=None):
+def connect_local_andor_launch(port=PORT,logfile=None,registry=None):
     """
     Connect to port mapper on the local machine. If the port
     mapper is not running, then start it, and then try connecting
-    again.
+    again. If a registry file is given, the port mapper keeps
+    its registrations there and reloads them when restarted.
     """
     consock = _connect('localhost', port)
     if consock:
         return consock
-    _launch(port,logfile) # this spawns a subprocess that executes _this_ module
+    _launch(port,logfile,registry) # this spawns a subprocess that executes _this_ module
     eventlet.sleep(0.2)
     consock = _connect('localhost', port, tries=120, retrywait=0.2)
     if consock:
@@ -40,12 +43,223 @@ def connect_local_andor_launch(port=PORT,logfile=None):
     raise IOError("Could not launch and connect to pyactpmd on port %s"%port)
 
 
+def register(consock, name, port):
+    """
+    Register name for port with the port mapper
+    connected to consock.
+    """
+    consock.sendall('register %s %s\n' % (name, port))
+    _check_ok(_readline(consock))
+
+def register_many(consock, registrations):
+    """
+    Register a dict of name : port with the port mapper
+    connected to consock, in one round trip.
+    """
+    if not registrations:
+        return
+    commands = _batches('register_many',
+                        ['%s %s' % item for item in registrations.items()])
+    consock.sendall(''.join(commands))
+    for command in commands:
+        _check_ok(_readline(consock))
+
+def lease(consock, seconds):
+    """
+    Ask the port mapper to unregister the names registered over
+    consock if it sends nothing for the given number of seconds.
+    """
+    consock.sendall('lease %s\n' % seconds)
+    _check_ok(_readline(consock))
+
+def heartbeat(consock):
+    """
+    Renew the lease of consock. The port mapper does not reply.
+    """
+    consock.sendall('heartbeat\n')
+
+def keep_alive(consock, seconds):
+    """
+    Take a lease of the given number of seconds and renew it from a
+    new greenthread, which is returned. Kill it to stop renewing.
+    """
+    lease(consock, seconds)
+    def renew():
+        while True:
+            eventlet.sleep(seconds / 3.0)
+            heartbeat(consock)
+    return eventlet.spawn(renew)
+
+def lookup(consock, name):
+    """
+    Return the port registered for name with the port mapper
+    connected to consock, or None if name is not registered.
+    """
+    consock.sendall('lookup %s\n' % name)
+    reply = _readline(consock)
+    if reply.startswith('error'):
+        raise IOError("pyactpmd lookup failed: %s" % reply)
+    if reply in ('', 'None'):
+        return None
+    return int(reply)
+
+def lookup_many(consock, names):
+    """
+    Return a dict of name : port for the given names, in one
+    round trip. Names which are not registered map to None.
+    """
+    if not names:
+        return {}
+    commands = _batches('lookup_many', names)
+    consock.sendall(''.join(commands))
+    ports = []
+    for command in commands:
+        reply = _readline(consock)
+        if reply.startswith('error'):
+            raise IOError("pyactpmd lookup_many failed: %s" % reply)
+        batch = [None] * (len(command.split()) - 1)
+        for i, port in enumerate(reply.split()):
+            if port not in ('-', 'None'):
+                batch[i] = int(port)
+        ports.extend(batch)
+    return dict(zip(names, ports))
+
+class RegistryMirror(object):
+    """
+    A local copy of the registrations of a port mapper, kept
+    up to date by watching it. Lookups are local dict reads.
+    Only names starting with prefix are mirrored.
+
+    If the connection is lost the mirror is emptied, and it
+    reconnects and watches again. synced is an Event which is
+    sent once the current registrations have all been received.
+    """
+    ## Seconds to wait before the first attempt to reconnect; the
+    ## wait doubles after each failed attempt, up to RECONNECT_MAX.
+    RECONNECT_WAIT = 0.1
+    RECONNECT_MAX = 10.0
+
+    def __init__(self, host='localhost', port=PORT, prefix=''):
+        self.registrations = {}
+        self.synced = event.Event()
+        self._host = host
+        self._port = port
+        self._prefix = prefix
+        self._consock = connect_remote(host, port)
+        self._gthread = eventlet.spawn(self._run)
+
+    def lookup(self, name):
+        """
+        Return the port registered for name, or None.
+        """
+        return self.registrations.get(name)
+
+    def wait_synced(self, timeout=None):
+        """
+        Wait until the mirror holds all current registrations.
+        Return False if it does not within timeout seconds.
+        """
+        with eventlet.Timeout(timeout, False):
+            self.synced.wait()
+            return True
+        return False
+
+    def close(self):
+        self._gthread.kill()
+        if self._consock is not None:
+            self._consock.close()
+
+    def _run(self):
+        wait = self.RECONNECT_WAIT
+        while True:
+            try:
+                self._watch()
+            except socket.error, e:
+                log.info("registry mirror connection broken: %s", e)
+            self._consock.close()
+            self._consock = None
+            self.registrations.clear()
+            if self.synced.ready():
+                # it was in sync, so the port mapper was answering
+                self.synced = event.Event()
+                wait = self.RECONNECT_WAIT
+            while self._consock is None:
+                eventlet.sleep(wait)
+                wait = min(wait * 2, self.RECONNECT_MAX)
+                self._consock = _connect(self._host, self._port)
+
+    def _watch(self):
+        self._consock.sendall('watch %s*\n' % self._prefix)
+        fd = self._consock.makefile('r')
+        for line in fd:
+            splitl = line.split()
+            if splitl == ['ok'] and not self.synced.ready():
+                self.synced.send(True)
+            if len(splitl) < 3 or splitl[0] != 'event':
+                continue
+            if splitl[1] == 'register' and len(splitl) == 4:
+                port = splitl[3]
+                if port != 'None':
+                    port = int(port)
+                else:
+                    port = None
+                self.registrations[splitl[2]] = port
+            elif splitl[1] == 'unregister':
+                self.registrations.pop(splitl[2], None)
+
+def node_urls(consock, names, host='localhost'):
+    """
+    Return 'http://host:port/' urls for those of the given
+    names which are registered with the port mapper on host.
+    Useful with actor.spawn_remote_placed.
+    """
+    ports = lookup_many(consock, names)
+    return ['http://%s:%s/' % (host, ports[name])
+            for name in names if ports[name] is not None]
+
+
 
 ## ----------------------- Internal helper functions ------------------------
 
 _registrations = {} # name : port
+_owners = {} # name : _Connection which registered it
+_leased = set() # _Connections which have taken a lease
+_watchers = {} # _Connection : set of watched names and 'prefix*' patterns
+_restored = {} # name : time by which its node must register it again
+_registry_log = None # _RegistryLog when registrations are persistent
+_received = weakref.WeakKeyDictionary() # client socket : data read past its last reply
+
+log = logging.getLogger('pyactpmd')
+
+## Log records are buffered and written out when this many accumulate,
+## when a warning or worse is logged, or every LOG_FLUSH_INTERVAL seconds.
+LOG_BUFFER = 1000
+LOG_FLUSH_INTERVAL = 1.0
+
+## Largest command, in bytes, a client may send.
+MAX_COMMAND = 1024 * 1024
+
+RECV_SIZE = 65536
 
-def _start(daemonize=True, logfile=None, port=PORT):
+## Events which may wait to be sent to a watching connection. A watcher
+## which falls further behind is disconnected.
+WATCH_QUEUE = 10000
+
+## Seconds between checks for connections whose lease has run out.
+REAP_INTERVAL = 1.0
+
+## Seconds a registration reloaded from the registry file is kept
+## without its node registering it again.
+RESTORE_GRACE = 30.0
+
+## The registry log is compacted into a snapshot when it holds more than
+## COMPACT_RATIO records per registration, and at least COMPACT_MIN.
+COMPACT_RATIO = 4
+COMPACT_MIN = 10000
+
+
+def _start(daemonize=True, logfile=None, port=PORT, loglevel='info',
+           registry=None):
     """
     This function starts up the port mapper. This is run
     when 'python pyactmd.py' is executed. It will daemonize
@@ -54,32 +268,75 @@ def _start(daemonize=True, logfile=None, port=PORT):
     """
     if logfile:
         logfile = os.path.abspath(logfile)
+    if registry:
+        registry = os.path.abspath(registry)
     if daemonize:
-        _daemonize(logfile, port)
+        _daemonize(logfile, port, registry)
     _redirect_io(logfile)
+    _setup_logging(loglevel)
+    if registry:
+        _restore(registry)
     try:
         server = _listen(('0.0.0.0',port))
     except socket.error,e:
         if e[0] == 98 or e[0] == 10048:
-            print "port",PORT,"in use, another pyactpmd must be runing"
+            log.error("port %s in use, another pyactpmd must be running", port)
             return
         else:
             raise
-    print "started pyactpmd on port: ",PORT,"pid:",os.getpid()
-    sys.stdout.flush()
+    log.warning("started pyactpmd on port: %s pid: %s", port, os.getpid())
+    eventlet.spawn_n(_reaper)
     while True:
         consock,address = server.accept()
         eventlet.spawn_n(_handlecon,consock,address)
 
 
-def _dispatch(line):
+def _setup_logging(loglevel):
+    """
+    Log to stdout through a memory buffer, so handling a
+    command does not wait on a synchronous write.
+    """
+    target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    handler = logging.handlers.MemoryHandler(
+        LOG_BUFFER, flushLevel=logging.WARNING, target=target)
+    log.addHandler(handler)
+    log.setLevel(getattr(logging, loglevel.upper()))
+    def flusher():
+        while True:
+            eventlet.sleep(LOG_FLUSH_INTERVAL)
+            handler.flush()
+    eventlet.spawn_n(flusher)
+
+
+def _dispatch(line, conn=None):
     """
     Handle port mapper commands. On the first cut this is a
     simple line based protocol. It can handle these commands:
     
     'register name port'
+    'register_many name port [name port ...]'
+    'unregister name'
     'lookup name'
+    'lookup_many name [name ...]'
+    'watch name|prefix*'
+    'unwatch name|prefix*'
+    'lease seconds'
+    'heartbeat'
     
+    lookup_many replies with the ports separated by spaces, and
+    '-' for each name which is not registered.
+
+    After watch, the connection is sent 'event register name port'
+    for every matching registration, then the same event for each
+    later registration and 'event unregister name' for each later
+    unregistration, until unwatch.
+
+    Names are registered for as long as the connection which
+    registered them stays open. After 'lease seconds', they are
+    also unregistered if the connection sends no command for that
+    many seconds. 'heartbeat' renews the lease and has no reply.
+
     And the process itself can also handle the 'kill' command.
     That command is mostly for debugging as the port mapper
     is never explicitly killed or stopped after spawning.
@@ -96,57 +353,508 @@ def _dispatch(line):
                 return 'error : invalid port'
         else:
             return 'error : invalid register args'
-        _registrations[name] = port
+        _register(name, port, conn)
+        return 'ok'
+
+    if splitl[0] == 'register_many':
+        if len(splitl) < 3 or len(splitl) % 2 != 1:
+            return 'error : invalid register_many args'
+        try:
+            pairs = [(splitl[i], int(splitl[i+1]))
+                     for i in xrange(1, len(splitl), 2)]
+        except ValueError:
+            return 'error : invalid port'
+        for name, port in pairs:
+            _register(name, port, conn)
+        return 'ok'
+
+    if splitl[0] == 'unregister':
+        if len(splitl)!=2:
+            return 'error : unregister args'
+        _unregister(splitl[1])
         return 'ok'
     
     if splitl[0] == 'lookup':
         if len(splitl)!=2:
             return 'error : lookup args'
-        return str(_registrations.get(splitl[1],''))
+        return str(_lookup(splitl[1], ''))
+
+    if splitl[0] == 'lookup_many':
+        if len(splitl) < 2:
+            return 'error : lookup_many args'
+        return ' '.join([str(_lookup(name, '-')) for name in splitl[1:]])
+
+    if splitl[0] in ('watch', 'unwatch'):
+        if len(splitl)!=2 or conn is None:
+            return 'error : %s args' % splitl[0]
+        pattern = splitl[1]
+        if splitl[0] == 'unwatch':
+            _watchers.get(conn, set()).discard(pattern)
+            return 'ok'
+        _watchers.setdefault(conn, set()).add(pattern)
+        events = ['event register %s %s' % (name, port)
+                  for name, port in _registrations.items()
+                  if _matches(pattern, name)]
+        if events:
+            conn.send(events)
+        return 'ok'
+
+    if splitl[0] == 'lease':
+        if len(splitl)!=2 or conn is None:
+            return 'error : lease args'
+        try:
+            seconds = float(splitl[1])
+        except ValueError:
+            return 'error : invalid lease'
+        conn.lease = seconds > 0 and seconds or None
+        conn.renew()
+        if conn.lease:
+            _leased.add(conn)
+        else:
+            _leased.discard(conn)
+        return 'ok'
+
+    if splitl[0] == 'heartbeat':
+        return None
     
     return 'error : invalid command'
 
+
+def _register(name, port, conn):
+    owner = _owners.pop(name, None)
+    if owner is not None:
+        owner.names.discard(name)
+    _restored.pop(name, None)
+    _registrations[name] = port
+    if _registry_log is not None:
+        _registry_log.register(name, port)
+    if conn is not None:
+        _owners[name] = conn
+        conn.names.add(name)
+    _notify(name, 'register %s %s' % (name, port))
+
+
+def _unregister(name):
+    if name not in _registrations:
+        return
+    del _registrations[name]
+    _restored.pop(name, None)
+    if _registry_log is not None:
+        _registry_log.unregister(name)
+    owner = _owners.pop(name, None)
+    if owner is not None:
+        owner.names.discard(name)
+    _notify(name, 'unregister %s' % name)
+
+
+def _lookup(name, default):
+    """
+    Return the port registered for name, first expiring the
+    registering connection if its lease has run out, so that
+    lookups of dead nodes fail without waiting for the reaper.
+    """
+    owner = _owners.get(name)
+    if owner is not None and owner.expired():
+        _expire(owner)
+    elif name in _restored and _restored[name] < time.time():
+        _unregister(name)
+    return _registrations.get(name, default)
+
+
+def _expire(conn):
+    """
+    Unregister everything conn registered and disconnect it.
+    """
+    log.info("lease of %s expired", conn.address)
+    _leased.discard(conn)
+    for name in list(conn.names):
+        _unregister(name)
+    try:
+        conn.sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+
+
+def _restore(path):
+    """
+    Reload the registrations kept in the registry file at path and
+    keep it up to date from now on. Reloaded names have no owning
+    connection; each is dropped the first time it is looked up after
+    RESTORE_GRACE seconds unless its node has registered it again.
+    """
+    global _registry_log
+    started = time.time()
+    _registry_log = _RegistryLog(path, _registrations)
+    deadline = started + RESTORE_GRACE
+    _restored.update(dict.fromkeys(_registrations, deadline))
+    eventlet.spawn_after(RESTORE_GRACE, _drop_restored, deadline)
+    log.warning("restored %s registrations in %.3f seconds",
+                len(_registrations), time.time() - started)
+
+
+def _drop_restored(deadline):
+    """
+    Unregister the reloaded names which were never registered again.
+    """
+    for name, name_deadline in _restored.items():
+        if name_deadline <= deadline:
+            _unregister(name)
+
+
+class _RegistryLog(object):
+    """
+    The registrations dict, kept on disk as a marshalled snapshot
+    at path plus an append-only log of later changes at path + '.log'.
+    Log records are 'R name port' and 'U name' lines; a torn
+    last record left by a crash is cut off. When the log grows
+    large it is compacted into a new snapshot.
+    """
+    def __init__(self, path, registrations):
+        self.path = path
+        self.registrations = registrations
+        if os.path.exists(path):
+            f = open(path, 'rb')
+            try:
+                registrations.update(marshal.load(f))
+            finally:
+                f.close()
+        self.records = 0
+        if os.path.exists(path + '.log'):
+            f = open(path + '.log', 'rb+')
+            try:
+                complete = 0
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    self._replay(line.split())
+                    self.records += 1
+                    complete += len(line)
+                # so the next record does not continue a torn one
+                f.truncate(complete)
+            finally:
+                f.close()
+        self._log = open(path + '.log', 'ab')
+
+    def _replay(self, record):
+        if len(record) == 3 and record[0] == 'R':
+            port = record[2]
+            if port == 'None':
+                port = None
+            else:
+                port = int(port)
+            self.registrations[record[1]] = port
+        elif len(record) == 2 and record[0] == 'U':
+            self.registrations.pop(record[1], None)
+
+    def register(self, name, port):
+        self._log.write('R %s %s\n' % (name, port))
+        self._logged()
+
+    def unregister(self, name):
+        self._log.write('U %s\n' % (name, ))
+        self._logged()
+
+    def _logged(self):
+        self.records += 1
+        if self.records > max(COMPACT_MIN, COMPACT_RATIO * len(self.registrations)):
+            self.compact()
+
+    def flush(self):
+        """
+        Hand logged records to the operating system. Called before
+        replying, so acknowledged changes survive a crash of the
+        port mapper.
+        """
+        self._log.flush()
+
+    def compact(self):
+        """
+        Write the current registrations as the snapshot and empty
+        the log. Replaying the old log over the new snapshot after
+        a crash between the two steps gives the same registrations.
+        """
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            marshal.dump(self.registrations, f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        if sys.platform == 'win32' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+        self._log.close()
+        self._log = open(self.path + '.log', 'wb')
+        self.records = 0
+
+    def close(self):
+        self._log.close()
+
+
+def _reap():
+    now = time.time()
+    for conn in list(_leased):
+        if conn.expired(now):
+            _expire(conn)
+
+
+def _reaper():
+    while True:
+        eventlet.sleep(REAP_INTERVAL)
+        _reap()
+
+
+def _matches(pattern, name):
+    if pattern.endswith('*'):
+        return name.startswith(pattern[:-1])
+    return name == pattern
+
+
+def _notify(name, event):
+    """
+    Push event to the connections watching name.
+    """
+    for conn, patterns in _watchers.items():
+        for pattern in patterns:
+            if _matches(pattern, name):
+                conn.push(['event ' + event])
+                break
+
+
+def _reply(command, conn=None):
+    """
+    Dispatch one command. A command may start with a request
+    id, '#<id> ', which is then repeated at the start of its
+    reply so pipelining clients can match replies to requests.
+    """
+    request_id = None
+    if command.startswith('#'):
+        request_id, _, command = command.partition(' ')
+    try:
+        r = _dispatch(command, conn)
+    except Exception,e:
+        r = 'error : %s' % e
+    if r is None:
+        return None
+    r = r.strip()
+    if request_id is None:
+        return r
+    return request_id + ' ' + r
+
+
+class _Connection(object):
+    """
+    A client connection. Commands are newline terminated until
+    the client sends 'binary', after which commands and replies
+    in both directions are framed by a 4 byte big endian length.
+    """
+    def __init__(self, consock, address):
+        self.sock = consock
+        self.address = address
+        self.binary = False
+        self.names = set()
+        self.lease = None
+        self.expires = None
+        self._wlock = semaphore.Semaphore()
+        self._events = collections.deque()
+        self._writer = None
+
+    def renew(self):
+        if self.lease:
+            self.expires = time.time() + self.lease
+
+    def expired(self, now=None):
+        if not self.lease:
+            return False
+        return (now or time.time()) > self.expires
+
+    def commands(self):
+        """
+        Yield (command, pending) for each command received, where
+        pending is True if the next command has already arrived.
+        """
+        buf, pos = '', 0
+        while True:
+            command, end = self._parse(buf, pos)
+            if command is None:
+                if len(buf) - pos > MAX_COMMAND:
+                    raise ValueError("command too long")
+                data = self.sock.recv(RECV_SIZE)
+                if not data:
+                    return
+                buf, pos = buf[pos:] + data, 0
+                continue
+            pos = end
+            if command:
+                yield command, self._parse(buf, pos)[0] is not None
+
+    def _parse(self, buf, pos):
+        """
+        Return the command at pos in buf and the position after
+        it, or (None, pos) if it has not been fully received.
+        """
+        if self.binary:
+            if len(buf) - pos < 4:
+                return None, pos
+            size, = struct.unpack('!I', buf[pos:pos+4])
+            if size > MAX_COMMAND:
+                raise ValueError("command too long")
+            end = pos + 4 + size
+            if len(buf) < end:
+                return None, pos
+            return buf[pos+4:end], end
+        end = buf.find('\n', pos)
+        if end < 0:
+            return None, pos
+        return buf[pos:end].strip(), end + 1
+
+    def send(self, replies):
+        """
+        Send replies or events. Events pushed by other connections'
+        greenlets are never interleaved with replies.
+        """
+        if self.binary:
+            data = ''.join([struct.pack('!I', len(r)) + r for r in replies])
+        else:
+            data = ''.join([r + '\n' for r in replies])
+        self._wlock.acquire()
+        try:
+            self.sock.sendall(data)
+        finally:
+            self._wlock.release()
+
+    def push(self, events):
+        """
+        Queue events for this connection's writer greenlet, so a
+        watcher which does not read can not block the greenlet
+        which notifies it. A watcher with more than WATCH_QUEUE
+        events waiting is disconnected instead.
+        """
+        if len(self._events) + len(events) > WATCH_QUEUE:
+            log.warning("disconnecting watcher %s: %s events waiting",
+                        self.address, len(self._events))
+            self.disconnect()
+            return
+        self._events.extend(events)
+        if self._writer is None:
+            self._writer = eventlet.spawn(self._write_events)
+
+    def _write_events(self):
+        try:
+            try:
+                while self._events:
+                    events = list(self._events)
+                    self._events.clear()
+                    self.send(events)
+            except socket.error:
+                self.disconnect()
+        finally:
+            self._writer = None
+
+    def disconnect(self):
+        """
+        Stop watching and shut the socket down, which ends the
+        connection's own greenlet and its cleanup.
+        """
+        _watchers.pop(self, None)
+        self._events.clear()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+
 def _handlecon(consock,address):
     """
     Handle a single client connection.
     The connection can stays open and the 
     client can issue multiple commands
-    in a sequential manner.
-    """
-    print "new connection from",address
-    rfd = consock.makefile('r')
-    wfd = consock.makefile('w')
-    l = rfd.readline()
-    clientport = None
-    while l:
-        l = l.strip()
-        if l.lower() == 'kill':
-            print "received kill command, exiting"
-            wfd.write('ok\n')
-            wfd.flush()
-            sys.exit(0)
-            break # shouldn't get here
-        print "got line",l,"[",address,"]"
-        try:
-            r = _dispatch(l).strip()
-        except Exception,e:
-            r = 'error : %s' % e
+    in a sequential manner. Commands which
+    arrive together are answered together.
+    """
+    global _registry_log
+    log.info("new connection from %s", address)
+    conn = _Connection(consock, address)
+    replies = []
+    try:
         try:
-            wfd.write(r+'\n')
-            wfd.flush()
+            for command, pending in conn.commands():
+                if command.lower() == 'kill':
+                    log.warning("received kill command, exiting")
+                    if _registry_log is not None:
+                        # keep the names this connection registered
+                        _registry_log.close()
+                        _registry_log = None
+                    conn.send(replies + ['ok'])
+                    logging.shutdown()
+                    sys.exit(0)
+                log.debug("got command %r [%s]", command, address)
+                if command == 'binary':
+                    conn.send(replies + ['ok'])
+                    replies = []
+                    conn.binary = True
+                    continue
+                conn.renew()
+                reply = _reply(command, conn)
+                if reply is not None:
+                    replies.append(reply)
+                if replies and not pending:
+                    if _registry_log is not None:
+                        _registry_log.flush()
+                    conn.send(replies)
+                    replies = []
         except socket.error,e:
-            if e[0] == 32:
-                print "broken pipe from client",address
-                break
-            else:
+            if e[0] not in (errno.EPIPE, errno.ECONNRESET):
                 raise
-        sys.stdout.flush()
-        l = rfd.readline()
-    rfd.close()
-    wfd.close()
-    consock.close()
-    print "closed client connection",address
-    sys.stdout.flush()
+            log.info("connection from client %s broken: %s", address, e)
+        except ValueError,e:
+            log.warning("dropping client %s: %s", address, e)
+    finally:
+        # names expire with the connection, however it ends
+        _watchers.pop(conn, None)
+        _leased.discard(conn)
+        for name in list(conn.names):
+            _unregister(name)
+        consock.close()
+        log.info("closed client connection %s", address)
+
+def _check_ok(reply):
+    if reply != 'ok':
+        raise IOError("pyactpmd command failed: %s" % reply)
+
+def _readline(consock):
+    """
+    Read one reply line from a port mapper connection.
+    """
+    buf = _received.pop(consock, '')
+    end = buf.find('\n')
+    while end < 0:
+        data = consock.recv(RECV_SIZE)
+        if not data:
+            raise IOError("pyactpmd connection closed")
+        end = data.find('\n')
+        if end >= 0:
+            end += len(buf)
+        buf += data
+    if end + 1 < len(buf):
+        _received[consock] = buf[end+1:]
+    return buf[:end].strip()
+
+def _batches(command, args):
+    """
+    Return command lines which together pass all of args, none of
+    them longer than the port mapper accepts.
+    """
+    lines, batch, size = [], [], len(command) + 1
+    for arg in args:
+        if batch and size + len(arg) + 1 > MAX_COMMAND:
+            lines.append('%s %s\n' % (command, ' '.join(batch)))
+            batch, size = [], len(command) + 1
+        batch.append(arg)
+        size += len(arg) + 1
+    lines.append('%s %s\n' % (command, ' '.join(batch)))
+    return lines
 
 def _listen(addr):
     """
@@ -172,10 +880,10 @@ def _connect(host, port, tries=1, retrywait=1):
         if tries <= 0:
             return None
         eventlet.sleep(retrywait)
-        return _connect(port, tries-1, retrywait)
+        return _connect(host, port, tries, retrywait)
 
     
-def _launch(port,logfile):
+def _launch(port,logfile,registry=None):
     """
     Run _this_ module in a separate process. That 
     process will daemonize the service and quickly
@@ -190,6 +898,8 @@ def _launch(port,logfile):
         args += ['-p', str(port)]
     if logfile:
         args += ['-l', logfile]
+    if registry:
+        args += ['-r', os.path.abspath(registry)]
     rcode = subprocess.call(args)
     return rcode
 
@@ -212,7 +922,7 @@ def _redirect_io(logfile):
         pass
 
 
-def _daemonize(logfile,port):
+def _daemonize(logfile,port,registry=None):
     """
     Daemonization code. This handle the daemonization for
     both POSIX systems (that have os.fork) and Windows (which
@@ -228,7 +938,7 @@ def _daemonize(logfile,port):
         _posix_daemonize()
         return # will return if last child process
     else: # win32
-        _win32_daemonize(logfile,port)
+        _win32_daemonize(logfile,port,registry)
         # never returns on win32, just create another process with -n option
         # then run os._exit(0)
 
@@ -258,10 +968,12 @@ def _posix_daemonize():
     os.dup2(0,2) # stderr = stdin = /dev/null
 
 
-def _win32_daemonize(logfile,port):
+def _win32_daemonize(logfile,port,registry=None):
     args = [_get_python_executable(), __file__, '-n']
     if logfile:
         args += ['-l', logfile]
+    if registry:
+        args += ['-r', registry]
     if port:
         args += ['-p', str(port)]
     DETACHED_PROCESS = 0x00000008
@@ -289,11 +1001,18 @@ if __name__=='__main__':
                  help="File to log stdout and stderr to.")
     p.add_option('-p','--port',default=PORT,type=int,
                  help="Port on which to listen for connections from actors.")
+    p.add_option('-v','--loglevel',default='info',
+                 choices=['debug','info','warning','error'],
+                 help="Least severe messages to log. debug logs every command.")
+    p.add_option('-r','--registry',default=None,
+                 help="File to keep registrations in across restarts.")
     opts,_ = p.parse_args()
     try:
-        _start(not opts.nodetach, opts.logfile, opts.port)
+        _start(not opts.nodetach, opts.logfile, opts.port, opts.loglevel,
+               opts.registry)
     except (SystemExit, KeyboardInterrupt):
-        print "Caught system interrupt, exiting"
+        log.warning("Caught system interrupt, exiting")
+        logging.shutdown()
         
     
 
@@ -0,0 +1,261 @@
+
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+import eventlet
+from pyact import pyactpmd
+
+
+def serve():
+    """
+    Run a port mapper server on a free local port
+    in this process. Return the port.
+    """
+    server = eventlet.listen(('127.0.0.1', 0))
+    def accept():
+        while True:
+            consock, address = server.accept()
+            eventlet.spawn_n(pyactpmd._handlecon, consock, address)
+    eventlet.spawn_n(accept)
+    return server.getsockname()[1]
+
+
+class TestPortMapper(unittest.TestCase):
+
+    def setUp(self):
+        pyactpmd._registrations.clear()
+        self.port = serve()
+        self.consock = eventlet.connect(('127.0.0.1', self.port))
+
+    def tearDown(self):
+        self.consock.close()
+
+    def test_dispatch(self):
+        self.assertEquals(pyactpmd._dispatch('register a 1'), 'ok')
+        self.assertEquals(pyactpmd._dispatch('lookup a'), '1')
+        self.assertEquals(pyactpmd._dispatch('lookup b'), '')
+        self.assertEquals(pyactpmd._dispatch('register_many b 2 c 3'), 'ok')
+        self.assertEquals(pyactpmd._dispatch('lookup_many c x a'), '3 - 1')
+        self.assertEquals(pyactpmd._dispatch('register_many b'),
+                          'error : invalid register_many args')
+        self.assertEquals(pyactpmd._dispatch('frob'), 'error : invalid command')
+
+    def test_client_helpers(self):
+        pyactpmd.register(self.consock, 'node1', 8001)
+        pyactpmd.register_many(self.consock, {'node2': 8002, 'node3': 0})
+        self.assertEquals(pyactpmd.lookup(self.consock, 'node1'), 8001)
+        self.assertEquals(pyactpmd.lookup(self.consock, 'nobody'), None)
+        self.assertEquals(
+            pyactpmd.lookup_many(self.consock, ['node2', 'node3', 'nobody']),
+            {'node2': 8002, 'node3': 0, 'nobody': None})
+        self.assertEquals(
+            pyactpmd.node_urls(self.consock, ['node1', 'nobody']),
+            ['http://localhost:8001/'])
+
+    def test_large_batches(self):
+        names = dict(('node%s_%s' % (i, 'x' * 50), i) for i in range(20000))
+        pyactpmd.register_many(self.consock, names)
+        self.assertEquals(len(pyactpmd._registrations), len(names))
+        self.assertEquals(pyactpmd.lookup_many(self.consock, names.keys()),
+                          names)
+        self.consock.sendall('lookup node1_%s\nlookup node2_%s\n'
+                             % ('x' * 50, 'x' * 50))
+        self.assertEquals(pyactpmd._readline(self.consock), '1')
+        self.assertEquals(pyactpmd._readline(self.consock), '2')
+
+    def test_pipelined_request_ids(self):
+        self.consock.sendall('#1 register a 1\n#2 lookup a\nlookup b\n')
+        fd = self.consock.makefile('r')
+        self.assertEquals(
+            [fd.readline(), fd.readline(), fd.readline()],
+            ['#1 ok\n', '#2 1\n', '\n'])
+
+    def test_binary_framing(self):
+        self.consock.sendall('binary\n')
+        self.assertEquals(pyactpmd._readline(self.consock), 'ok')
+        frames = ['register a 1', '#7 lookup a']
+        self.consock.sendall(
+            ''.join([struct.pack('!I', len(f)) + f for f in frames]))
+        data = ''
+        while len(data) < 14:
+            data += self.consock.recv(1024)
+        self.assertEquals(data, '\x00\x00\x00\x02ok\x00\x00\x00\x04#7 1')
+
+    def test_watch(self):
+        pyactpmd.register(self.consock, 'web1', 8001)
+        self.consock.sendall('watch web*\n')
+        fd = self.consock.makefile('r')
+        self.assertEquals(fd.readline(), 'event register web1 8001\n')
+        self.assertEquals(fd.readline(), 'ok\n')
+        other = eventlet.connect(('127.0.0.1', self.port))
+        pyactpmd.register_many(other, {'web2': 8002, 'db1': 9001})
+        self.assertEquals(fd.readline(), 'event register web2 8002\n')
+        other.sendall('unregister web1\n')
+        self.assertEquals(fd.readline(), 'event unregister web1\n')
+        other.close()
+
+    def test_stuck_watcher(self):
+        watcher = eventlet.connect(('127.0.0.1', self.port))
+        watcher.sendall('watch n*\n')
+        eventlet.sleep(0.01)
+        old_limit = pyactpmd.WATCH_QUEUE
+        pyactpmd.WATCH_QUEUE = 1000
+        try:
+            names = dict(('n%s_%s' % (i, 'x' * 200), i) for i in range(100))
+            for i in range(200):
+                with eventlet.Timeout(5):
+                    pyactpmd.register_many(self.consock, names)
+        finally:
+            pyactpmd.WATCH_QUEUE = old_limit
+        eventlet.sleep(0.01)
+        self.assertEquals(
+            [p for p in pyactpmd._watchers.values() if 'n*' in p], [])
+        watcher.close()
+
+    def test_registry_mirror(self):
+        pyactpmd.register(self.consock, 'web1', 8001)
+        mirror = pyactpmd.RegistryMirror('127.0.0.1', self.port, 'web')
+        try:
+            pyactpmd.register_many(self.consock, {'web2': 8002, 'db1': 9001})
+            self.consock.sendall('unregister web1\n')
+            pyactpmd._readline(self.consock)
+            eventlet.sleep(0.01)
+            self.assertEquals(mirror.registrations, {'web2': 8002})
+            self.assertEquals(mirror.lookup('web2'), 8002)
+        finally:
+            mirror.close()
+
+    def test_registry_mirror_reconnects(self):
+        pyactpmd.register(self.consock, 'web1', 8001)
+        mirror = pyactpmd.RegistryMirror('127.0.0.1', self.port, 'web')
+        try:
+            self.assertEquals(mirror.wait_synced(1), True)
+            self.assertEquals(mirror.registrations, {'web1': 8001})
+            watchers = [c for c in pyactpmd._watchers
+                        if c.address == mirror._consock.getsockname()]
+            self.assertEquals(len(watchers), 1)
+            watchers[0].sock.shutdown(socket.SHUT_RDWR)
+            eventlet.sleep(0.01)
+            self.assertEquals(mirror.synced.ready(), False)
+            self.assertEquals(mirror.registrations, {})
+            self.consock.sendall('unregister web1\n')
+            pyactpmd._readline(self.consock)
+            pyactpmd.register(self.consock, 'web2', 8002)
+            self.assertEquals(mirror.wait_synced(1), True)
+            self.assertEquals(mirror.registrations, {'web2': 8002})
+        finally:
+            mirror.close()
+
+    def test_disconnect_unregisters(self):
+        other = eventlet.connect(('127.0.0.1', self.port))
+        pyactpmd.register(other, 'node1', 8001)
+        self.assertEquals(pyactpmd.lookup(self.consock, 'node1'), 8001)
+        other.close()
+        eventlet.sleep(0.01)
+        self.assertEquals(pyactpmd.lookup(self.consock, 'node1'), None)
+
+    def test_reset_unregisters(self):
+        other = eventlet.connect(('127.0.0.1', self.port))
+        pyactpmd.register(other, 'node1', 8001)
+        other.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                         struct.pack('ii', 1, 0))
+        other.close() # sends a reset
+        eventlet.sleep(0.01)
+        self.assertEquals(pyactpmd.lookup(self.consock, 'node1'), None)
+
+    def test_lease_expiry(self):
+        other = eventlet.connect(('127.0.0.1', self.port))
+        pyactpmd.lease(other, 0.05)
+        pyactpmd.register(other, 'node1', 8001)
+        pyactpmd.heartbeat(other)
+        pyactpmd.register(other, 'node2', 8002)
+        eventlet.sleep(0.1)
+        self.assertEquals(pyactpmd.lookup(self.consock, 'node1'), None)
+        self.assertEquals(other.recv(1024), '')
+        self.assertEquals(pyactpmd._registrations, {})
+        other.close()
+
+    def test_keep_alive(self):
+        other = eventlet.connect(('127.0.0.1', self.port))
+        renewer = pyactpmd.keep_alive(other, 0.05)
+        pyactpmd.register(other, 'node1', 8001)
+        eventlet.sleep(0.1)
+        pyactpmd._reap()
+        self.assertEquals(pyactpmd.lookup(self.consock, 'node1'), 8001)
+        renewer.kill()
+        eventlet.sleep(0.1)
+        pyactpmd._reap()
+        self.assertEquals(pyactpmd._registrations, {})
+        other.close()
+
+
+
+class TestRegistryFile(unittest.TestCase):
+
+    def setUp(self):
+        pyactpmd._registrations.clear()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'registry')
+
+    def tearDown(self):
+        if pyactpmd._registry_log is not None:
+            pyactpmd._registry_log.close()
+        pyactpmd._registry_log = None
+        pyactpmd._registrations.clear()
+        pyactpmd._restored.clear()
+        shutil.rmtree(self.dir)
+
+    def restart(self):
+        """
+        Simulate the port mapper crashing and being restarted.
+        """
+        pyactpmd._registry_log.close()
+        pyactpmd._registrations.clear()
+        pyactpmd._owners.clear()
+        pyactpmd._restore(self.path)
+
+    def test_restore(self):
+        pyactpmd._restore(self.path)
+        pyactpmd._dispatch('register_many a 1 b 2 c 3')
+        pyactpmd._dispatch('unregister b')
+        pyactpmd._registry_log.flush()
+        self.restart()
+        self.assertEquals(pyactpmd._registrations, {'a': 1, 'c': 3})
+        self.assertEquals(pyactpmd._dispatch('lookup a'), '1')
+
+        pyactpmd._dispatch('register a 4')
+        pyactpmd._restored['c'] = 0
+        self.assertEquals(pyactpmd._dispatch('lookup_many a c'), '4 -')
+
+    def test_torn_record(self):
+        pyactpmd._restore(self.path)
+        pyactpmd._dispatch('register a 1')
+        pyactpmd._registry_log.flush()
+        f = open(self.path + '.log', 'ab')
+        f.write('R b')
+        f.close()
+        self.restart()
+        self.assertEquals(pyactpmd._registrations, {'a': 1})
+        pyactpmd._dispatch('register c 3')
+        pyactpmd._registry_log.flush()
+        self.restart()
+        self.assertEquals(pyactpmd._registrations, {'a': 1, 'c': 3})
+
+    def test_compact(self):
+        pyactpmd._restore(self.path)
+        for i in range(5):
+            pyactpmd._dispatch('register a %s' % i)
+        pyactpmd._dispatch('register b 1')
+        pyactpmd._registry_log.compact()
+        self.assertEquals(os.path.getsize(self.path + '.log'), 0)
+        pyactpmd._dispatch('unregister b')
+        pyactpmd._registry_log.flush()
+        self.restart()
+        self.assertEquals(pyactpmd._registrations, {'a': 4})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Opt-in fair scheduling for Actors.
+
+An Actor only gives up the hub when it waits in receive, sleeps or
+calls cooperate. Once enabled, each Actor is charged reductions for
+the work it does in the actor module: a message received, a message
+scanned while matching patterns, a message cast. After budget
+reductions, or as soon as an Actor of higher priority is waiting to
+run again, the Actor yields. Yielded Actors are resumed highest
+priority first, oldest first within a priority, one per hub turn, so
+I/O and timers keep running in between.
+
+Code which runs for long without receiving or casting can not be
+interrupted; call cooperate in such loops.
+"""
+
+import collections
+
+import eventlet
+from eventlet import hubs
+
+
+## Actor.priority values.
+PRIORITIES = [LOW, NORMAL, HIGH] = [0, 1, 2]
+
+## Default number of reductions an Actor may use before it yields.
+BUDGET = 2000
+
+enabled = False
+budget = BUDGET
+
+_queues = [collections.deque() for priority in PRIORITIES]
+_scheduled = False
+
+
+def enable(reductions=BUDGET):
+    """Start charging Actors reductions, yielding every reductions.
+    """
+    global enabled, budget
+    budget = reductions
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def charge(reductions=1):
+    """Charge the current Actor reductions, yielding if its budget is
+    used up or an Actor of higher priority is waiting to run.
+    """
+    current = eventlet.getcurrent()
+    priority = getattr(current, 'priority', None)
+    if priority is None:
+        return
+    current._reductions += reductions
+    if current._reductions >= budget:
+        reschedule(current)
+        return
+    for queue in _queues[priority + 1:]:
+        if queue:
+            reschedule(current)
+            return
+
+
+def reschedule(actor):
+    """Queue actor, the current greenlet, to be resumed in priority order
+    and switch to the hub.
+    """
+    actor._reductions = 0
+    ticket = object()
+    actor._ticket = ticket
+    _queues[actor.priority].append((actor, ticket))
+    _schedule()
+    try:
+        hubs.get_hub().switch()
+    finally:
+        actor._ticket = None
+
+
+def _schedule():
+    global _scheduled
+    if not _scheduled:
+        _scheduled = True
+        hubs.get_hub().schedule_call_global(0, _resume_next)
+
+
+def _resume_next():
+    global _scheduled
+    _scheduled = False
+    for queue in reversed(_queues):
+        while queue:
+            actor, ticket = queue.popleft()
+            # skip Actors which were killed or woken some other way
+            if actor._ticket is not ticket or actor.dead:
+                continue
+            for waiting in _queues:
+                if waiting:
+                    _schedule()
+                    break
+            actor.switch()
+            return
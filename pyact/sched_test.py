@@ -0,0 +1,52 @@
+
+import unittest
+import eventlet
+from pyact import actor, sched
+
+
+def drainer(name, count, log, priority):
+    def drain(receive):
+        current = eventlet.getcurrent()
+        current.priority = priority
+        for i in range(count):
+            current.address.cast(i)
+        for i in range(count):
+            receive()
+            log.append(name)
+    return drain
+
+
+def switches(log):
+    return len([i for i in range(1, len(log)) if log[i] != log[i - 1]])
+
+
+class TestSched(unittest.TestCase):
+
+    def tearDown(self):
+        sched.disable()
+
+    def run_drainers(self, *specs):
+        log = []
+        actor.wait_all([drainer(name, 500, log, priority)
+                        for name, priority in specs])
+        return log
+
+    def test_disabled(self):
+        log = self.run_drainers(('a', sched.NORMAL), ('b', sched.NORMAL))
+        self.assertEquals(switches(log), 1)
+
+    def test_budget(self):
+        sched.enable(100)
+        log = self.run_drainers(('a', sched.NORMAL), ('b', sched.NORMAL))
+        self.assertEquals(log.count('a'), 500)
+        self.assertEquals(switches(log) > 5, True)
+
+    def test_priority(self):
+        sched.enable(100)
+        log = self.run_drainers(('low', sched.LOW), ('high', sched.HIGH))
+        # low starts first, but after yielding it only runs again
+        # once high is done
+        self.assertEquals(log, ['high'] * 500 + ['low'] * 500)
+
+if __name__ == '__main__':
+    unittest.main()
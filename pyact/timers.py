@@ -0,0 +1,254 @@
+"""
+A hierarchical timer wheel.
+
+Every eventlet.Timeout is an entry in the hub's timer heap, so with
+thousands of Actors waiting in receive with a timeout each insert
+and cancel costs O(log n). A Wheel counts time in ticks of
+resolution seconds and keeps its timers in levels of SLOTS slots:
+level 0 holds the timers due within the current SLOTS ticks, level
+1 those due within the current SLOTS**2 ticks, and so on. Adding and
+cancelling a timer is O(1). Whenever level 0 wraps around, the next
+slot of level 1 is spread over level 0, and likewise up the levels.
+A Wheel keeps one hub timer, set for the next tick with work to do.
+
+Timers fire up to one tick late, never early. Callbacks run in the
+hub greenlet, like eventlet timer callbacks, so they must not block.
+
+call_soon runs callbacks on the next hub turn, in order, all from one
+hub timer; spawn uses it to start new Actors.
+"""
+
+import collections
+import itertools
+import logging
+import math
+import time
+
+from eventlet import hubs
+
+
+## Default length of a tick, in seconds.
+RESOLUTION = 0.01
+
+## Each level has 2 ** SLOT_BITS slots. With LEVELS levels and the
+## default resolution, timers up to about 16 months away are placed
+## directly; later ones wait in the last slot and are placed again.
+SLOT_BITS = 8
+SLOTS = 1 << SLOT_BITS
+LEVELS = 4
+
+log = logging.getLogger('pyact.timers')
+
+_MASK = SLOTS - 1
+_order = itertools.count()
+
+
+class Timer(object):
+    """A callback pending in a Wheel. Returned by Wheel.add and
+    Wheel.add_interval; call cancel to drop it.
+    """
+    __slots__ = ['wheel', 'deadline', 'interval', 'callback', 'args',
+                 'slot', 'order']
+
+    def __init__(self, wheel, deadline, interval, callback, args):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.slot = None
+        self.order = _order.next()
+
+    @property
+    def pending(self):
+        return self.slot is not None
+
+    def cancel(self):
+        self.interval = None
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+
+
+class Wheel(object):
+    def __init__(self, resolution=RESOLUTION, levels=LEVELS):
+        self.resolution = resolution
+        self.levels = [[set() for index in xrange(SLOTS)]
+                       for level in xrange(levels)]
+        self.count = 0
+        self.tick = self._floor(time.time()) # the last tick run
+        self._wakeup = None # the tick the hub timer is set for
+        self._hub_timer = None
+        self._running = False
+
+    def add(self, delay, callback, *args):
+        """Call callback(*args) in the hub after delay seconds.
+        """
+        return self._add(Timer(self, time.time() + delay, None,
+                               callback, args))
+
+    def add_interval(self, interval, callback, *args):
+        """Call callback(*args) in the hub every interval seconds until
+        the Timer is cancelled. Calls which would have been due while
+        the hub was busy are skipped, not made up for.
+        """
+        return self._add(Timer(self, time.time() + interval, interval,
+                               callback, args))
+
+    def _add(self, timer):
+        if not self.count:
+            # nothing is placed relative to the old tick
+            self.tick = max(self.tick, self._floor(time.time()))
+        due = self._place(timer, max(self._ceil(timer.deadline),
+                                     self.tick + 1))
+        self.count += 1
+        if not self._running:
+            self._wake_at(due)
+        return timer
+
+    def _floor(self, seconds):
+        return int(seconds / self.resolution)
+
+    def _ceil(self, seconds):
+        return int(math.ceil(seconds / self.resolution))
+
+    def _place(self, timer, tick):
+        """Put timer in the slot for tick, which is not before the
+        current one. Return the tick at which the Wheel has to run
+        next for it.
+        """
+        top = len(self.levels) - 1
+        for level in xrange(top + 1):
+            shift = SLOT_BITS * (level + 1)
+            if tick >> shift == self.tick >> shift:
+                index = (tick >> (SLOT_BITS * level)) & _MASK
+                break
+        else:
+            # too far away: wait in the slot of the top level which
+            # is spread out last, and be placed again from there
+            level = top
+            index = ((self.tick >> (SLOT_BITS * top)) - 1) & _MASK
+        slot = self.levels[level][index]
+        slot.add(timer)
+        timer.slot = slot
+        if level == 0:
+            return tick
+        return ((self.tick >> SLOT_BITS) + 1) << SLOT_BITS
+
+    def _wake_at(self, tick):
+        if self._wakeup is not None and self._wakeup <= tick:
+            return
+        if self._hub_timer is not None:
+            self._hub_timer.cancel()
+        self._wakeup = tick
+        self._hub_timer = hubs.get_hub().schedule_call_global(
+            max(0, tick * self.resolution - time.time()), self._run)
+
+    def _next_tick(self):
+        level0 = self.levels[0]
+        for index in xrange((self.tick & _MASK) + 1, SLOTS):
+            if level0[index]:
+                return (self.tick & ~_MASK) + index
+        return ((self.tick >> SLOT_BITS) + 1) << SLOT_BITS
+
+    def _run(self):
+        # the hub does not run timers early, so the tick it was set
+        # for has come even if time.time() rounds down below it
+        target = max(self._floor(time.time()), self._wakeup)
+        self._hub_timer = None
+        self._wakeup = None
+        self._running = True
+        try:
+            while self.tick < target and self.count:
+                self.tick += 1
+                tick = self.tick
+                levels = 1
+                while levels < len(self.levels) and not (
+                        tick & ((1 << (SLOT_BITS * levels)) - 1)):
+                    levels += 1
+                for level in xrange(levels - 1, 0, -1):
+                    self._cascade(level,
+                                  (tick >> (SLOT_BITS * level)) & _MASK)
+                self._fire(tick & _MASK)
+            if not self.count:
+                self.tick = max(self.tick, target)
+        finally:
+            self._running = False
+            if self.count:
+                self._wake_at(self._next_tick())
+
+    def _cascade(self, level, index):
+        slot = self.levels[level][index]
+        if not slot:
+            return
+        self.levels[level][index] = set()
+        for timer in slot:
+            self._place(timer, max(self._ceil(timer.deadline), self.tick))
+
+    def _fire(self, index):
+        slot = self.levels[0][index]
+        if not slot:
+            return
+        self.levels[0][index] = set()
+        due = sorted(slot, key=lambda timer: (timer.deadline, timer.order))
+        for timer in due:
+            if timer.slot is not slot:
+                # cancelled by an earlier callback
+                continue
+            timer.slot = None
+            self.count -= 1
+            if timer.interval is not None:
+                timer.deadline = max(timer.deadline + timer.interval,
+                                     time.time())
+                self._place(timer, max(self._ceil(timer.deadline),
+                                       self.tick + 1))
+                self.count += 1
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                log.exception("Timer callback %r failed", timer.callback)
+
+
+wheel = Wheel()
+
+
+def call_later(delay, callback, *args):
+    """Call callback(*args) in the hub after delay seconds, using the
+    shared Wheel. Return a Timer.
+    """
+    return wheel.add(delay, callback, *args)
+
+
+def call_interval(interval, callback, *args):
+    """Call callback(*args) in the hub every interval seconds, using the
+    shared Wheel. Return a Timer.
+    """
+    return wheel.add_interval(interval, callback, *args)
+
+
+_soon = collections.deque()
+_soon_scheduled = False
+
+
+def call_soon(callback, *args):
+    """Call callback(*args) in the hub on its next turn, after the
+    callbacks given before it.
+    """
+    global _soon_scheduled
+    _soon.append((callback, args))
+    if not _soon_scheduled:
+        _soon_scheduled = True
+        hubs.get_hub().schedule_call_global(0, _run_soon)
+
+
+def _run_soon():
+    global _soon_scheduled
+    _soon_scheduled = False
+    # callbacks given meanwhile wait for the next turn
+    for i in xrange(len(_soon)):
+        callback, args = _soon.popleft()
+        try:
+            callback(*args)
+        except Exception:
+            log.exception("Callback %r failed", callback)
@@ -0,0 +1,122 @@
+
+import time
+import unittest
+from StringIO import StringIO
+import eventlet
+from eventlet import wsgi
+from pyact import actor, timers, wsgiapp
+
+
+class TestWheel(unittest.TestCase):
+
+    def test_order_and_cancel(self):
+        wheel = timers.Wheel(resolution=0.001)
+        fired = []
+        for delay in (0.03, 0.01, 0.02):
+            wheel.add(delay, fired.append, delay)
+        timer = wheel.add(0.015, fired.append, 'cancelled')
+        self.assertEquals(timer.pending, True)
+        timer.cancel()
+        self.assertEquals(timer.pending, False)
+        eventlet.sleep(0.05)
+        self.assertEquals(fired, [0.01, 0.02, 0.03])
+        self.assertEquals(wheel.count, 0)
+
+    def test_never_early(self):
+        wheel = timers.Wheel(resolution=0.001, levels=2)
+        late = []
+        def check(deadline):
+            late.append(time.time() - deadline)
+        # beyond SLOTS ** 2 ticks, so some wait in the last slot
+        for i in range(200):
+            delay = i * 0.0005
+            wheel.add(delay, check, time.time() + delay)
+        eventlet.sleep(0.15)
+        self.assertEquals(len(late), 200)
+        self.assertEquals(min(late) >= 0, True)
+
+    def test_interval(self):
+        wheel = timers.Wheel(resolution=0.001)
+        fired = []
+        timer = wheel.add_interval(0.01, lambda: fired.append(1))
+        eventlet.sleep(0.055)
+        timer.cancel()
+        count = len(fired)
+        self.assertEquals(3 <= count <= 5, True)
+        eventlet.sleep(0.02)
+        self.assertEquals(len(fired), count)
+
+    def test_call_soon(self):
+        ran = []
+        timers.call_soon(ran.append, 1)
+        timers.call_soon(ran.append, 2)
+        self.assertEquals(ran, [])
+        eventlet.sleep(0)
+        self.assertEquals(ran, [1, 2])
+
+
+class Ticker(actor.Actor):
+    def main(self, count):
+        received = []
+        for i in range(count):
+            pattern, message = self.receive({'tick': int})
+            received.append(message['tick'])
+        return received
+
+
+class TestSendAfter(unittest.TestCase):
+
+    def test_send_after(self):
+        ticker = Ticker.spawn(1)
+        actor.send_after(ticker, {'tick': 2}, 0.02)
+        actor.send_after(ticker, {'tick': 1}, 0.01)
+        self.assertEquals(ticker.wait(), [1])
+
+    def test_cancel(self):
+        ticker = Ticker.spawn(1)
+        actor.send_after(ticker, {'tick': 1}, 0.01).cancel()
+        actor.send_after(ticker, {'tick': 2}, 0.02)
+        self.assertEquals(ticker.wait(), [2])
+
+    def test_send_interval(self):
+        ticker = Ticker.spawn(3)
+        timer = actor.send_interval(ticker, {'tick': 0}, 0.005)
+        self.assertEquals(ticker.wait(), [0, 0, 0])
+        eventlet.sleep(0.02)
+        self.assertEquals(timer.pending, False)
+
+    def test_send_interval_dead(self):
+        ticker = Ticker.spawn(0)
+        ticker.wait()
+        timer = actor.send_interval(ticker, {'tick': 0}, 0.005)
+        eventlet.sleep(0.02)
+        self.assertEquals(timer.pending, False)
+
+    def test_send_interval_remote(self):
+        sock = eventlet.listen(('127.0.0.1', 0))
+        server = eventlet.spawn(wsgi.server, sock, wsgiapp.app, log=StringIO())
+        url = 'http://127.0.0.1:%s/' % (sock.getsockname()[1], )
+        try:
+            ticker = Ticker.spawn(2)
+            timer = actor.send_interval(
+                actor.RemoteAddress(url + ticker.actor_id), {'tick': 0}, 0.005)
+            self.assertEquals(ticker.wait(), [0, 0])
+            eventlet.sleep(0.05)
+            self.assertEquals(timer.pending, False)
+        finally:
+            server.kill()
+            sock.close()
+
+    def test_receive_timeout(self):
+        def waiter(receive):
+            started = time.time()
+            result = receive({'never': int}, timeout=0.02)
+            return result, time.time() - started
+        result, elapsed = actor.spawn(waiter).wait()
+        self.assertEquals(result, (None, None))
+        self.assertEquals(elapsed >= 0.02, True)
+        self.assertEquals(timers.wheel.count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""
+Tracing hooks.
+
+Install a hook with add_hook and it is called as hook(event, info)
+for the events it asked for:
+
+  SPAWN    {'actor', 'parent', 'type'}  an Actor was spawned
+  CAST     {'actor', 'to', 'size'}      an Actor (or other greenlet)
+                                        cast a message of size bytes
+  DELIVER  {'actor', 'size', 'mailbox'} a message reached a mailbox
+  RECEIVE  {'actor', 'mailbox'}         an Actor received a message
+  EXIT     {'actor', 'exception'}       an Actor finished
+
+Every info also has 'time', from time.time(), and 'trace', the trace
+id of the Actor concerned or None. 'actor' is an actor id, or None
+for a greenlet which is not an Actor.
+
+While a hook is installed, call messages carry a 'trace' id: the
+caller's own, or a new one. An Actor takes on the trace id of each
+call message it receives, so the calls it makes in turn carry it
+too. RemoteAddress and the wsgi gateway pass it along, in the call
+message and the X-Pyact-Trace header.
+
+A hook installed with sample < 1 sees that fraction of the events.
+Events with a trace id are sampled by the id, so a hook sees all of
+the events of a trace, on every node, or none of them.
+
+With no hooks installed, the actor module only checks 'enabled'.
+"""
+
+import logging
+import random
+import time
+import uuid
+
+import eventlet
+
+
+EVENTS = [SPAWN, CAST, DELIVER, RECEIVE, EXIT] = [
+    'spawn', 'cast', 'deliver', 'receive', 'exit']
+
+enabled = False
+
+log = logging.getLogger('pyact.trace')
+
+_hooks = dict((event, []) for event in EVENTS) # event : [(hook, sample)]
+
+
+def add_hook(hook, events=EVENTS, sample=1.0):
+    """Call hook(event, info) for the given events, or a sample of them.
+    """
+    global enabled
+    for event in events:
+        _hooks[event].append((hook, sample))
+    enabled = True
+
+
+def remove_hook(hook):
+    global enabled
+    for event, hooks in _hooks.items():
+        hooks[:] = [(h, sample) for (h, sample) in hooks if h is not hook]
+    enabled = any(_hooks.values())
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def current_trace():
+    """Return the trace id of the current Actor, or None.
+    """
+    return getattr(eventlet.getcurrent(), 'trace_id', None)
+
+
+def _sampled(info, sample):
+    if sample >= 1:
+        return True
+    trace_id = info.get('trace')
+    if trace_id and isinstance(trace_id, basestring):
+        try:
+            return int(trace_id[:8], 16) < sample * 0x100000000
+        except ValueError:
+            pass
+    return random.random() < sample
+
+
+def emit(event, info):
+    """Pass info about event to the hooks installed for it.
+    """
+    hooks = _hooks[event]
+    if not hooks:
+        return
+    info['time'] = time.time()
+    info.setdefault('trace', None)
+    for hook, sample in hooks:
+        if _sampled(info, sample):
+            try:
+                hook(event, info)
+            except Exception:
+                log.exception("Trace hook %r failed", hook)
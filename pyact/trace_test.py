@@ -0,0 +1,107 @@
+
+import unittest
+import eventlet
+from pyact import actor, trace
+from pyact.wsgiapp_test import serve
+
+
+class Recorder(object):
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event, info):
+        self.events.append((event, info))
+
+    def kinds(self, actor_id):
+        return [event for event, info in self.events
+                if info['actor'] == actor_id]
+
+
+class Traced(actor.Server):
+    def whoami(self, message):
+        return self.trace_id
+
+
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.recorder = Recorder()
+
+    def tearDown(self):
+        trace.remove_hook(self.recorder)
+
+    def test_disabled(self):
+        self.assertEquals(trace.enabled, False)
+        trace.add_hook(self.recorder)
+        self.assertEquals(trace.enabled, True)
+        trace.remove_hook(self.recorder)
+        self.assertEquals(trace.enabled, False)
+
+    def test_events(self):
+        trace.add_hook(self.recorder)
+        def child(receive):
+            receive()
+        def parent(receive):
+            address = actor.spawn_link(child)
+            child_id = address.actor_id
+            address.cast('hi')
+            receive()
+            return child_id
+        parent_address = actor.spawn(parent)
+        parent_id = parent_address.actor_id
+        child_id = parent_address.wait()
+        self.assertEquals(self.recorder.kinds(child_id),
+                          ['spawn', 'deliver', 'receive', 'cast', 'exit'])
+        cast = [info for event, info in self.recorder.events
+                if event == 'cast' and info['to'] == child_id][0]
+        self.assertEquals(cast['actor'], parent_id)
+        self.assertEquals(cast['size'], len('"hi"'))
+
+    def test_call_trace(self):
+        trace.add_hook(self.recorder, [trace.RECEIVE])
+        server = Traced.spawn()
+        def client(receive):
+            eventlet.getcurrent().trace_id = 'abc'
+            return server.call('whoami')
+        self.assertEquals(actor.spawn(client).wait(), 'abc')
+        def fresh(receive):
+            return server.call('whoami')
+        self.assertEquals(len(actor.spawn(fresh).wait()), 32)
+        server.kill()
+
+    def test_remote_trace(self):
+        trace.add_hook(self.recorder, [trace.RECEIVE])
+        url = serve()
+        server = Traced.spawn()
+        server._actor.rename('traced')
+        def client(receive):
+            eventlet.getcurrent().trace_id = 'abcd'
+            return actor.RemoteAddress.lookup(url + 'traced').call('whoami')
+        self.assertEquals(actor.spawn(client).wait(), 'abcd')
+        server.kill()
+
+    def test_sampling(self):
+        trace.add_hook(self.recorder, sample=0.5)
+        trace.emit(trace.EXIT, {'actor': 'a', 'trace': '00000000'})
+        trace.emit(trace.EXIT, {'actor': 'b', 'trace': 'ffffffff'})
+        self.assertEquals(self.recorder.kinds('a'), ['exit'])
+        self.assertEquals(self.recorder.kinds('b'), [])
+
+    def test_user_trace_key(self):
+        """Assert that a 'trace' key in an ordinary message is neither
+        adopted as the trace id nor fatal to a sampled hook.
+        """
+        trace.add_hook(self.recorder, sample=0.5)
+        class Receiver(actor.Actor):
+            def main(self):
+                pattern, message = self.receive()
+                return self.trace_id, message
+        address = Receiver.spawn()
+        actor_id = address.actor_id
+        address.cast({'trace': 7, 'x': 1})
+        self.assertEquals(address.wait(), (None, {'trace': 7, 'x': 1}))
+        self.assertEquals(actor_id in actor.Actor.all_actors, False)
+
+
+if __name__ == '__main__':
+    unittest.main()
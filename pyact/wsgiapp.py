@@ -1,7 +1,82 @@
 
+import collections
+import hashlib
 import traceback
+import urlparse
+import uuid
+import weakref
 import eventlet
-from pyact import actor, shape
+from eventlet import event
+from eventlet import greenlet
+from pyact import actor, shape, timers
+
+
+## Default and maximum number of published messages held for a streaming
+## GET client. When a slow client falls this far behind, messages are dropped
+## according to the drop policy and the client is told how many it missed.
+STREAM_BUFFER = 100
+STREAM_BUFFER_MAX = 10000
+
+## Seconds between keepalives sent to an idle streaming client.
+STREAM_KEEPALIVE = 15
+
+## Number of encoded GET responses of versioned actors to keep.
+SNAPSHOT_CACHE_SIZE = 256
+
+
+## Number of compiled code strings kept by compile_code.
+CODE_CACHE_SIZE = 256
+
+## Most actors one PUT /_spawn request may create.
+SPAWN_MANY_MAX = 10000
+
+TEMPLATE_PREFIX = '_templates/'
+SPAWN_PATH = '_spawn'
+LOAD_PATH = '_load'
+STATS_PATH = '_stats'
+
+## Prometheus names and types of the node_stats and Actor.stats counters.
+_METRICS = [
+    ('actors', 'pyact_actors', 'gauge'),
+    ('spawned', 'pyact_spawned_total', 'counter'),
+    ('exited', 'pyact_exited_total', 'counter'),
+    ('messages_in', 'pyact_messages_in_total', 'counter'),
+    ('messages_out', 'pyact_messages_out_total', 'counter'),
+    ('messages_scanned', 'pyact_messages_scanned_total', 'counter'),
+    ('mailbox', 'pyact_mailbox_messages', 'gauge'),
+    ('mailbox_peak', 'pyact_mailbox_peak_messages', 'gauge'),
+    ('blocked_time', 'pyact_blocked_seconds_total', 'counter'),
+    ('unblocked_time', 'pyact_unblocked_seconds_total', 'counter')]
+
+_code_cache = collections.OrderedDict() # sha1 of source : code object
+_templates = {} # name : code object
+_epochs = weakref.WeakKeyDictionary() # Actor : id unique to that Actor
+
+
+def _epoch(an_actor):
+    """
+    Return an id unique to an_actor, so that its ETags and cached
+    snapshots are not those of an earlier Actor of the same name.
+    """
+    epoch = _epochs.get(an_actor)
+    if epoch is None:
+        epoch = _epochs[an_actor] = uuid.uuid4().hex[:16]
+    return epoch
+
+
+def compile_code(code_string):
+    """
+    Compile actor source code, reusing the code object of
+    recently compiled identical source.
+    """
+    key = hashlib.sha1(code_string).hexdigest()
+    code = _code_cache.pop(key, None)
+    if code is None:
+        code = compile(code_string, '<actor %s>' % (key[:8], ), 'exec')
+    _code_cache[key] = code
+    while len(_code_cache) > CODE_CACHE_SIZE:
+        _code_cache.popitem(last=False)
+    return code
 
 
 def spawn_code(code_string):
@@ -9,16 +84,19 @@ def spawn_code(code_string):
 
 
 class EvalActor(actor.Actor):
-    def main(self, path, body):
+    def main(self, path, body, args=None):
         if path is not None:
             self.rename(path)
         try:
+            if isinstance(body, basestring):
+                body = compile_code(body)
             exec body in {
                 'actor_id': self.actor_id,
                 'address': self.address,
                 'receive': self.receive,
                 'cooperate': self.cooperate,
                 'sleep': self.sleep,
+                'args': args,
                 'lookup': actor.RemoteAddress.lookup,
                 'spawn_code': spawn_code,
                 'spawn_remote': actor.spawn_remote}, vars(self)
@@ -35,24 +113,143 @@ class LocalCaller(actor.Actor):
     Performs a local call on behalf of a remote caller and 
     immediately exists
     """
-    def main(self,local_addr,message_id,method,message,timeout):
+    def main(self,local_addr,message_id,method,message,timeout,trace_id=None):
         my_address = eventlet.getcurrent().address
-        local_addr | {'call':message_id,
-                      'method':method,
-                      'address':my_address,
-                      'message':message}
+        call_msg = {'call':message_id,
+                    'method':method,
+                    'address':my_address,
+                    'message':message}
+        if trace_id:
+            self.trace_id = call_msg['trace'] = trace_id
+        local_addr | call_msg
         if timeout is None:
             cancel = None
         else:
-            cancel = eventlet.Timeout(timeout,eventlet.TimeoutError)
+            cancel = timers.call_later(timeout,self.throw,eventlet.TimeoutError)
         RSP = {'response':message_id,'message':object}
         EXC = {'response':message_id,'exception':object}
         INV = {'response':message_id,'invalid_method':str}
-        _,res = self.receive(RSP,EXC,INV)
+        try:
+            _,res = self.receive(RSP,EXC,INV)
+        finally:
+            if cancel is not None:
+                cancel.cancel()
         return res
 
+class StreamSubscriber(actor.Actor):
+    """
+    Subscribes to an actor on behalf of a streaming GET request.
+    It is never run; the response iterator drains its mailbox,
+    which is bounded to maxlen messages. When the mailbox is full
+    the 'oldest' policy drops the oldest waiting message and the
+    'newest' policy drops the incoming one.
+    """
+    def __init__(self, maxlen=STREAM_BUFFER, drop='oldest'):
+        # not Actor.__init__: since it never runs, it is neither
+        # registered nor counted as spawned in node_stats
+        greenlet.greenlet.__init__(self)
+        self._actor_id = str(uuid.uuid1())
+        self.maxlen = maxlen
+        self.drop = drop
+        self.dropped = 0
+
+    def _cast(self, message, as_json=True):
+        if len(self._mailbox) >= self.maxlen:
+            self.dropped += 1
+            if self.drop == 'newest':
+                return
+            self._mailbox.pop(0)
+        actor.Actor._cast(self, message, as_json)
+
+    def wake(self):
+        if self._wevent and not self._wevent.has_result():
+            self._wevent.send(None)
+
+
+def _wake_on_exit(source, subscriber):
+    try:
+        source._exit_event.wait()
+    except Exception:
+        pass
+    subscriber.wake()
+
+
+def _stream(source, subscriber, fmt, encode, keepalive):
+    """
+    Response iterator for a streaming GET. Yields published
+    messages as server-sent events or as JSON lines until the
+    source actor exits or the client goes away.
+    """
+    if fmt == 'sse':
+        frame = 'data: %s\n\n'
+        dropped_frame = 'event: dropped\ndata: %s\n\n'
+        idle_frame = ': keepalive\n\n'
+    else:
+        frame = '%s\n'
+        dropped_frame = '{"_pyact_dropped": %s}\n'
+        idle_frame = '\n'
+    watcher = eventlet.spawn(_wake_on_exit, source, subscriber)
+    try:
+        while True:
+            if not subscriber._mailbox:
+                if source.dead:
+                    return
+                subscriber._wevent = event.Event()
+                try:
+                    with eventlet.Timeout(keepalive, False):
+                        subscriber._wevent.wait()
+                finally:
+                    subscriber._wevent = None
+                if not subscriber._mailbox:
+                    if source.dead:
+                        return
+                    yield idle_frame
+                    continue
+            chunks = []
+            if subscriber.dropped:
+                chunks.append(dropped_frame % subscriber.dropped)
+                subscriber.dropped = 0
+            while subscriber._mailbox:
+                chunks.append(frame % encode(subscriber._mailbox.pop(0)))
+            yield ''.join(chunks)
+    finally:
+        watcher.kill()
+        source.remove_subscriber(subscriber.address)
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(stats):
+    """
+    Format node_stats output in the Prometheus text format. Actor
+    stats become pyact_actor_* samples labelled by actor_id and type.
+    """
+    lines = []
+    for key, name, kind in _METRICS:
+        lines.append('# TYPE %s %s' % (name, kind))
+        lines.append('%s %s' % (name, stats[key]))
+    actor_stats = stats.get('actor_stats')
+    if actor_stats:
+        for key, name, kind in _METRICS:
+            if key not in actor_stats[0]:
+                continue
+            name = name.replace('pyact_', 'pyact_actor_', 1)
+            lines.append('# TYPE %s %s' % (name, kind))
+            for an_actor in actor_stats:
+                lines.append('%s{actor_id="%s",type="%s"} %s' % (
+                    name, _label(an_actor['actor_id']),
+                    _label(an_actor['type']), an_actor[key]))
+    return '\n'.join(lines) + '\n'
+
+
 class ActorApplication(object):
 
+    def __init__(self):
+        # (actor_id, state version, local address, query) : (headers, body)
+        self._snapshots = collections.OrderedDict()
+
     def __call__(self, env, start_response):
         path = env['PATH_INFO'][1:]
         method = 'do_'+env['REQUEST_METHOD']
@@ -63,10 +260,100 @@ class ActorApplication(object):
         if not path:
             start_response('405 Method Not Allowed', [('Content-type', 'text/plain')])
             return 'Method Not Allowed\n'
-        new_actor = EvalActor.spawn(path, env['wsgi.input'].read(int(env['CONTENT_LENGTH'])))
+        body = env['wsgi.input'].read(int(env['CONTENT_LENGTH']))
+        if path == SPAWN_PATH:
+            return self.put_spawn_many(body, start_response)
+        if path.startswith(TEMPLATE_PREFIX):
+            return self.put_template(path[len(TEMPLATE_PREFIX):], body, start_response)
+        query = urlparse.parse_qs(env.get('QUERY_STRING', ''))
+        if 'template' in query:
+            code = _templates.get(query['template'][0])
+            if code is None:
+                start_response('404 Not Found', [('Content-type', 'text/plain')])
+                return 'Not Found\n'
+            try:
+                args = body and actor.json.loads(body, object_hook=actor.generate_custom) or None
+            except ValueError:
+                start_response('400 Bad Request', [('Content-type', 'text/plain')])
+                return 'Bad Request\n'
+            new_actor = EvalActor.spawn(path, code, args)
+        else:
+            new_actor = EvalActor.spawn(path, body)
         start_response('202 Accepted', [('Content-type', 'text/plain')])
         return 'Accepted\n'
 
+    def put_spawn_many(self,body,start_response):
+        """
+        Spawn several actors from one json request of the form
+        {'count': N, 'code': <source>} or
+        {'count': N, 'template': <name>, 'args': <args>}.
+        Respond with {'actors': [<actor_id>, ...]}.
+        """
+        try:
+            req = actor.json.loads(body, object_hook=actor.generate_custom)
+            count = int(req.get('count', 1))
+            if 'template' in req:
+                code = _templates.get(req['template'])
+                if code is None:
+                    start_response('404 Not Found', [('Content-type', 'text/plain')])
+                    return 'Not Found\n'
+            else:
+                code = compile_code(req['code'])
+        except (ValueError, KeyError, TypeError, AttributeError, SyntaxError):
+            traceback.print_exc()
+            start_response('400 Bad Request', [('Content-type', 'text/plain')])
+            return 'Bad Request\n'
+        if not 0 < count <= SPAWN_MANY_MAX:
+            start_response('400 Bad Request', [('Content-type', 'text/plain')])
+            return 'Bad Request\n'
+        args = req.get('args')
+        ids = [EvalActor.spawn(None, code, args).actor_id for i in xrange(count)]
+        start_response('202 Accepted', [('Content-type', 'application/json')])
+        return actor.json.dumps({'actors': ids}) + '\n'
+
+    def get_load(self,start_response):
+        """
+        Report how busy this node is, for placing new actors.
+        """
+        mailbox = 0
+        for an_actor in actor.Actor.all_actors.values():
+            mailbox += len(getattr(an_actor, '_p_mailbox', ()))
+        start_response('200 OK', [('Content-type', 'application/json')])
+        return actor.json.dumps({'actors': len(actor.Actor.all_actors),
+                                 'mailbox': mailbox}) + '\n'
+
+    def get_stats(self,env,start_response):
+        """
+        Report the node_stats counters, with the stats of every
+        actor if actors=1, as json or, with format=prometheus, in
+        the Prometheus text format.
+        """
+        query = urlparse.parse_qs(env.get('QUERY_STRING', ''))
+        stats = actor.node_stats(query.get('actors') == ['1'])
+        if query.get('format') == ['prometheus']:
+            start_response('200 OK', [('Content-type', 'text/plain; version=0.0.4')])
+            return prometheus_text(stats)
+        start_response('200 OK', [('Content-type', 'application/json')])
+        return actor.json.dumps(stats) + '\n'
+
+    def put_template(self,name,body,start_response):
+        """
+        Compile body and register it as the named template. Actors
+        are then spawned from it with PUT /<path>?template=<name>
+        and a json body which the code sees as 'args'.
+        """
+        if not name:
+            start_response('405 Method Not Allowed', [('Content-type', 'text/plain')])
+            return 'Method Not Allowed\n'
+        try:
+            _templates[name] = compile_code(body)
+        except SyntaxError:
+            traceback.print_exc()
+            start_response('400 Bad Request', [('Content-type', 'text/plain')])
+            return 'Bad Request\n'
+        start_response('201 Created', [('Content-type', 'text/plain')])
+        return 'Created\n'
+
     def do_POST(self,path,env,start_response):
         local_address = 'http://%s/' % (env['HTTP_HOST'], )
         old_actor = actor.Actor.all_actors.get(path)
@@ -95,23 +382,29 @@ class ActorApplication(object):
             return 'Accepted\n'
         
         # handle a remote call
+        trace_id = msg.get('trace') or env.get('HTTP_X_PYACT_TRACE')
+        headers = [('Content-type','application/json')]
+        if trace_id:
+            headers.append(('X-Pyact-Trace', trace_id))
         try:
             rmsg = LocalCaller.spawn(local_addr=old_actor.address,
                                      message_id=msg['remotecall'],
                                      method=msg['method'],
                                      message=msg['message'],
-                                     timeout=msg['timeout']).wait()
+                                     timeout=msg['timeout'],
+                                     trace_id=trace_id).wait()
         except eventlet.TimeoutError:
             start_response('408 Request Timeout',[('Content-type','text/plain')])
             return actor.json.dumps({'timeout':msg['timeout']})+'\n'
 
-        resp_str = actor.json.dumps(rmsg, default=_remote_handle_custom)+'\n'
+        resp_str = actor.json.dumps(
+            rmsg, default=_remote_handle_custom(local_address))+'\n'
         if shape.is_shaped(rmsg, RSP_PAT):
-            start_response('202 Accepted',[('Content-type','application/json')])
+            start_response('202 Accepted',headers)
         elif shape.is_shaped(rmsg, INV_PAT):
-            start_response('404 Not Found',[('Content-type','application/json')])
+            start_response('404 Not Found',headers)
         else:
-            start_response('406 Not Acceptable',[('Content-type','application/json')])
+            start_response('406 Not Acceptable',headers)
         return resp_str
 
 
@@ -139,26 +432,130 @@ class ActorApplication(object):
         elif path == 'some-js-file.js':
             start_response('200 OK', [('Content-type', 'text/plain')])
             return 'some-js-file\n'
+        elif path == LOAD_PATH:
+            return self.get_load(start_response)
+        elif path == STATS_PATH:
+            return self.get_stats(env, start_response)
 
         old_actor = actor.Actor.all_actors.get(path)
         if old_actor is None:
             start_response('404 Not Found', [('Content-type', 'text/plain')])
             return "Not Found\n"
-        start_response('200 OK', [('Content-type', 'application/json')])
         local_address = 'http://%s/' % (env['HTTP_HOST'], )
+        query = urlparse.parse_qs(env.get('QUERY_STRING', ''))
+        if query.get('stream', ['0'])[0] not in ('', '0'):
+            return self.do_stream(old_actor, query, local_address, start_response)
+
+        try:
+            fields = query.get('fields', [None])[0]
+            if fields is not None:
+                fields = set(fields.split(','))
+            offset = int(query.get('offset', [0])[0])
+            limit = query.get('limit', [None])[0]
+            if limit is not None:
+                limit = int(limit)
+            since = query.get('since', [None])[0]
+            if since is not None:
+                since = int(since)
+        except ValueError:
+            start_response('400 Bad Request', [('Content-type', 'text/plain')])
+            return 'Bad Request\n'
+
+        version = old_actor.state_version
+        headers = [('Content-type', 'application/json')]
+        if version is not None:
+            epoch = _epoch(old_actor)
+            etag = '"%s-%s"' % (epoch, version)
+            headers.append(('ETag', etag))
+            if env.get('HTTP_IF_NONE_MATCH') == etag:
+                start_response('304 Not Modified', headers)
+                return ''
+            key = (epoch, version, local_address,
+                   env.get('QUERY_STRING', ''))
+            cached = self._snapshots.pop(key, None)
+            if cached is not None:
+                self._snapshots[key] = cached
+                start_response('200 OK', headers + cached[0])
+                return cached[1]
+
+        if since is not None:
+            changed = old_actor.changed_since(since)
+            if changed is not None:
+                fields = changed if fields is None else changed & fields
+        state = vars(old_actor)
+        to_dump = dict([(x, y) for (x, y) in state.items()
+                        if not x.startswith('_')
+                        and (fields is None or x in fields)])
+
+        totals = []
+        if offset or limit is not None:
+            for name, value in to_dump.items():
+                if isinstance(value, (list, tuple)):
+                    totals.append('%s=%s' % (name, len(value)))
+                    if limit is None:
+                        to_dump[name] = value[offset:]
+                    else:
+                        to_dump[name] = value[offset:offset + limit]
+        extra = []
+        if totals:
+            extra.append(('X-Pyact-Total', ','.join(sorted(totals))))
+
+        if since is not None:
+            to_dump = {'version': version,
+                       'full': changed is None,
+                       'state': to_dump,
+                       'removed': sorted([x for x in (changed or ())
+                                          if x not in state])}
+        body = actor.json.dumps(
+            to_dump, default=_remote_handle_custom(local_address)) + '\n'
+        if version is not None:
+            self._snapshots[key] = (extra, body)
+            while len(self._snapshots) > SNAPSHOT_CACHE_SIZE:
+                self._snapshots.popitem(last=False)
+        start_response('200 OK', headers + extra)
+        return body
+
+    def do_stream(self,old_actor,query,local_address,start_response):
+        """
+        Subscribe to the messages old_actor publishes and stream them
+        to the client. The query may give format=sse (the default)
+        or format=jsonl, buffer=<max messages held for this client>
+        and drop=oldest|newest.
+        """
+        fmt = query.get('format', ['sse'])[0]
+        drop = query.get('drop', ['oldest'])[0]
+        try:
+            maxlen = int(query.get('buffer', [STREAM_BUFFER])[0])
+        except ValueError:
+            maxlen = 0
+        if (fmt not in ('sse', 'jsonl') or drop not in ('oldest', 'newest')
+            or not 0 < maxlen <= STREAM_BUFFER_MAX):
+            start_response('400 Bad Request', [('Content-type', 'text/plain')])
+            return 'Bad Request\n'
+
+        subscriber = StreamSubscriber(maxlen, drop)
+        old_actor.add_subscriber(subscriber.address)
+        default = _remote_handle_custom(local_address)
+        encode = lambda msg: actor.json.dumps(msg, default=default)
+        if fmt == 'sse':
+            content_type = 'text/event-stream'
+        else:
+            content_type = 'application/x-json-stream'
+        start_response('200 OK', [('Content-type', content_type),
+                                  ('Cache-Control', 'no-cache')])
+        return _stream(old_actor, subscriber, fmt, encode, STREAM_KEEPALIVE)
 
-        to_dump = dict([(x, y) for (x, y) in vars(old_actor).items() if not x.startswith('_')])
-        return actor.json.dumps(to_dump, default=_remote_handle_custom) + '\n'
-        
 
-def _remote_handle_custom(obj):
-    """Custom json handling of remote addresses.
-    Falls back on actor.handle_custom to handle
-    Binary or other objects.
+def _remote_handle_custom(local_address):
+    """Return a custom json handler which encodes addresses
+    as urls relative to local_address. Falls back on
+    actor.handle_custom to handle Binary or other objects.
     """
-    if isinstance(obj, actor.Address):
-        return {'address': local_address + obj.actor_id}
-    return actor.handle_custom(obj)
+    def handle_custom(obj):
+        if isinstance(obj, actor.Address):
+            return {'address': local_address + obj.actor_id}
+        return actor.handle_custom(obj)
+    return handle_custom
     
 
 app = ActorApplication()
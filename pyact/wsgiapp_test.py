@@ -0,0 +1,332 @@
+
+import time
+import unittest
+import eventlet
+from eventlet import wsgi
+from StringIO import StringIO
+from pyact import actor, wsgiapp
+
+
+def request(method, path, body='', query=''):
+    """
+    Call the wsgi application directly. Return the
+    status line, the headers and the response body
+    iterator.
+    """
+    env = {'REQUEST_METHOD': method,
+           'PATH_INFO': '/' + path,
+           'QUERY_STRING': query,
+           'HTTP_HOST': 'localhost:8080',
+           'CONTENT_LENGTH': str(len(body)),
+           'wsgi.input': StringIO(body)}
+    started = []
+    def start_response(status, headers):
+        started.append((status, dict(headers)))
+    result = wsgiapp.app(env, start_response)
+    status, headers = started[0]
+    return status, headers, result
+
+
+def serve():
+    """
+    Serve the wsgi application on a free local port.
+    Return the url of the server.
+    """
+    sock = eventlet.listen(('127.0.0.1', 0))
+    eventlet.spawn_n(wsgi.server, sock, wsgiapp.app, log=StringIO())
+    return 'http://127.0.0.1:%s/' % (sock.getsockname()[1], )
+
+
+class Publisher(actor.Actor):
+    def main(self):
+        while True:
+            pat, msg = self.receive()
+            if msg == 'stop':
+                return
+            self.publish(msg)
+
+
+class TestStream(unittest.TestCase):
+
+    def test_stream_sse(self):
+        publisher = Publisher.spawn()
+        eventlet.sleep(0)
+        status, headers, body = request('GET', publisher.actor_id, query='stream=1')
+        self.assertEquals(status, '200 OK')
+        self.assertEquals(headers['Content-type'], 'text/event-stream')
+        publisher | {'tick': 1}
+        publisher | {'tick': 2}
+        chunk = body.next()
+        self.assertEquals(chunk, 'data: {"tick": 1}\n\ndata: {"tick": 2}\n\n')
+        publisher | 'stop'
+        publisher.wait()
+        self.assertRaises(StopIteration, body.next)
+
+    def test_stream_jsonl_drops_oldest(self):
+        publisher = Publisher.spawn()
+        eventlet.sleep(0)
+        status, headers, body = request(
+            'GET', publisher.actor_id, query='stream=1&format=jsonl&buffer=2')
+        for i in range(5):
+            publisher | i
+        eventlet.sleep(0.01)
+        self.assertEquals(body.next(), '{"_pyact_dropped": 3}\n3\n4\n')
+        body.close()
+        self.assertEquals(publisher._actor._subscribers, [])
+        publisher.kill()
+
+    def test_stream_ends_on_exit(self):
+        publisher = Publisher.spawn()
+        eventlet.sleep(0)
+        spawned = actor.node_stats()['spawned']
+        status, headers, body = request('GET', publisher.actor_id, query='stream=1')
+        self.assertEquals(actor.node_stats()['spawned'], spawned)
+        eventlet.spawn_after(0.01, publisher.kill)
+        started = time.time()
+        self.assertRaises(StopIteration, body.next)
+        self.assertEquals(time.time() - started < 1, True)
+
+    def test_stream_bad_request(self):
+        publisher = Publisher.spawn()
+        status, headers, body = request(
+            'GET', publisher.actor_id, query='stream=1&buffer=0')
+        self.assertEquals(status, '400 Bad Request')
+        publisher.kill()
+
+
+class Counter(actor.Actor):
+    def main(self):
+        self.count = 0
+        self.log = []
+        self.name = 'counter'
+        self.changed()
+        while True:
+            pat, msg = self.receive()
+            self.count += 1
+            self.log.append(msg)
+            self.changed('count', 'log')
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.counter = Counter.spawn()
+        eventlet.sleep(0)
+
+    def tearDown(self):
+        self.counter.kill()
+
+    def get(self, query=''):
+        return self.get_path(self.counter.actor_id, query)
+
+    def get_path(self, path, query=''):
+        status, headers, body = request('GET', path, query=query)
+        return status, headers, body and actor.json.loads(body)
+
+    def test_fields(self):
+        status, headers, state = self.get('fields=count,name')
+        self.assertEquals(state, {'count': 0, 'name': 'counter'})
+
+    def test_pagination(self):
+        for i in range(10):
+            self.counter | i
+        eventlet.sleep(0)
+        status, headers, state = self.get('fields=log&offset=2&limit=3')
+        self.assertEquals(state, {'log': [2, 3, 4]})
+        self.assertEquals(headers['X-Pyact-Total'], 'log=10')
+
+    def test_etag_and_cache(self):
+        status, headers, state = self.get()
+        etag = headers['ETag']
+        self.assertEquals(etag.endswith('-1"'), True)
+        status, headers, body = request('GET', self.counter.actor_id)
+        self.assertEquals(len(wsgiapp.app._snapshots) > 0, True)
+        env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/' + self.counter.actor_id,
+               'HTTP_HOST': 'localhost:8080', 'HTTP_IF_NONE_MATCH': etag}
+        started = []
+        wsgiapp.app(env, lambda status, headers: started.append(status))
+        self.assertEquals(started, ['304 Not Modified'])
+        self.counter | 'bump'
+        eventlet.sleep(0)
+        started = []
+        wsgiapp.app(env, lambda status, headers: started.append(status))
+        self.assertEquals(started, ['200 OK'])
+
+    def test_restarted_actor(self):
+        def versioned(receive, val):
+            current = actor.eventlet.getcurrent()
+            current.val = val
+            current.changed()
+            receive()
+        first = actor.spawn(versioned, 1)
+        first._actor.rename('versioned')
+        eventlet.sleep(0)
+        status, headers, state = self.get_path('versioned')
+        self.assertEquals(state, {'val': 1})
+        etag = headers['ETag']
+        first.kill()
+        second = actor.spawn(versioned, 2)
+        second._actor.rename('versioned')
+        eventlet.sleep(0)
+        status, headers, state = self.get_path('versioned')
+        self.assertEquals(state, {'val': 2})
+        self.assertEquals(headers['ETag'] != etag, True)
+        second.kill()
+
+    def test_since(self):
+        self.counter | 'bump'
+        eventlet.sleep(0)
+        status, headers, diff = self.get('since=1')
+        self.assertEquals(diff, {'version': 2, 'full': False, 'removed': [],
+                                 'state': {'count': 1, 'log': ['bump']}})
+        status, headers, diff = self.get('since=0')
+        self.assertEquals(diff['full'], True)
+        self.assertEquals(diff['state']['name'], 'counter')
+
+
+class TestTemplates(unittest.TestCase):
+
+    def test_compile_cache(self):
+        code = wsgiapp.compile_code('x = 1\n')
+        self.assertEquals(wsgiapp.compile_code('x = 1\n') is code, True)
+
+    def test_spawn_template(self):
+        status, headers, body = request(
+            'PUT', '_templates/adder', 'total = args["a"] + args["b"]\nreceive()\n')
+        self.assertEquals(status, '201 Created')
+        status, headers, body = request(
+            'PUT', 'sum1', '{"a": 1, "b": 2}', query='template=adder')
+        self.assertEquals(status, '202 Accepted')
+        eventlet.sleep(0)
+        status, headers, body = request('GET', 'sum1')
+        self.assertEquals(actor.json.loads(body), {'total': 3})
+        actor.Address.lookup('sum1').kill()
+
+    def test_unknown_template(self):
+        status, headers, body = request('PUT', 'sum2', '', query='template=nope')
+        self.assertEquals(status, '404 Not Found')
+
+    def test_bad_template(self):
+        status, headers, body = request('PUT', '_templates/bad', 'def (\n')
+        self.assertEquals(status, '400 Bad Request')
+
+
+WORKER = 'n = args\nreceive()\n'
+
+
+class TestSpawnMany(unittest.TestCase):
+
+    def test_spawn_many(self):
+        status, headers, body = request(
+            'PUT', '_spawn', actor.json.dumps({'count': 3, 'code': WORKER}))
+        self.assertEquals(status, '202 Accepted')
+        ids = actor.json.loads(body)['actors']
+        self.assertEquals(len(ids), 3)
+        status, headers, body = request('GET', '_load')
+        load = actor.json.loads(body)
+        self.assertEquals(load['actors'] >= 3, True)
+        for actor_id in ids:
+            actor.Address.lookup(actor_id).kill()
+
+    def test_spawn_many_bad_count(self):
+        status, headers, body = request(
+            'PUT', '_spawn', actor.json.dumps({'count': 0, 'code': WORKER}))
+        self.assertEquals(status, '400 Bad Request')
+
+    def test_spawn_remote_placed(self):
+        url = serve()
+        actor.register_template(url, 'worker', WORKER)
+        addresses = actor.spawn_remote_placed(
+            [url], 4, template='worker', args=7)
+        self.assertEquals(len(addresses), 4)
+        eventlet.sleep(0.01)
+        for address in addresses:
+            self.assertEquals(address.actor_id.startswith(url), True)
+            local = actor.Address.lookup(address.actor_id[len(url):])
+            self.assertEquals(local._actor.n, 7)
+            local.kill()
+
+
+class TestLookupCache(unittest.TestCase):
+
+    def test_lookup_cache(self):
+        url = serve()
+        cache = actor.RemoteAddress.lookup_cache
+        cache.clear()
+        publisher = Publisher.spawn()
+        publisher._actor.rename('cached')
+        hits, misses = cache.hits, cache.misses
+        remote = actor.RemoteAddress.lookup(url + 'cached')
+        actor.RemoteAddress.lookup(url + 'cached')
+        self.assertEquals((cache.hits - hits, cache.misses - misses), (1, 1))
+
+        publisher | 'stop'
+        publisher.wait()
+        self.assertEquals(cache.get(url + 'cached'), True)
+        remote.cast('hello')
+        self.assertEquals(cache.get(url + 'cached'), None)
+        self.assertRaises(KeyError, actor.RemoteAddress.lookup, url + 'cached')
+        self.assertEquals(cache.get(url + 'cached'), False)
+
+    def test_expiry(self):
+        cache = actor.LookupCache(maxsize=2, ttl=-1)
+        cache.put('http://a/x', True)
+        self.assertEquals(cache.get('http://a/x'), None)
+        cache = actor.LookupCache(maxsize=2)
+        for name in 'xyz':
+            cache.put('http://a/' + name, True)
+        self.assertEquals(cache.get('http://a/x'), None)
+        self.assertEquals(cache.get('http://a/z'), True)
+
+
+class TestSupervisorState(unittest.TestCase):
+
+    def test_get_supervisor(self):
+        sup = actor.Supervisor.spawn([{'id': 'a', 'start': Counter}])
+        eventlet.sleep(0)
+        status, headers, body = request('GET', sup.actor_id)
+        self.assertEquals(status, '200 OK')
+        self.assertEquals(actor.json.loads(body)['strategy'], 'one_for_one')
+        sup.kill()
+
+
+class TestStats(unittest.TestCase):
+
+    def test_stats_json(self):
+        counter = Counter.spawn()
+        counter | 'bump'
+        eventlet.sleep(0)
+        status, headers, body = request('GET', '_stats', query='actors=1')
+        stats = actor.json.loads(body)
+        self.assertEquals(stats['actors'] >= 1, True)
+        mine = [s for s in stats['actor_stats']
+                if s['actor_id'] == counter.actor_id]
+        self.assertEquals(mine[0]['messages_in'], 1)
+        self.assertEquals(mine[0]['type'], 'Counter')
+        counter.kill()
+
+    def test_counters_not_state(self):
+        counter = Counter.spawn()
+        counter | 'bump'
+        eventlet.sleep(0)
+        status, headers, body = request('GET', counter.actor_id)
+        self.assertEquals(sorted(actor.json.loads(body)),
+                          ['count', 'log', 'name'])
+        counter.kill()
+
+    def test_stats_prometheus(self):
+        counter = Counter.spawn()
+        eventlet.sleep(0)
+        status, headers, body = request(
+            'GET', '_stats', query='format=prometheus&actors=1')
+        self.assertEquals(headers['Content-type'], 'text/plain; version=0.0.4')
+        lines = body.splitlines()
+        self.assertEquals('# TYPE pyact_messages_in_total counter' in lines, True)
+        self.assertEquals(
+            'pyact_actor_mailbox_messages{actor_id="%s",type="Counter"} 0' % (
+                counter.actor_id, ) in lines, True)
+        counter.kill()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,6 @@ setup(name = "python-actors",
       version = "0.1",
       long_description = "Python Actors",
       author='Donovan Preston',
-      packages = ['pyact'],
+      packages = ['pyact', 'pyact.bench'],
       package_dir = {'pyact': 'pyact'},
     )